@@ -6,20 +6,35 @@ import json
 import uuid
 import shutil
 import hashlib
+import sqlite3
+import mimetypes
 import functools
 from datetime import datetime, timedelta, timezone
 import time
+_BOOT_STARTED = time.perf_counter()
 from pathlib import Path
+from glob import escape as glob_escape
+from urllib.parse import quote
 from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, session, flash
+from werkzeug.security import safe_join
+from flask import Flask, Response, render_template, request, jsonify, send_file, send_from_directory, redirect, url_for, session, flash, stream_with_context
 from flask_cors import CORS
 from flask_login import login_user, logout_user, login_required, current_user
 from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
 import random
 import pathlib
+import io
+import csv
+import base64
+import queue
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from collections import deque
-from sqlalchemy import inspect, text
-from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+from sqlalchemy import text, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, joinedload, aliased
 from sqlalchemy.exc import OperationalError, IntegrityError
 
 # Décorateur personnalisé pour l'accès invité stylisé (Étape 8)
@@ -34,29 +49,43 @@ def guest_allowed(f):
 # Importation des modules locaux
 from config import *
 from extensions import db, login_manager, mail
+import backups
 from flask_mail import Message as MailMessage
 import threading
 import smtplib
-import socket # Ajouté pour détecter l'IP locale
 import asyncio
 from aiosmtpd.controller import Controller
 from aiosmtpd.handlers import Sink
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-# Détection de l'IP locale du serveur pour les exceptions d'administration
-def get_server_ip():
+# Processus du pool de rendu (contexte 'spawn') : Python y ré-exécute app.py sous le
+# nom __mp_main__ ; les définitions suffisent, les effets de bord du démarrage
+# (vérification de la base, thread d'emails, filtre de contenu...) sont sautés
+POOL_WORKER = __name__ == '__mp_main__'
+
+# ============================================
+# DÉMARRAGE PAR ÉTAPES (CHRONOMÉTRAGE)
+# ============================================
+# Le chemin critique se limite à la confirmation du schéma : vérification
+# d'intégrité, sauvegardes, SMTP et rafraîchissement de static/ tournent en
+# arrière-plan. Chaque étape est chronométrée et résumée avant le premier accept.
+_BOOT_TIMINGS = []
+
+@contextmanager
+def boot_stage(name):
+    started = time.perf_counter()
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except:
-        return "127.0.0.1"
+        yield
+    finally:
+        _BOOT_TIMINGS.append((name, time.perf_counter() - started))
 
-SERVER_IP_ADDRESS = get_server_ip()
-print(f"[KRONOS] IP du serveur détectée: {SERVER_IP_ADDRESS}")
+def print_boot_timings():
+    total = time.perf_counter() - _BOOT_STARTED
+    staged = sum(duration for _, duration in _BOOT_TIMINGS)
+    parts = [f"{name} {duration * 1000:.0f} ms" for name, duration in _BOOT_TIMINGS]
+    parts.append(f"imports/routes {(total - staged) * 1000:.0f} ms")
+    print(f"[BOOT] Prêt en {total * 1000:.0f} ms ({', '.join(parts)})")
 
 # ============================================
 # SERVEUR SMTP INTERNE (AUTO-HÉBERGÉ)
@@ -185,6 +214,7 @@ def safe_disconnect(socket_id):
 
 import re
 import difflib
+import unicodedata
 _ANTISPAM_COUNTERS = {}
 _ANTISPAM_RECENT = {}
 _ANTISPAM_MUTES = {}
@@ -387,9 +417,13 @@ def _delete_recent_messages_of_user(user_id, seconds_window):
             Message.is_deleted == False,
             Message.created_at >= cutoff
         ).all()
+        deleted_by_channel = {}
         for m in msgs:
             m.is_deleted = True
             m.content = ""
+            deleted_by_channel.setdefault(m.channel_id, []).append(m.id)
+        for channel_id, message_ids in deleted_by_channel.items():
+            rewind_dm_activity(channel_id, message_ids)
         db.session.commit()
         for m in msgs:
             _ANTISPAM_DELETE_QUEUE.append((m.id, m.channel_id))
@@ -399,13 +433,136 @@ def _delete_recent_messages_of_user(user_id, seconds_window):
     except Exception as e:
         print(f"[ANTISPAM] Erreur suppression messages: {e}")
 
+# ============================================
+# FILTRE DE CONTENU (AHO-CORASICK)
+# ============================================
+# Normalisation : minuscules, suppression des accents, repliement leetspeak
+_LEET_FOLD = {
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't',
+    '@': 'a', '$': 's', '!': 'i', '|': 'i', '€': 'e',
+}
+
+def normalize_for_filter(text):
+    """Retourne (texte normalisé, index d'origine de chaque caractère normalisé)"""
+    out = []
+    index_map = []
+    for i, ch in enumerate(text or ''):
+        folded = _LEET_FOLD.get(ch)
+        if folded is None:
+            folded = ''.join(c for c in unicodedata.normalize('NFKD', ch.lower())
+                             if not unicodedata.combining(c))
+        for c in folded:
+            out.append(c)
+            index_map.append(i)
+    return ''.join(out), index_map
+
+class ContentFilter:
+    """Automate Aho-Corasick : tous les termes interdits en une seule passe linéaire"""
+    
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self._terms = 0
+        self._built = True
+    
+    def add(self, term, category):
+        normalized, _ = normalize_for_filter(term.strip())
+        if not normalized:
+            return
+        node = 0
+        for ch in normalized:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((len(normalized), term, category))
+        self._terms += 1
+        self._built = False
+    
+    def build(self):
+        pending = deque(self._goto[0].values())
+        for child in pending:
+            self._fail[child] = 0
+        while pending:
+            node = pending.popleft()
+            for ch, child in self._goto[node].items():
+                pending.append(child)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+        self._built = True
+        return self
+    
+    def __len__(self):
+        return self._terms
+    
+    def find(self, text, whole_words=False):
+        """Liste des correspondances (début, fin, terme, catégorie) dans le texte d'origine"""
+        if not self._built:
+            self.build()
+        normalized, index_map = normalize_for_filter(text)
+        matches = []
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for pos, ch in enumerate(normalized):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, term, category in out[node]:
+                start, end = index_map[pos - length + 1], index_map[pos] + 1
+                # Limites de mot jugées sur le texte d'origine : « vulgaire! » reste un mot
+                # entier même si « ! » est replié en « i » pour la recherche
+                if whole_words and (
+                    (start > 0 and text[start - 1].isalnum()) or
+                    (end < len(text) and text[end].isalnum())
+                ):
+                    continue
+                matches.append((start, end, term, category))
+        return matches
+    
+    def first(self, text, whole_words=False):
+        found = self.find(text, whole_words=whole_words)
+        return found[0] if found else None
+    
+    def mask(self, text, matches):
+        chars = list(text)
+        for start, end, _, _ in matches:
+            for i in range(start, end):
+                if not chars[i].isspace():
+                    chars[i] = '*'
+        return ''.join(chars)
+
+def load_blocklist(path):
+    terms = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    terms.append(line)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[FILTER] Lecture de la liste de blocage impossible ({path}): {e}")
+    return terms
+
 # ============================================
 # SYSTÈME DE VALIDATION DES PSEUDONYMES
 # ============================================
 class NicknameValidator:
     OFFENSIVE_TERMS = ["inapproprié", "vulgaire", "insulte"] # Liste simplifiée pour l'exemple
     FORBIDDEN_EMOJIS = ["🍑", "🍆"]
-    MARTIN_VARIANTS_REGEX = r"(?i)m[a@4]rt[i1l]n"
+    # Variantes de "Martin" (ex-regex m[a@4]rt[i1l]n) : le leetspeak est replié
+    # par la normalisation, seule la variante "l" doit être listée explicitement
+    RESTRICTED_TERMS = ["martin", "martln"]
     
     @staticmethod
     def validate(username):
@@ -413,25 +570,23 @@ class NicknameValidator:
         if not username or len(username) < 3:
             return False, "Le pseudonyme doit contenir au moins 3 caractères."
         
-        # 1. Détection des emojis interdits
-        for emoji in NicknameValidator.FORBIDDEN_EMOJIS:
-            if emoji in username:
-                return False, f"L'emoji {emoji} est strictement interdit dans les pseudonymes."
-        
-        # 2. Détection de "Martin" et ses variantes (Regex)
-        if re.search(NicknameValidator.MARTIN_VARIANTS_REGEX, username):
-            return False, "Ce pseudonyme n'est pas autorisé par la politique de sécurité."
+        # 1-2-4. Emojis interdits, variantes de "Martin" et termes offensants : une seule passe
+        match = CONTENT_FILTER.first(username)
+        if match:
+            _, _, term, category = match
+            if category == 'emoji':
+                return False, f"L'emoji {term} est strictement interdit dans les pseudonymes."
+            if category == 'restricted':
+                return False, "Ce pseudonyme n'est pas autorisé par la politique de sécurité."
+            return False, "Le pseudonyme contient un terme inapproprié."
         
         # 3. Détection par similarité (Martin)
+        # Un ratio > 0.8 avec un mot de 6 lettres n'est possible que pour 5 à 8 lettres
         username_clean = re.sub(r'[^a-zA-Z]', '', username).lower()
-        similarity = difflib.SequenceMatcher(None, username_clean, "martin").ratio()
-        if similarity > 0.8:
-            return False, "Ce pseudonyme est trop similaire à un terme interdit."
-        
-        # 4. Détection de termes offensants
-        for term in NicknameValidator.OFFENSIVE_TERMS:
-            if term in username.lower():
-                return False, "Le pseudonyme contient un terme inapproprié."
+        if 5 <= len(username_clean) <= 8:
+            similarity = difflib.SequenceMatcher(None, username_clean, "martin").ratio()
+            if similarity > 0.8:
+                return False, "Ce pseudonyme est trop similaire à un terme interdit."
         
         return True, None
 
@@ -465,6 +620,30 @@ class NicknameValidator:
         
         return valid_suggestions[:4]
 
+def build_content_filter():
+    """Compile le filtre partagé (pseudonymes + messages)"""
+    cf = ContentFilter()
+    for emoji in NicknameValidator.FORBIDDEN_EMOJIS:
+        cf.add(emoji, 'emoji')
+    for term in NicknameValidator.RESTRICTED_TERMS:
+        cf.add(term, 'restricted')
+    for term in NicknameValidator.OFFENSIVE_TERMS + load_blocklist(CONTENT_FILTER_BLOCKLIST_PATH):
+        cf.add(term, 'offensive')
+    return cf.build()
+
+CONTENT_FILTER = ContentFilter() if POOL_WORKER else build_content_filter()
+
+def filter_message_content(content):
+    """Applique le filtre aux messages. Retourne (contenu, erreur)"""
+    if CONTENT_FILTER_MESSAGE_MODE == 'off' or not content:
+        return content, None
+    matches = [m for m in CONTENT_FILTER.find(content, whole_words=True) if m[3] == 'offensive']
+    if not matches:
+        return content, None
+    if CONTENT_FILTER_MESSAGE_MODE == 'mask':
+        return CONTENT_FILTER.mask(content, matches), None
+    return None, 'Message refusé : contenu inapproprié'
+
 # ============================================
 # INITIALISATION APPLICATION
 # ============================================
@@ -483,13 +662,6 @@ try:
 except Exception:
     pass
 
-# Démarrage conditionnel des services en arrière-plan (évite double lancement avec le reloader)
-if (os.environ.get('WERKZEUG_RUN_MAIN') == 'true') or (not DEBUG):
-    try:
-        start_smtp_once()
-    except Exception as e:
-        print(f"[INIT] SMTP non démarré: {e}")
-
 # ============================================
 # SYSTÈME D'INTERNATIONALISATION (i18n)
 # ============================================
@@ -557,66 +729,6 @@ def set_lang(lang):
         return resp
     return redirect(request.referrer or '/')
 
-# Migration automatique de la base de données pour les colonnes manquantes
-def migrate_database():
-    import sqlite3
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Table users
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'reset_token' not in columns:
-            cursor.execute('ALTER TABLE users ADD COLUMN reset_token TEXT')
-            print("[DB] Colonne reset_token ajoutée.")
-            
-        if 'reset_token_expires_at' not in columns:
-            cursor.execute('ALTER TABLE users ADD COLUMN reset_token_expires_at DATETIME')
-            print("[DB] Colonne reset_token_expires_at ajoutée.")
-        
-        if 'mute_until' not in columns:
-            cursor.execute('ALTER TABLE users ADD COLUMN mute_until DATETIME')
-            print("[DB] Colonne mute_until ajoutée.")
-
-        if 'theme' not in columns:
-            cursor.execute('ALTER TABLE users ADD COLUMN theme TEXT DEFAULT "dark"')
-            print("[DB] Colonne theme ajoutée.")
-            
-        if 'notif_sound' not in columns:
-            cursor.execute('ALTER TABLE users ADD COLUMN notif_sound BOOLEAN DEFAULT 1')
-            print("[DB] Colonne notif_sound ajoutée.")
-            
-        if 'animations_enabled' not in columns:
-            cursor.execute('ALTER TABLE users ADD COLUMN animations_enabled BOOLEAN DEFAULT 1')
-            print("[DB] Colonne animations_enabled ajoutée.")
-            
-        # Table email_messages
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS email_messages (
-                id TEXT PRIMARY KEY,
-                recipient TEXT NOT NULL,
-                subject TEXT NOT NULL,
-                body_html TEXT NOT NULL,
-                status TEXT DEFAULT 'pending' NOT NULL,
-                attempts INTEGER DEFAULT 0 NOT NULL,
-                max_retries INTEGER DEFAULT 3 NOT NULL,
-                last_attempt DATETIME,
-                error_log TEXT,
-                sent_at DATETIME,
-                is_opened BOOLEAN DEFAULT 0 NOT NULL,
-                opened_at DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL
-            )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_recipient ON email_messages(recipient)")
-        
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"[DB ERROR] Échec de la migration automatique : {e}")
-
 # ============================================
 # SYSTÈME DE FILE D'ATTENTE D'EMAILS
 # ============================================
@@ -639,7 +751,7 @@ def email_worker():
                         email_msg.attempts += 1
                         email_msg.last_attempt = datetime.now(timezone.utc)
                         session.commit()
-                        server_url = f"http://{SERVER_IP_ADDRESS}:5000/" if 'SERVER_IP_ADDRESS' in globals() and SERVER_IP_ADDRESS else "http://localhost:5000/"
+                        server_url = f"http://{get_server_ip() or 'localhost'}:5000/"
                         tracking_pixel = f'<img src="{server_url}api/mail/track/{email_msg.id}" width="1" height="1" style="display:none">'
                         success, error = PrivateMailer.send(
                             recipient=email_msg.recipient,
@@ -699,184 +811,188 @@ def send_async_email(app, msg):
     """Ancienne fonction conservée pour compatibilité mais utilisant maintenant la queue"""
     with app.app_context():
         queue_email(msg.recipients[0], msg.subject, msg.html)
-# Exécuter la migration au démarrage (Compatible Flask 3.x)
-def ensure_db_file_ok():
-    engine = db.engine
-    if engine.dialect.name != 'sqlite':
+# Vérification d'intégrité différée : quick_check (ou integrity_check complet)
+# sur une connexion dédiée, DB_INTEGRITY_CHECK_DELAY secondes après le démarrage
+_DB_INTEGRITY_STATE = {'mode': DB_INTEGRITY_CHECK, 'checked_at': None, 'ok': None,
+                       'errors': [], 'duration': None}
+
+def check_db_integrity():
+    """Lance le PRAGMA configuré ; met à jour _DB_INTEGRITY_STATE et retourne True si la base est saine"""
+    pragma = 'integrity_check' if DB_INTEGRITY_CHECK == 'full' else 'quick_check'
+    started = time.monotonic()
+    conn = sqlite3.connect(f"{Path(str(DB_PATH)).resolve().as_uri()}?mode=ro", uri=True,
+                           timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        rows = [row[0] for row in conn.execute(f"PRAGMA {pragma}(100)")]
+    finally:
+        conn.close()
+    ok = rows == ['ok']
+    _DB_INTEGRITY_STATE.update({
+        'checked_at': datetime.now(timezone.utc).isoformat(), 'ok': ok,
+        'errors': [] if ok else rows, 'duration': round(time.monotonic() - started, 2),
+    })
+    if ok:
+        print(f"[DB] {pragma} ok en {_DB_INTEGRITY_STATE['duration']}s")
+    else:
+        print(f"[DB INTEGRITY ERROR] {pragma} a signalé {len(rows)} problème(s): {rows[:5]}")
+    return ok
+
+def start_integrity_check():
+    """Vérification en arrière-plan (sans effet si DB_INTEGRITY_CHECK='off' ou hors SQLite)"""
+    if DB_INTEGRITY_CHECK == 'off' or db.engine.dialect.name != 'sqlite' or not Path(str(DB_PATH)).exists():
         return
-    db_path = Path(str(DB_PATH))
-    if not db_path.exists():
+    def worker():
+        time.sleep(max(0, DB_INTEGRITY_CHECK_DELAY))
+        lower_io_priority()
+        try:
+            check_db_integrity()
+        except Exception as e:
+            print(f"[DB INTEGRITY ERROR] {e}")
+    threading.Thread(target=worker, daemon=True).start()
+
+# Totaux de stockage tenus à jour en continu (voir TOTAUX DE STOCKAGE ET D'ENTITÉS)
+_STORAGE_TOTALS = {
+    'uploads_bytes': 0, 'data_bytes': 0,
+    'users': 0, 'channels': 0, 'messages': 0, 'files': 0,
+}
+_STORAGE_STATE = {'reconciled_at': None, 'running': False, 'last_duration': None, 'last_drift': {}}
+_STORAGE_LOCK = threading.Lock()
+_STORAGE_RECONCILER_STARTED = False
+
+def adjust_storage_total(key, delta):
+    if not delta:
         return
-    import sqlite3
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute('PRAGMA integrity_check;')
-    res = cur.fetchone()
-    conn.close()
-    if not res or (isinstance(res, tuple) and res[0] != 'ok') or (isinstance(res, str) and res != 'ok'):
-        raise Exception('integrity check failed')
-def verify_db_structure():
+    with _STORAGE_LOCK:
+        _STORAGE_TOTALS[key] = _STORAGE_TOTALS.get(key, 0) + delta
+
+def _storage_key(path):
     try:
-        from models import (
-            User,
-            Channel,
-            ChannelParticipant,
-            Message,
-            MessagePin,
-            MessageReaction,
-            FileAttachment,
-            BannedIP,
-            AuditLog,
-            Contributor,
-            MessageRead,
-            OnlinePresence,
-            EmailMessage,
-            GameSession,
-        )
-    except Exception:
-        User = Channel = ChannelParticipant = Message = MessagePin = None
-        MessageReaction = FileAttachment = BannedIP = AuditLog = None
-        Contributor = MessageRead = OnlinePresence = EmailMessage = GameSession = None
-    engine = db.engine
-    inspector = inspect(engine)
-    tables = set(inspector.get_table_names())
-    # Créer les tables manquantes de manière non destructive
-    for model in [
-        User,
-        Channel,
-        ChannelParticipant,
-        Message,
-        MessagePin,
-        MessageReaction,
-        FileAttachment,
-        BannedIP,
-        AuditLog,
-        Contributor,
-        MessageRead,
-        OnlinePresence,
-        EmailMessage,
-        GameSession,
-    ]:
-        if model is None:
-            continue
-        name = getattr(model, '__tablename__', None)
-        if not name or name in tables:
-            continue
-        model.__table__.create(bind=engine, checkfirst=True)
-        tables.add(name)
-    if engine.dialect.name == 'sqlite':
-        with engine.begin() as conn:
-            def ensure_sqlite_columns(table_name, columns_spec, create_index_stmt=None):
-                if table_name not in tables:
-                    return
-                existing_cols = {col['name'] for col in inspector.get_columns(table_name)}
-                for name, type_sql, default_sql in columns_spec:
-                    if name in existing_cols:
-                        continue
-                    ddl = f'ALTER TABLE {table_name} ADD COLUMN {name} {type_sql}'
-                    if default_sql is not None:
-                        ddl += f' DEFAULT {default_sql}'
-                    conn.execute(text(ddl))
-                    existing_cols.add(name)
-            ensure_sqlite_columns(
-                'users',
-                [
-                    ('reset_token', 'TEXT', None),
-                    ('reset_token_expires_at', 'DATETIME', None),
-                    ('mute_until', 'DATETIME', None),
-                    ('last_ip', 'TEXT', None),
-                    ('theme', 'TEXT', "'dark'"),
-                    ('notif_sound', 'BOOLEAN', '1'),
-                    ('animations_enabled', 'BOOLEAN', '1'),
-                    ('personal_panic_url', 'VARCHAR(500)', None),
-                    ('personal_panic_hotkey', 'VARCHAR(50)', None),
-                ]
-            )
-            ensure_sqlite_columns(
-                'email_messages',
-                [
-                    ('status', 'TEXT', "'pending'"),
-                    ('attempts', 'INTEGER', '0'),
-                    ('max_retries', 'INTEGER', '3'),
-                    ('last_attempt', 'DATETIME', None),
-                    ('error_log', 'TEXT', None),
-                    ('sent_at', 'DATETIME', None),
-                    ('is_opened', 'BOOLEAN', '0'),
-                    ('opened_at', 'DATETIME', None),
-                    ('created_at', 'DATETIME', None),
-                ]
-            )
-            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_email_recipient ON email_messages(recipient)"))
-            ensure_sqlite_columns(
-                'game_sessions',
-                [
-                    ('name', 'TEXT', "'Battleship'"),
-                    ('game_type', 'VARCHAR(50)', "'battleship'"),
-                    ('is_private', 'BOOLEAN', '0'),
-                    ('join_code', 'VARCHAR(20)', None),
-                    ('created_by_id', 'TEXT', None),
-                    ('max_players', 'INTEGER', '2'),
-                    ('players_json', 'TEXT', "'[]'"),
-                    ('state_json', 'TEXT', "'{}'"),
-                    ('current_turn_user_id', 'TEXT', None),
-                    ('code', 'VARCHAR(12)', None),
-                    ('status', 'TEXT', "'waiting'"),
-                    ('mode', 'TEXT', "'pvp'"),
-                    ('p1_id', 'TEXT', None),
-                    ('p2_id', 'TEXT', None),
-                    ('p1_ready', 'BOOLEAN', '0'),
-                    ('p2_ready', 'BOOLEAN', '0'),
-                    ('current_turn', 'TEXT', None),
-                    ('p1_board', 'TEXT', None),
-                    ('p2_board', 'TEXT', None),
-                    ('history', 'TEXT', None),
-                    ('spectators', 'TEXT', None),
-                    ('created_at', 'DATETIME', None),
-                    ('updated_at', 'DATETIME', None),
-                ]
-            )
+        Path(path).resolve().relative_to(Path(DATA_DIR).resolve())
+        return 'data_bytes'
+    except (ValueError, OSError):
+        return 'uploads_bytes'
 
-def backup_database():
+def track_file_added(path):
+    """Comptabilise un fichier qui vient d'être écrit"""
     try:
-        db_path = DB_PATH
-        if not db_path:
-            return
-        db_path = Path(str(db_path))
-        if not db_path.exists():
-            return
-        backup_dir = db_path.parent / "backups"
-        backup_dir.mkdir(parents=True, exist_ok=True)
-        ts = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-        backup_path = backup_dir / f"kronos_startup_{ts}.db"
-        shutil.copy2(str(db_path), str(backup_path))
-        backups = sorted(backup_dir.glob("kronos_startup_*.db"))
-        if len(backups) > 5:
-            for old in backups[:-5]:
-                try:
-                    old.unlink()
-                except Exception:
-                    pass
-    except Exception as e:
-        print(f"[DB BACKUP ERROR] {e}")
+        adjust_storage_total(_storage_key(path), os.path.getsize(path))
+    except OSError:
+        pass
 
-def restore_last_backup():
+def remove_tracked_file(path):
+    """Supprime un fichier et décompte sa taille ; False s'il n'existait pas"""
     try:
-        db_path = DB_PATH
-        if not db_path:
-            return False
-        db_path = Path(str(db_path))
-        backup_dir = db_path.parent / "backups"
-        if not backup_dir.exists():
-            return False
-        backups = sorted(backup_dir.glob("kronos_startup_*.db"))
-        if not backups:
-            return False
-        last = backups[-1]
-        shutil.copy2(str(last), str(db_path))
-        return True
+        size = os.path.getsize(path)
+        os.remove(path)
+    except OSError:
+        return False
+    adjust_storage_total(_storage_key(path), -size)
+    return True
+
+# ============================================
+# SAUVEGARDES EN LIGNE DE LA BASE
+# ============================================
+# Un thread copie la base vivante toutes les BACKUP_INTERVAL secondes sur sa
+# propre connexion sqlite3 (hors pool) : VACUUM INTO ou API de sauvegarde par
+# pas (voir backups.py). La copie est écrite en .partial, vérifiée par
+# quick_check, empreinte SHA-256 dans un fichier .sha256 voisin, puis renommée.
+# Rétention : BACKUP_RETENTION_DAYS, en gardant toujours BACKUP_MIN_KEEP copies.
+
+_BACKUP_STATE = {'running': False, 'last_backup': None, 'last_error': None, 'last_duration': None, 'count': 0}
+_BACKUP_LOCK = threading.Lock()
+_BACKUP_SCHEDULER_STARTED = False
+
+def prune_backups():
+    """Supprime les sauvegardes expirées et les copies interrompues"""
+    removed = 0
+    for path in backups.expired_backups(BACKUP_DIR, BACKUP_RETENTION_DAYS, BACKUP_MIN_KEEP):
+        if remove_tracked_file(path):
+            removed += 1
+        backups.checksum_path(path).unlink(missing_ok=True)
+    for path in backups.stale_partials(BACKUP_DIR):
+        path.unlink(missing_ok=True)
+    return removed
+
+def create_backup(reason='planifiée'):
+    """Sauvegarde complète et vérifiée ; None si une autre est en cours ou en cas d'échec"""
+    with _BACKUP_LOCK:
+        if _BACKUP_STATE['running']:
+            return None
+        _BACKUP_STATE['running'] = True
+    started = time.monotonic()
+    final_path = BACKUP_DIR / f"kronos_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.db"
+    partial_path = final_path.with_name(final_path.name + backups.PARTIAL_SUFFIX)
+    try:
+        if not Path(str(DB_PATH)).exists():
+            return None
+        if reason == 'planifiée':
+            lower_io_priority()
+        partial_path.unlink(missing_ok=True)
+        method = backups.copy_database(DB_PATH, partial_path, method=BACKUP_METHOD,
+                                       pages_per_step=BACKUP_PAGES_PER_STEP, step_sleep=BACKUP_STEP_SLEEP,
+                                       timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        backups.quick_check(partial_path)
+        checksum = backups.sha256_file(partial_path)
+        os.replace(partial_path, final_path)
+        backups.write_checksum(final_path, checksum)
+        track_file_added(final_path)
+        duration = round(time.monotonic() - started, 2)
+        info = {
+            'file': final_path.name, 'size': final_path.stat().st_size, 'sha256': checksum,
+            'method': method, 'reason': reason, 'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        _BACKUP_STATE.update({'last_backup': info, 'last_error': None, 'last_duration': duration,
+                              'count': _BACKUP_STATE['count'] + 1})
+        removed = prune_backups()
+        print(f"[BACKUP] {final_path.name} ({reason}, {method}, {info['size']} octets) en {duration}s"
+              + (f", {removed} ancienne(s) supprimée(s)" if removed else ""))
+        return info
     except Exception as e:
-        print(f"[DB RESTORE ERROR] {e}")
+        partial_path.unlink(missing_ok=True)
+        _BACKUP_STATE['last_error'] = str(e)
+        print(f"[BACKUP ERROR] {e}")
+        return None
+    finally:
+        _BACKUP_STATE['running'] = False
+
+def start_backup_run(reason='manuelle'):
+    """Lance une sauvegarde en arrière-plan"""
+    if _BACKUP_STATE['running']:
         return False
+    threading.Thread(target=create_backup, args=(reason,), daemon=True).start()
+    return True
+
+def start_backup_scheduler():
+    """Sauvegarde toutes les BACKUP_INTERVAL secondes (0 = désactivé)"""
+    global _BACKUP_SCHEDULER_STARTED
+    if _BACKUP_SCHEDULER_STARTED or BACKUP_INTERVAL <= 0:
+        return
+    _BACKUP_SCHEDULER_STARTED = True
+    def worker():
+        # Laisser le démarrage se terminer ; inutile de recopier si la dernière est récente
+        time.sleep(max(0, BACKUP_STARTUP_DELAY))
+        existing = backups.list_backups(BACKUP_DIR)
+        if existing:
+            age = time.time() - existing[-1].stat().st_mtime
+            if age < BACKUP_INTERVAL:
+                time.sleep(BACKUP_INTERVAL - age)
+        while True:
+            create_backup()
+            time.sleep(max(300, BACKUP_INTERVAL))
+    threading.Thread(target=worker, daemon=True).start()
+
+def list_backup_infos():
+    infos = []
+    for path in reversed(backups.list_backups(BACKUP_DIR)):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        infos.append({
+            'file': path.name, 'size': stat.st_size, 'sha256': backups.read_checksum(path),
+            'created_at': datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+        })
+    return infos
 
 # Vérification de la configuration SMTP au démarrage
 def check_smtp_config():
@@ -894,16 +1010,112 @@ def check_smtp_config():
     else:
         print(f"[MAIL] Configuration SMTP Privée détectée pour : {SMTP_USER}")
 
-check_smtp_config()
+if not POOL_WORKER:
+    check_smtp_config()
+
+def touch_static_files():
+    """Rafraîchit la date des fichiers statiques (invalide les caches navigateur après mise à jour)"""
+    now = time.time()
+    for root, dirs, files in os.walk(app.static_folder):
+        for f in files:
+            try:
+                os.utime(os.path.join(root, f), (now, now))
+            except OSError:
+                pass
 
-for root, dirs, files in os.walk(app.static_folder):
-    for f in files: os.utime(os.path.join(root, f), (time.time(), time.time()))
+def start_background_services():
+    """Services non indispensables au premier accept, lancés après le démarrage"""
+    threading.Thread(target=touch_static_files, daemon=True).start()
+    # Évite un double lancement avec le reloader
+    if (os.environ.get('WERKZEUG_RUN_MAIN') == 'true') or (not DEBUG):
+        try:
+            start_smtp_once()
+        except Exception as e:
+            print(f"[INIT] SMTP non démarré: {e}")
+    start_integrity_check()
+    if BLOB_DEDUP_MIGRATION_ENABLED:
+        start_blob_dedup_migration()
+    start_storage_reconciler()
+    resume_bulk_delete_jobs()
+    start_orphan_gc_scheduler()
+    start_wal_checkpointer()
+    start_backup_scheduler()
 
 # Extensions
 db.init_app(app)
 mail.init_app(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# ============================================
+# PROFIL SQLITE (PRAGMAS PAR CONNEXION + CHECKPOINT WAL)
+# ============================================
+# Chaque connexion ouverte par le pool reçoit SQLITE_PRAGMAS (WAL, synchronous,
+# cache, mmap, busy_timeout...). En WAL, un thread fait régulièrement un
+# checkpoint PASSIVE (TRUNCATE si le journal dépasse SQLITE_WAL_TRUNCATE_BYTES)
+# pour que le fichier -wal ne grossisse pas indéfiniment.
+
+_SQLITE_CHECKPOINT_STATE = {'last_run': None, 'mode': None, 'busy': None, 'log_frames': None,
+                            'checkpointed': None, 'wal_bytes': 0, 'errors': 0}
+_SQLITE_CHECKPOINT_STARTED = False
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_profile(dbapi_connection, connection_record):
+    """Applique SQLITE_PRAGMAS à chaque nouvelle connexion SQLite"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def checkpoint_wal(mode=None):
+    """Checkpoint du WAL ; PASSIVE par défaut, TRUNCATE si le journal est trop gros"""
+    try:
+        wal_bytes = os.path.getsize(f"{DB_PATH}-wal")
+    except OSError:
+        wal_bytes = 0
+    mode = mode or ('TRUNCATE' if wal_bytes > SQLITE_WAL_TRUNCATE_BYTES else 'PASSIVE')
+    with db.engine.connect() as conn:
+        busy, log_frames, checkpointed = conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})").first()
+    _SQLITE_CHECKPOINT_STATE.update({
+        'last_run': datetime.now(timezone.utc).isoformat(), 'mode': mode, 'busy': busy,
+        'log_frames': log_frames, 'checkpointed': checkpointed, 'wal_bytes': wal_bytes,
+    })
+    return busy, log_frames, checkpointed
+
+def start_wal_checkpointer():
+    """Checkpoint toutes les SQLITE_CHECKPOINT_INTERVAL secondes (WAL uniquement)"""
+    global _SQLITE_CHECKPOINT_STARTED
+    if _SQLITE_CHECKPOINT_STARTED or SQLITE_JOURNAL_MODE != 'WAL' or db.engine.dialect.name != 'sqlite':
+        return
+    _SQLITE_CHECKPOINT_STARTED = True
+    def worker():
+        while True:
+            time.sleep(max(10, SQLITE_CHECKPOINT_INTERVAL))
+            try:
+                with app.app_context():
+                    checkpoint_wal()
+            except Exception as e:
+                _SQLITE_CHECKPOINT_STATE['errors'] += 1
+                print(f"[SQLITE] Checkpoint impossible: {e}")
+    threading.Thread(target=worker, daemon=True).start()
+
+def get_sqlite_profile_status():
+    """Pragmas effectivement actifs sur une connexion du pool + état du checkpoint"""
+    if db.engine.dialect.name != 'sqlite':
+        return None
+    status = {}
+    with db.engine.connect() as conn:
+        for name, _ in SQLITE_PRAGMAS:
+            row = conn.exec_driver_sql(f"PRAGMA {name}").first()
+            status[name] = row[0] if row else None
+    status['checkpoint'] = dict(_SQLITE_CHECKPOINT_STATE)
+    status['integrity'] = dict(_DB_INTEGRITY_STATE)
+    return status
+
+
 # Login Manager
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -916,15 +1128,11 @@ def unauthorized():
 
 # Importer les modèles APRÈS l'initialisation de db
 from models import *
+from migrations import apply_migrations, latest_version, pending_migrations
 
 # Autoriser le skip de la vérification DB via variable d'environnement (utile pour tests)
-if not os.environ.get('KRONOS_SKIP_DB_VERIFY'):
+if not os.environ.get('KRONOS_SKIP_DB_VERIFY') and not POOL_WORKER:
     with app.app_context():
-        try:
-            backup_database()
-        except Exception as e:
-            print(f"[DB BACKUP ERROR] {e}")
-        ensure_db_file_ok()
         engine = db.engine
         try:
             db_path = None
@@ -933,21 +1141,98 @@ if not os.environ.get('KRONOS_SKIP_DB_VERIFY'):
                 db_path = Path(str(DB_PATH))
             if is_sqlite and (not db_path or not db_path.exists()):
                 raise RuntimeError(f"Base SQLite introuvable à {DB_PATH}. Restaure ou copie ton fichier existant, aucune recréation automatique n'est faite.")
-            # Réparation non destructive systématique :
-            # - création des tables manquantes
-            # - ajout des colonnes manquantes
-            verify_db_structure()
-            print("Vérification DB non destructive OK (tables manquantes / colonnes ajoutées).")
+            # Migrations versionnées : simple lecture de version si la base est à jour
+            with boot_stage('schéma'):
+                pending = pending_migrations(engine)
+            applied = []
+            if pending:
+                # Seule sauvegarde synchrone : juste avant de modifier le schéma
+                if is_sqlite:
+                    with boot_stage('sauvegarde pré-migration'):
+                        create_backup('avant migration')
+                with boot_stage('migrations'):
+                    applied = apply_migrations(engine)
+            print(f"[DB] Schéma version {latest_version()}"
+                  + (f" (migrations appliquées: {', '.join(map(str, applied))})" if applied else " (à jour)"))
         except Exception as e:
-            print(f"[DB VERIFY ERROR] {e}")
-            restored = restore_last_backup()
-            if restored:
-                print("[DB] Base restaurée automatiquement depuis le dernier backup de démarrage.")
+            # Chaque migration est transactionnelle : la base reste à la dernière version appliquée
+            print(f"[DB MIGRATION ERROR] {e}")
             raise
 
 socketio = SocketIO(app, async_mode=SOCKETIO_ASYNC_MODE, cors_allowed_origins="*", ping_timeout=10, ping_interval=5)
 
-if EMAIL_QUEUE_ENABLED:
+# ============================================
+# LIMITEUR DE DÉBIT SOCKET.IO (SEAU À JETONS)
+# ============================================
+# Chaque handler @socketio.on est enveloppé automatiquement : un seau par
+# (utilisateur, événement), rechargé à débit constant. La clé utilisateur est
+# lue dans la session (pas de requête DB) ; à défaut on utilise le SID.
+_SOCKET_RATE_EXEMPT = {'connect', 'disconnect'}
+_SOCKET_RATE_BUCKETS = {}
+_SOCKET_RATE_LOCK = threading.Lock()
+_SOCKET_RATE_DROPPED = {}
+_SOCKET_RATE_MAX_BUCKETS = 50000
+
+def _socket_rate_allow(event):
+    rate, burst = SOCKET_RATE_LIMITS.get(event, SOCKET_RATE_LIMIT_DEFAULT)
+    key = (session.get('_user_id') or request.sid, event)
+    now = time.monotonic()
+    with _SOCKET_RATE_LOCK:
+        bucket = _SOCKET_RATE_BUCKETS.get(key)
+        if bucket is None:
+            if len(_SOCKET_RATE_BUCKETS) >= _SOCKET_RATE_MAX_BUCKETS:
+                _prune_socket_rate_buckets(now)
+            bucket = [float(burst), now]
+            _SOCKET_RATE_BUCKETS[key] = bucket
+        tokens = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1.0:
+            bucket[0] = tokens
+            _SOCKET_RATE_DROPPED[event] = _SOCKET_RATE_DROPPED.get(event, 0) + 1
+            return False
+        bucket[0] = tokens - 1.0
+        return True
+
+def _prune_socket_rate_buckets(now, idle_seconds=600):
+    stale = [k for k, b in _SOCKET_RATE_BUCKETS.items() if now - b[1] > idle_seconds]
+    for k in stale:
+        _SOCKET_RATE_BUCKETS.pop(k, None)
+
+def socket_rate_limited(event):
+    """Décorateur appliquant le seau à jetons de l'événement donné"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            if not _socket_rate_allow(event):
+                return {'status': 'error', 'message': 'rate_limited', 'event': event}
+            return handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_socket_rate_stats():
+    return {
+        'enabled': SOCKET_RATE_LIMIT_ENABLED,
+        'default': list(SOCKET_RATE_LIMIT_DEFAULT),
+        'limits': {k: list(v) for k, v in SOCKET_RATE_LIMITS.items()},
+        'dropped': dict(_SOCKET_RATE_DROPPED),
+        'dropped_total': sum(_SOCKET_RATE_DROPPED.values()),
+        'active_buckets': len(_SOCKET_RATE_BUCKETS),
+    }
+
+if SOCKET_RATE_LIMIT_ENABLED:
+    _socketio_on = socketio.on
+    def _rate_limited_on(event, namespace=None):
+        register = _socketio_on(event, namespace)
+        def decorator(handler):
+            if event in _SOCKET_RATE_EXEMPT:
+                return register(handler)
+            register(socket_rate_limited(event)(handler))
+            # On retourne le handler d'origine : les appels directs (alias) ne sont pas recomptés
+            return handler
+        return decorator
+    socketio.on = _rate_limited_on
+
+if EMAIL_QUEUE_ENABLED and not POOL_WORKER:
     email_thread = threading.Thread(target=email_worker, daemon=True)
     email_thread.start()
 
@@ -978,12 +1263,13 @@ def is_ip_banned(ip):
 def is_supreme_admin(user=None, ip=None):
     """
     Détermine si l'utilisateur est Admin Suprême
-    L'IP qui lance le serveur ou ADMIN_SUPREME_IP devient Admin Suprême
+    L'IP qui lance le serveur ou KRONOS_ADMIN_IP devient Admin Suprême
     """
     target_ip = ip or get_client_ip()
     
     # Vérifier si l'IP est celle de l'admin supreme
-    if ADMIN_SUPREME_IP and target_ip == ADMIN_SUPREME_IP:
+    admin_supreme_ip = get_admin_supreme_ip()
+    if admin_supreme_ip and target_ip == admin_supreme_ip:
         return True
     
     # Si lancé en local (127.0.0.1 ou localhost)
@@ -1046,18 +1332,152 @@ def get_file_type(filename):
     else:
         return 'file'
 
+# ============================================
+# JOURNAL D'AUDIT ASYNCHRONE (ÉCRITURE PAR LOTS)
+# ============================================
+# Les entrées sont poussées dans une file bornée puis insérées par lots
+# par un thread dédié : les requêtes ne paient plus de commit supplémentaire.
+_AUDIT_QUEUE = queue.Queue(maxsize=AUDIT_QUEUE_MAXSIZE)
+_AUDIT_WRITE_LOCK = threading.Lock()
+_AUDIT_WORKER_STARTED = False
+_AUDIT_PENDING = threading.Event()
+_AUDIT_STOP = threading.Event()
+_AUDIT_METRICS = {
+    'enqueued': 0,
+    'written': 0,
+    'dropped': 0,
+    'late': 0,
+    'failed': 0,
+    'max_latency': 0.0,
+}
+
+_AUDIT_METRICS_LOCK = threading.Lock()
+
+def _audit_metric(key, delta=1):
+    # Compteurs partagés entre les requêtes et le worker : += n'est pas atomique
+    with _AUDIT_METRICS_LOCK:
+        _AUDIT_METRICS[key] += delta
+
+def _insert_audit_rows(rows):
+    with db.engine.begin() as conn:
+        conn.execute(AuditLog.__table__.insert(), rows)
+
+def _write_audit_batch(batch):
+    """Insère un lot d'entrées d'audit en une seule transaction.
+
+    Si une ligne viole une contrainte (acteur supprimé entre-temps...), le lot
+    est rejoué ligne par ligne pour n'écarter que les entrées fautives.
+    """
+    if not batch:
+        return
+    try:
+        _insert_audit_rows([row for row, _ in batch])
+        written = batch
+    except IntegrityError:
+        written = []
+        for row, enqueued_at in batch:
+            try:
+                _insert_audit_rows([row])
+                written.append((row, enqueued_at))
+            except Exception as e:
+                print(f"[AUDIT] Entrée ignorée ({row.get('action_type')}): {e}")
+        _audit_metric('failed', len(batch) - len(written))
+    except Exception as e:
+        _audit_metric('failed', len(batch))
+        print(f"[AUDIT] Échec d'écriture d'un lot de {len(batch)} entrées: {e}")
+        return
+    now = time.monotonic()
+    with _AUDIT_METRICS_LOCK:
+        _AUDIT_METRICS['written'] += len(written)
+        for _, enqueued_at in written:
+            latency = now - enqueued_at
+            if latency > AUDIT_LATE_SECONDS:
+                _AUDIT_METRICS['late'] += 1
+            if latency > _AUDIT_METRICS['max_latency']:
+                _AUDIT_METRICS['max_latency'] = latency
+
+def _drain_audit_queue(max_items):
+    batch = []
+    while len(batch) < max_items:
+        try:
+            batch.append(_AUDIT_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def _write_pending_audit():
+    """Vide la file par lots ; l'appelant tient _AUDIT_WRITE_LOCK du retrait à l'écriture"""
+    while True:
+        batch = _drain_audit_queue(AUDIT_BATCH_SIZE)
+        if not batch:
+            return
+        _write_audit_batch(batch)
+
+def flush_audit_log():
+    """Arrête le worker puis vide intégralement la file d'audit (appelé à l'arrêt du serveur)"""
+    _AUDIT_STOP.set()
+    _AUDIT_PENDING.set()
+    # Le worker retire et écrit sous le verrou : l'attendre suffit à ne perdre aucun lot
+    with _AUDIT_WRITE_LOCK:
+        with app.app_context():
+            _write_pending_audit()
+
+def _start_audit_worker():
+    global _AUDIT_WORKER_STARTED
+    if _AUDIT_WORKER_STARTED:
+        return
+    _AUDIT_WORKER_STARTED = True
+    def worker():
+        while not _AUDIT_STOP.is_set():
+            try:
+                _AUDIT_PENDING.wait(AUDIT_FLUSH_INTERVAL)
+                with _AUDIT_WRITE_LOCK:
+                    if _AUDIT_STOP.is_set():
+                        return
+                    _AUDIT_PENDING.clear()
+                    with app.app_context():
+                        _write_pending_audit()
+            except Exception as e:
+                print(f"[AUDIT] Worker error: {e}")
+                time.sleep(0.5)
+    threading.Thread(target=worker, daemon=True).start()
+
+atexit.register(flush_audit_log)
+
+def get_audit_metrics():
+    with _AUDIT_METRICS_LOCK:
+        metrics = dict(_AUDIT_METRICS)
+    metrics['pending'] = _AUDIT_QUEUE.qsize()
+    metrics['capacity'] = AUDIT_QUEUE_MAXSIZE
+    metrics['max_latency'] = round(metrics['max_latency'], 3)
+    return metrics
+
 def log_action(actor, action_type, target_id=None, target_type=None, details=None):
-    """Enregistre une action dans le journal d'audit"""
-    log = AuditLog(
-        actor_id=actor.id if actor else None,
-        action_type=action_type,
-        target_id=target_id,
-        target_type=target_type,
-        details=details,
-        ip_address=get_client_ip()
-    )
-    db.session.add(log)
-    db.session.commit()
+    """Enregistre une action dans le journal d'audit (écriture différée par lots)"""
+    try:
+        ip_address = get_client_ip()
+    except RuntimeError:
+        ip_address = None
+    row = {
+        'id': str(uuid.uuid4()),
+        'actor_id': actor.id if actor else None,
+        'action_type': action_type,
+        'target_id': target_id,
+        'target_type': target_type,
+        'details': details,
+        'ip_address': ip_address,
+        'created_at': get_current_utc_time(),
+    }
+    _start_audit_worker()
+    if _AUDIT_ACTION_TYPES is not None:
+        _AUDIT_ACTION_TYPES.add(action_type)
+    try:
+        _AUDIT_QUEUE.put_nowait((row, time.monotonic()))
+        _AUDIT_PENDING.set()
+        _audit_metric('enqueued')
+    except queue.Full:
+        _audit_metric('dropped')
+        print(f"[AUDIT] File pleine, entrée ignorée: {action_type}")
 
 def update_all_usernames(old_username, new_username):
     """Met à jour le pseudo dans tous les messages (approche avec display_name dynamique)"""
@@ -1320,13 +1740,25 @@ def update_profile():
     if 'bio' in data:
         current_user.bio = data['bio']
     
-    if 'banner_filename' in data:
-        current_user.banner_filename = data['banner_filename']
-    
-    if 'avatar_filename' in data:
-        current_user.avatar_filename = data['avatar_filename']
+    # Seuls les fichiers envoyés par l'utilisateur via /api/upload/avatar sont acceptés
+    if 'banner_filename' in data and data['banner_filename'] != current_user.banner_filename:
+        banner = data['banner_filename'] or None
+        if banner and not own_profile_image(BANNERS_DIR, banner):
+            return jsonify({'error': 'Bannière invalide'}), 400
+        current_user.banner_filename = banner
+    
+    avatar_changed = False
+    if 'avatar_filename' in data and data['avatar_filename'] != current_user.avatar_filename:
+        avatar = data['avatar_filename'] or None
+        if avatar and not own_profile_image(AVATARS_DIR, avatar):
+            return jsonify({'error': 'Avatar invalide'}), 400
+        current_user.avatar_filename = avatar
+        current_user.avatar_variants = None
+        avatar_changed = True
     
     db.session.commit()
+    if avatar_changed and current_user.avatar_filename:
+        schedule_avatar_variants(current_user.id, current_user.avatar_filename)
     
     return jsonify({'message': 'Profil mis à jour', 'user': current_user.to_dict(include_sensitive=True)})
 
@@ -1422,6 +1854,7 @@ def upload_profile_image(user=None):
         app.logger.warning(f"upload_profile_image: file too large ({size} bytes)")
         return jsonify({'error': 'Fichier trop volumineux (max 8MB)'}), 400
     
+    adjust_storage_total(_storage_key(file_path), size)
     app.logger.info(f"upload_profile_image: success filename={filename}, size={size}")
     return jsonify({'filename': filename})
 
@@ -1605,7 +2038,10 @@ def edit_message(message_id):
         return jsonify({'error': 'Permission refusée'}), 403
     
     data = request.get_json()
-    message.content = data.get('content', message.content)
+    content, filter_error = filter_message_content(data.get('content', message.content))
+    if filter_error:
+        return jsonify({'error': filter_error}), 400
+    message.content = content
     message.is_edited = True
     message.edited_at = datetime.now(timezone.utc)
     
@@ -1639,6 +2075,7 @@ def delete_message(message_id):
     channel_id = message.channel_id
     message.is_deleted = True
     message.content = ""
+    rewind_dm_activity(channel_id, [message.id])
     
     db.session.commit()
     
@@ -1749,6 +2186,99 @@ def list_pins(channel_id):
         })
     return jsonify({'pins': result})
 
+# ============================================
+# COMPTEURS DE NON-LUS ET MENTIONS
+# ============================================
+# Chaque salon porte un compteur monotone (message_seq) et chaque utilisateur
+# un curseur de lecture par salon : non-lus = message_seq - read_seq.
+# Aucune lecture de la table messages n'est nécessaire.
+
+def next_channel_seq(channel_id):
+    """Incrémente et retourne le numéro de message du salon (dans la transaction courante)"""
+    db.session.execute(
+        db.update(Channel).where(Channel.id == channel_id)
+        .values(message_seq=Channel.message_seq + 1)
+    )
+    return db.session.execute(
+        db.select(Channel.message_seq).where(Channel.id == channel_id)
+    ).scalar() or 0
+
+def advance_read_cursor(user_id, channel_id, seq=None):
+    """Avance le curseur de lecture (jamais en arrière) ; seq=None = tout le salon"""
+    channel_seq = db.session.execute(
+        db.select(Channel.message_seq).where(Channel.id == channel_id)
+    ).scalar()
+    if channel_seq is None:
+        return
+    target = channel_seq if seq is None else min(seq, channel_seq)
+    db.session.execute(text("""
+        INSERT INTO channel_read_states (id, user_id, channel_id, read_seq, mention_count, updated_at)
+        VALUES (:id, :user_id, :channel_id, :seq, 0, :now)
+        ON CONFLICT(user_id, channel_id) DO UPDATE SET
+            read_seq = MAX(read_seq, excluded.read_seq),
+            mention_count = CASE WHEN excluded.read_seq >= :channel_seq THEN 0 ELSE mention_count END,
+            updated_at = excluded.updated_at
+    """), {
+        'id': str(uuid.uuid4()), 'user_id': user_id, 'channel_id': channel_id,
+        'seq': target, 'channel_seq': channel_seq, 'now': get_current_utc_time(),
+    })
+    db.session.commit()
+
+def increment_mentions(channel_id, user_ids):
+    """Ajoute une mention non lue pour chaque utilisateur mentionné"""
+    if not user_ids:
+        return
+    now = get_current_utc_time()
+    db.session.execute(text("""
+        INSERT INTO channel_read_states (id, user_id, channel_id, read_seq, mention_count, updated_at)
+        VALUES (:id, :user_id, :channel_id, 0, 1, :now)
+        ON CONFLICT(user_id, channel_id) DO UPDATE SET
+            mention_count = mention_count + 1,
+            updated_at = excluded.updated_at
+    """), [
+        {'id': str(uuid.uuid4()), 'user_id': uid, 'channel_id': channel_id, 'now': now}
+        for uid in set(user_ids)
+    ])
+    db.session.commit()
+
+@app.route('/api/unread', methods=['GET'])
+@login_required
+def get_unread_counts():
+    """Non-lus et mentions de tous les salons visibles, en une requête"""
+    rows = db.session.execute(text("""
+        SELECT c.id, c.channel_type, c.message_seq,
+               COALESCE(s.read_seq, 0), COALESCE(s.mention_count, 0)
+        FROM channels c
+        LEFT JOIN channel_read_states s ON s.channel_id = c.id AND s.user_id = :user_id
+        WHERE c.channel_type != :dm
+           OR c.id IN (SELECT channel_id FROM dm_conversations WHERE user_id = :user_id)
+    """), {'user_id': current_user.id, 'dm': ChannelType.DM}).fetchall()
+    counts = {}
+    for channel_id, channel_type, message_seq, read_seq, mentions in rows:
+        counts[channel_id] = {
+            'unread': max(0, (message_seq or 0) - read_seq),
+            'mentions': mentions,
+            'is_dm': channel_type == ChannelType.DM,
+        }
+    return jsonify({'channels': counts})
+
+@app.route('/api/channels/<channel_id>/read', methods=['POST'])
+@login_required
+def mark_channel_read(channel_id):
+    """Avance le curseur de lecture jusqu'au message indiqué (ou jusqu'au dernier)"""
+    data = request.get_json(silent=True) or {}
+    seq = None
+    if data.get('message_id'):
+        message = db.session.get(Message, data['message_id'])
+        if not message or message.channel_id != channel_id:
+            return jsonify({'error': 'Message introuvable'}), 404
+        if message.seq is None:
+            # Message antérieur aux compteurs : rien à avancer
+            return jsonify({'success': True})
+        seq = message.seq
+    advance_read_cursor(current_user.id, channel_id, seq)
+    return jsonify({'success': True})
+
 # ============================================
 # MESSAGES PRIVÉS (DM)
 # ============================================
@@ -1757,46 +2287,67 @@ def list_pins(channel_id):
 # MESSAGERIE PRIVÉE COMPLÈTE
 # ============================================
 
+DM_PAGE_SIZE = 50
+
 @app.route('/api/dm/conversations', methods=['GET'])
 @login_required
 def list_dm_conversations():
-    target_page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 50))
-    participant_channels = (
-        db.session.query(ChannelParticipant.channel_id)
-        .filter_by(user_id=current_user.id)
-        .subquery()
+    """Conversations privées triées par activité, pagination par curseur.
+
+    Une seule requête sur le résumé matérialisé (index user_id, last_activity_at).
+    """
+    try:
+        per_page = max(1, min(int(request.args.get('per_page', DM_PAGE_SIZE)), 200))
+    except (TypeError, ValueError):
+        per_page = DM_PAGE_SIZE
+    Peer = aliased(User)
+    LastMessage = aliased(Message)
+    query = (
+        db.session.query(DMConversation, Channel, Peer, LastMessage, ChannelReadState)
+        .join(Channel, Channel.id == DMConversation.channel_id)
+        .outerjoin(Peer, Peer.id == DMConversation.peer_id)
+        .outerjoin(LastMessage, LastMessage.id == DMConversation.last_message_id)
+        .outerjoin(ChannelReadState, db.and_(
+            ChannelReadState.channel_id == DMConversation.channel_id,
+            ChannelReadState.user_id == DMConversation.user_id
+        ))
+        .filter(DMConversation.user_id == current_user.id)
     )
-    dm_channels = (
-        db.session.query(Channel)
-        .filter(Channel.id.in_(db.select(participant_channels)), Channel.channel_type == ChannelType.DM)
+    cursor = _decode_keyset_cursor(request.args.get('cursor', ''))
+    if cursor:
+        activity_at, channel_id = cursor
+        query = query.filter(db.or_(
+            DMConversation.last_activity_at < activity_at,
+            db.and_(DMConversation.last_activity_at == activity_at, DMConversation.channel_id < channel_id)
+        ))
+    rows = (
+        query.order_by(DMConversation.last_activity_at.desc(), DMConversation.channel_id.desc())
+        .limit(per_page + 1)
         .all()
     )
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
     conversations = []
-    for ch in dm_channels:
-        last_msg = Message.query.filter_by(channel_id=ch.id, is_deleted=False).order_by(Message.created_at.desc()).first()
-        other_participant = ChannelParticipant.query.filter(
-            ChannelParticipant.channel_id == ch.id,
-            ChannelParticipant.user_id != current_user.id
-        ).first()
-        other_user = db.session.get(User, other_participant.user_id) if other_participant else None
+    for conv, ch, peer, last_msg, read_state in rows:
+        visible = last_msg if last_msg and not last_msg.is_deleted else None
+        read_seq = read_state.read_seq if read_state else 0
         conversations.append({
             'channel': ch.to_dict(),
-            'other_user': other_user.to_dict(include_sensitive=False) if other_user else None,
-            'last_message': last_msg.to_dict() if last_msg else None,
-            'last_activity_at': last_msg.created_at.isoformat() if last_msg else (ch.created_at.isoformat() if ch.created_at else None),
-            'unread_count': 0
+            'other_user': peer.to_dict(include_sensitive=False) if peer else None,
+            'last_message': visible.to_dict() if visible else None,
+            'last_activity_at': conv.last_activity_at.isoformat() if conv.last_activity_at else None,
+            'unread_count': max(0, (ch.message_seq or 0) - read_seq),
+            'mention_count': read_state.mention_count if read_state else 0
         })
-    conversations.sort(key=lambda c: c['last_activity_at'] or '', reverse=True)
-    start = (target_page - 1) * per_page
-    end = start + per_page
-    paged = conversations[start:end]
+    next_cursor = None
+    if has_more and rows:
+        last_conv = rows[-1][0]
+        next_cursor = _encode_keyset_cursor(last_conv.last_activity_at, last_conv.channel_id)
     return jsonify({
-        'conversations': paged,
-        'total': len(conversations),
-        'page': target_page,
+        'conversations': conversations,
         'per_page': per_page,
-        'has_more': end < len(conversations)
+        'next_cursor': next_cursor,
+        'has_more': has_more
     })
 
 @app.route('/api/dm/start', methods=['POST'])
@@ -1835,15 +2386,21 @@ def dm_leave():
     part = ChannelParticipant.query.filter_by(channel_id=channel_id, user_id=current_user.id).first()
     if part:
         db.session.delete(part)
-        db.session.commit()
+    # Une conversation quittée n'est plus réutilisée : la clé canonique est libérée
+    channel.dm_key = None
+    DMConversation.query.filter_by(channel_id=channel_id, user_id=current_user.id).delete(synchronize_session=False)
+    db.session.commit()
+    invalidate_dm_participants(channel_id=channel_id)
     system_msg = Message(
         channel_id=channel_id,
         user_id=current_user.id,
         content=f"{current_user.display_name or current_user.username} a quitté la conversation",
         message_type=MessageType.SYSTEM
     )
+    system_msg.seq = next_channel_seq(channel_id)
     db.session.add(system_msg)
     db.session.commit()
+    record_dm_activity(channel_id, system_msg)
     # CORRECTION : Utiliser str() pour la room
     socketio.emit('new_message', system_msg.to_dict(), room=str(channel_id))
     other_part = ChannelParticipant.query.filter(ChannelParticipant.channel_id == channel_id, ChannelParticipant.user_id != current_user.id).first()
@@ -1857,36 +2414,865 @@ def dm_leave():
     return jsonify({'message': 'Conversation quittée'})
 
 def _find_dm_channel(user_a_id, user_b_id):
-    subq = ChannelParticipant.query.filter(ChannelParticipant.user_id.in_([user_a_id, user_b_id]))\
-        .with_entities(ChannelParticipant.channel_id).subquery()
-    candidates = (
-        db.session.query(Channel)
-        .filter(Channel.id.in_(db.select(subq)), Channel.channel_type == ChannelType.DM)
+    """Recherche du DM par clé canonique (une seule sonde d'index unique)"""
+    return Channel.query.filter_by(dm_key=dm_pair_key(user_a_id, user_b_id)).first()
+
+def get_or_create_dm_channel(user, target_user):
+    """Retourne (salon DM, créé) ; création sans course grâce à l'index unique dm_key"""
+    existing = _find_dm_channel(user.id, target_user.id)
+    if existing:
+        return existing, False
+    dm_channel = Channel(
+        name=f"DM-{user.username}-{target_user.username}",
+        description=None,
+        channel_type=ChannelType.DM,
+        category="Privé",
+        dm_key=dm_pair_key(user.id, target_user.id)
+    )
+    db.session.add(dm_channel)
+    try:
+        db.session.flush()
+        db.session.add(ChannelParticipant(channel_id=dm_channel.id, user_id=user.id))
+        db.session.add(ChannelParticipant(channel_id=dm_channel.id, user_id=target_user.id))
+        now = get_current_utc_time()
+        db.session.add(DMConversation(user_id=user.id, channel_id=dm_channel.id,
+                                      peer_id=target_user.id, last_activity_at=now))
+        db.session.add(DMConversation(user_id=target_user.id, channel_id=dm_channel.id,
+                                      peer_id=user.id, last_activity_at=now))
+        db.session.commit()
+    except IntegrityError:
+        # Une autre requête a créé la conversation entre-temps : on la réutilise
+        db.session.rollback()
+        return _find_dm_channel(user.id, target_user.id), False
+    return dm_channel, True
+
+# Cache mémoire salon DM -> participants avec profils publics précalculés.
+# Invalidé sur dm_leave et quand un champ de profil mis en cache change (profil, rôle, sanctions).
+DM_PARTICIPANTS_CACHE_MAX = 5000
+_DM_PARTICIPANTS_CACHE = {}
+_DM_USER_CHANNELS = {}
+_DM_PARTICIPANTS_LOCK = threading.Lock()
+# Incrémenté à chaque invalidation : une entrée construite avant n'est pas stockée
+_DM_PARTICIPANTS_GENERATION = 0
+# Champs lus par User.to_dict(include_sensitive=False) ; last_seen et les pings de
+# présence, mis à jour en continu, n'invalident pas le cache
+_DM_PROFILE_FIELDS = ('username', 'display_name', 'avatar_filename', 'avatar_variants', 'banner_filename',
+                      'bio', 'role', 'is_active', 'is_shadowbanned', 'banned_at', 'mute_until')
+
+def get_dm_participants(channel):
+    """Retourne {'channel': dict, 'profiles': {user_id: profil public}} (une requête au premier appel)"""
+    with _DM_PARTICIPANTS_LOCK:
+        entry = _DM_PARTICIPANTS_CACHE.get(channel.id)
+        generation = _DM_PARTICIPANTS_GENERATION
+    if entry is not None:
+        return entry
+    users = (
+        db.session.query(User)
+        .join(ChannelParticipant, ChannelParticipant.user_id == User.id)
+        .filter(ChannelParticipant.channel_id == channel.id)
         .all()
     )
-    for ch in candidates:
-        users = set(p.user_id for p in ChannelParticipant.query.filter_by(channel_id=ch.id).all())
-        if users == {user_a_id, user_b_id}:
-            return ch
+    entry = {
+        'channel': channel.to_dict(),
+        'profiles': {u.id: u.to_dict(include_sensitive=False) for u in users},
+    }
+    with _DM_PARTICIPANTS_LOCK:
+        if generation != _DM_PARTICIPANTS_GENERATION:
+            # Invalidation pendant la construction : profils peut-être périmés
+            return entry
+        while len(_DM_PARTICIPANTS_CACHE) >= DM_PARTICIPANTS_CACHE_MAX:
+            old_id = next(iter(_DM_PARTICIPANTS_CACHE))
+            _drop_dm_participants_locked(old_id)
+        _DM_PARTICIPANTS_CACHE[channel.id] = entry
+        for user_id in entry['profiles']:
+            _DM_USER_CHANNELS.setdefault(user_id, set()).add(channel.id)
+    return entry
+
+def _drop_dm_participants_locked(channel_id):
+    entry = _DM_PARTICIPANTS_CACHE.pop(channel_id, None)
+    if not entry:
+        return
+    for user_id in entry['profiles']:
+        channels = _DM_USER_CHANNELS.get(user_id)
+        if channels:
+            channels.discard(channel_id)
+            if not channels:
+                _DM_USER_CHANNELS.pop(user_id, None)
+
+def invalidate_dm_participants(channel_id=None, user_id=None):
+    """Invalide un salon, ou tous les salons DM d'un utilisateur"""
+    global _DM_PARTICIPANTS_GENERATION
+    with _DM_PARTICIPANTS_LOCK:
+        _DM_PARTICIPANTS_GENERATION += 1
+        if channel_id:
+            _drop_dm_participants_locked(channel_id)
+        if user_id:
+            for cid in list(_DM_USER_CHANNELS.get(user_id, ())):
+                _drop_dm_participants_locked(cid)
+
+@event.listens_for(User, 'after_update')
+def _invalidate_dm_profiles_on_user_update(mapper, connection, target):
+    attrs = db.inspect(target).attrs
+    if any(attrs[field].history.has_changes() for field in _DM_PROFILE_FIELDS):
+        invalidate_dm_participants(user_id=target.id)
+
+def record_dm_activity(channel_id, message, user_id=None):
+    """Met à jour le résumé des participants (ou d'un seul) après un nouveau message"""
+    query = DMConversation.query.filter_by(channel_id=channel_id)
+    if user_id:
+        query = query.filter_by(user_id=user_id)
+    query.update({
+        DMConversation.last_message_id: message.id,
+        DMConversation.last_activity_at: message.created_at or get_current_utc_time(),
+    }, synchronize_session=False)
+    db.session.commit()
+
+def rewind_dm_activity(channel_id, deleted_ids):
+    """Après suppression, ramène last_message_id au dernier message encore visible du DM.
+
+    À appeler avant le commit de la suppression ; last_activity_at est conservé
+    pour ne pas réordonner la liste des conversations.
+    """
+    if not deleted_ids:
+        return
+    db.session.flush()
+    previous = (db.select(Message.id)
+                .where(Message.channel_id == channel_id, Message.is_deleted.is_(False))
+                .order_by(Message.created_at.desc())
+                .limit(1).scalar_subquery())
+    DMConversation.query.filter(
+        DMConversation.channel_id == channel_id,
+        DMConversation.last_message_id.in_(list(deleted_ids))
+    ).update({DMConversation.last_message_id: previous}, synchronize_session=False)
+
+
+
+
+
+
+
+
+
+
+
+# ============================================
+# TOTAUX DE STOCKAGE ET D'ENTITÉS (STATISTIQUES ADMIN)
+# ============================================
+# Les octets occupés (uploads, data hors base vivante) et le nombre
+# d'utilisateurs / salons / messages / fichiers sont tenus à jour à chaque
+# écriture ou suppression ; un recalage périodique corrige la dérive
+# (suppressions en masse, fichiers déposés à la main, rollbacks).
+
+def _live_database_bytes():
+    """Taille de la base vivante (+ WAL) : quelques stat, pas de parcours"""
+    total = 0
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            total += os.path.getsize(f"{DB_PATH}{suffix}")
+        except OSError:
+            pass
+    return total
+
+def _tree_bytes(root, exclude=()):
+    total = 0
+    stack = [str(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and entry.path not in exclude:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+def reconcile_storage_totals():
+    """Recalcule les totaux (parcours disque + COUNT) et mémorise la dérive corrigée"""
+    started = time.monotonic()
+    db_files = {str(DB_PATH), f"{DB_PATH}-wal", f"{DB_PATH}-shm"}
+    fresh = {
+        'uploads_bytes': _tree_bytes(UPLOADS_DIR),
+        'data_bytes': _tree_bytes(DATA_DIR, exclude=db_files),
+        'users': User.query.count(),
+        'channels': Channel.query.count(),
+        'messages': Message.query.count(),
+        'files': FileAttachment.query.count(),
+    }
+    reconcile_storage_usage()
+    with _STORAGE_LOCK:
+        drift = {k: v - _STORAGE_TOTALS.get(k, 0) for k, v in fresh.items()}
+        _STORAGE_TOTALS.update(fresh)
+    first_run = _STORAGE_STATE['reconciled_at'] is None
+    _STORAGE_STATE['last_drift'] = {} if first_run else {k: v for k, v in drift.items() if v}
+    _STORAGE_STATE['reconciled_at'] = datetime.now(timezone.utc).isoformat()
+    _STORAGE_STATE['last_duration'] = round(time.monotonic() - started, 3)
+
+def start_storage_reconciler():
+    """Recalage immédiat puis toutes les STATS_RECONCILE_INTERVAL secondes"""
+    global _STORAGE_RECONCILER_STARTED
+    if _STORAGE_RECONCILER_STARTED:
+        return
+    _STORAGE_RECONCILER_STARTED = True
+    def worker():
+        while True:
+            _STORAGE_STATE['running'] = True
+            try:
+                with app.app_context():
+                    reconcile_storage_totals()
+            except Exception as e:
+                print(f"[STATS] Erreur de recalage: {e}")
+            finally:
+                _STORAGE_STATE['running'] = False
+            time.sleep(max(60, STATS_RECONCILE_INTERVAL))
+    threading.Thread(target=worker, daemon=True).start()
+
+def get_storage_totals():
+    with _STORAGE_LOCK:
+        totals = dict(_STORAGE_TOTALS)
+    totals['database_bytes'] = _live_database_bytes()
+    totals['disk_used'] = totals['uploads_bytes'] + totals['data_bytes'] + totals['database_bytes']
+    totals.update(_STORAGE_STATE)
+    return totals
+
+def _register_entity_counter(model, key):
+    @event.listens_for(model, 'after_insert')
+    def _on_insert(mapper, connection, target):
+        adjust_storage_total(key, 1)
+    @event.listens_for(model, 'after_delete')
+    def _on_delete(mapper, connection, target):
+        adjust_storage_total(key, -1)
+
+for _model, _key in ((User, 'users'), (Channel, 'channels'), (Message, 'messages'), (FileAttachment, 'files')):
+    _register_entity_counter(_model, _key)
+
+# ============================================
+# QUOTAS DE STOCKAGE (UTILISATEUR / SALON)
+# ============================================
+# users.storage_used et channels.storage_used sont tenus à jour dans la même
+# transaction que l'ajout ou la suppression de la pièce jointe (taille logique,
+# même si le blob est partagé). La vérification d'un upload est donc une simple
+# lecture de ligne, faite avant de recevoir le contenu (Content-Length ou taille
+# annoncée de l'upload fractionné). Le recalage périodique corrige la dérive.
+
+def _storage_usage_updates(user_id, channel_id, delta):
+    """Requêtes UPDATE ajustant les compteurs de l'uploadeur et du salon"""
+    statements = []
+    for model, owner_id in ((User, user_id), (Channel, channel_id)):
+        if owner_id:
+            statements.append(
+                db.update(model.__table__).where(model.__table__.c.id == owner_id)
+                .values(storage_used=db.func.max(db.func.coalesce(model.__table__.c.storage_used, 0) + delta, 0))
+            )
+    return statements
+
+@event.listens_for(FileAttachment, 'after_insert')
+def _count_attachment_storage(mapper, connection, target):
+    for statement in _storage_usage_updates(target.uploader_id, target.channel_id, target.file_size or 0):
+        connection.execute(statement)
+
+@event.listens_for(FileAttachment, 'after_delete')
+def _uncount_attachment_storage(mapper, connection, target):
+    for statement in _storage_usage_updates(target.uploader_id, target.channel_id, -(target.file_size or 0)):
+        connection.execute(statement)
+
+def uncount_attachments(ids):
+    """Décompte des pièces jointes supprimées hors ORM (à appeler avant le DELETE)"""
+    rows = db.session.execute(
+        db.select(FileAttachment.uploader_id, FileAttachment.channel_id, db.func.sum(FileAttachment.file_size))
+        .where(FileAttachment.id.in_(ids))
+        .group_by(FileAttachment.uploader_id, FileAttachment.channel_id)
+    ).all()
+    for user_id, channel_id, size in rows:
+        for statement in _storage_usage_updates(user_id, channel_id, -(size or 0)):
+            db.session.execute(statement)
+
+def _effective_quota(quota, default):
+    return default if quota is None else quota
+
+def storage_quota_error(user, channel_id, incoming_size):
+    """Message d'erreur si incoming_size octets dépasseraient un quota, sinon None"""
+    incoming_size = max(0, incoming_size or 0)
+    quota = _effective_quota(user.storage_quota, USER_STORAGE_QUOTA)
+    if quota and (user.storage_used or 0) + incoming_size > quota:
+        return f'Quota de stockage dépassé ({(user.storage_used or 0) // (1024 * 1024)} / {quota // (1024 * 1024)} Mo)'
+    channel = db.session.get(Channel, channel_id) if channel_id else None
+    if channel is not None:
+        quota = _effective_quota(channel.storage_quota, CHANNEL_STORAGE_QUOTA)
+        if quota and (channel.storage_used or 0) + incoming_size > quota:
+            return f'Quota de stockage du salon dépassé ({quota // (1024 * 1024)} Mo)'
     return None
 
+def reconcile_storage_usage():
+    """Recalcule les compteurs par utilisateur et par salon (SUM groupée, recalage périodique)"""
+    for model, column in ((User, FileAttachment.uploader_id), (Channel, FileAttachment.channel_id)):
+        usage = (db.select(db.func.coalesce(db.func.sum(FileAttachment.file_size), 0))
+                 .where(column == model.id).scalar_subquery())
+        db.session.execute(db.update(model).values(storage_used=usage))
+    db.session.commit()
+
+def storage_usage_payload(used, quota, default):
+    quota = _effective_quota(quota, default)
+    return {'used': used or 0, 'quota': quota or None, 'remaining': max(0, quota - (used or 0)) if quota else None}
+
+@app.route('/api/user/storage', methods=['GET'])
+@login_required
+def get_user_storage():
+    """Espace utilisé et quota de l'utilisateur courant"""
+    return jsonify(storage_usage_payload(current_user.storage_used, current_user.storage_quota, USER_STORAGE_QUOTA))
+
+@app.route('/api/admin/users/<user_id>/quota', methods=['PUT'])
+@admin_required
+def set_user_quota(user_id):
+    """Fixe le quota d'un utilisateur (octets ; null = valeur par défaut, 0 = illimité)"""
+    user = db.session.get(User, user_id)
+    if not user:
+        return jsonify({'error': 'Utilisateur non trouvé'}), 404
+    quota = (request.get_json(silent=True) or {}).get('quota')
+    if quota is not None and (isinstance(quota, bool) or not isinstance(quota, int) or quota < 0):
+        return jsonify({'error': 'Quota invalide'}), 400
+    user.storage_quota = quota
+    db.session.commit()
+    log_action(current_user, ActionType.SET_QUOTA, target_id=user.id, target_type='user', details=f'Quota: {quota}')
+    return jsonify(storage_usage_payload(user.storage_used, user.storage_quota, USER_STORAGE_QUOTA))
+
+@app.route('/api/admin/channels/<channel_id>/quota', methods=['PUT'])
+@admin_required
+def set_channel_quota(channel_id):
+    """Fixe le quota d'un salon (octets ; null = valeur par défaut, 0 = illimité)"""
+    channel = db.session.get(Channel, channel_id)
+    if not channel:
+        return jsonify({'error': 'Salon non trouvé'}), 404
+    quota = (request.get_json(silent=True) or {}).get('quota')
+    if quota is not None and (isinstance(quota, bool) or not isinstance(quota, int) or quota < 0):
+        return jsonify({'error': 'Quota invalide'}), 400
+    channel.storage_quota = quota
+    db.session.commit()
+    log_action(current_user, ActionType.SET_QUOTA, target_id=channel.id, target_type='channel', details=f'Quota: {quota}')
+    return jsonify(storage_usage_payload(channel.storage_used, channel.storage_quota, CHANNEL_STORAGE_QUOTA))
+
+# ============================================
+# STOCKAGE DÉDUPLIQUÉ (ADRESSAGE PAR CONTENU)
+# ============================================
+# Chaque contenu est écrit une seule fois sous BLOBS_DIR, nommé par son SHA-256.
+# Les FileAttachment y pointent (content_hash) et FileBlob.ref_count compte les
+# références : le fichier n'est supprimé qu'au départ de la dernière.
+
+def blob_path(content_hash):
+    return BLOBS_DIR / content_hash[:2] / content_hash
+
+def blob_filename(content_hash):
+    """Chemin relatif à FILES_DIR stocké dans FileAttachment.filename"""
+    return f"{BLOBS_DIR.name}/{content_hash[:2]}/{content_hash}"
+
+def spool_upload(stream):
+    """Écrit un flux dans un fichier temporaire en calculant son SHA-256 -> (chemin, hash, taille)"""
+    tmp_path = CHUNKED_UPLOAD_DIR / f"{uuid.uuid4().hex}.spool"
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                f.write(block)
+                hasher.update(block)
+                size += len(block)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path, hasher.hexdigest(), size
+
+def _increment_blob_ref(content_hash):
+    return db.session.execute(
+        db.update(FileBlob).where(FileBlob.content_hash == content_hash)
+        .values(ref_count=FileBlob.ref_count + 1)
+    ).rowcount
+
+def acquire_blob(content_hash, source_path=None, size=None, copy=False):
+    """Ajoute une référence au blob, en le créant depuis source_path si besoin.
+
+    Retourne (blob, créé). La référence est posée dans la transaction courante,
+    l'appelant valide avec son FileAttachment. Si le blob existait déjà,
+    source_path n'est pas touché (à l'appelant de le supprimer).
+    """
+    if _increment_blob_ref(content_hash):
+        return db.session.get(FileBlob, content_hash), False
+    if source_path is None:
+        return None, False
+    target = blob_path(content_hash)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if copy:
+        shutil.copy2(str(source_path), str(target))
+    else:
+        shutil.move(str(source_path), str(target))
+    blob = FileBlob(content_hash=content_hash, file_path=str(target), file_size=size or 0, ref_count=1)
+    try:
+        with db.session.begin_nested():
+            db.session.add(blob)
+    except IntegrityError:
+        # Même contenu créé en parallèle : on se rattache au blob existant
+        _increment_blob_ref(content_hash)
+        return db.session.get(FileBlob, content_hash), False
+    track_file_added(target)
+    return blob, True
+
+def release_blob(content_hash):
+    """Retire une référence ; retourne le chemin à supprimer (après commit) si c'était la dernière"""
+    db.session.execute(
+        db.update(FileBlob).where(FileBlob.content_hash == content_hash)
+        .values(ref_count=FileBlob.ref_count - 1)
+    )
+    row = db.session.execute(
+        db.select(FileBlob.ref_count, FileBlob.file_path).where(FileBlob.content_hash == content_hash)
+    ).first()
+    if row is None or row[0] > 0:
+        return None
+    db.session.execute(db.delete(FileBlob).where(FileBlob.content_hash == content_hash))
+    return row[1]
+
+def purge_blob_files(paths):
+    """Supprime les blobs libérés, sauf s'ils ont été recréés entre-temps"""
+    for path in paths:
+        content_hash = Path(path).name
+        if db.session.get(FileBlob, content_hash) is not None:
+            continue
+        remove_tracked_file(path)
 
+_BLOB_MIGRATION_STATE = {
+    'running': False, 'processed': 0, 'deduplicated': 0,
+    'missing': 0, 'errors': 0, 'bytes_saved': 0,
+}
 
+def _sha256_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
 
+def migrate_legacy_attachments(batch_size=None):
+    """Rattache par lots les fichiers hérités (sans empreinte) aux blobs dédupliqués.
 
+    Hachage et copie se font hors transaction (la copie est préparée à côté du
+    blob puis renommée) ; chaque fichier est ensuite validé par une écriture
+    courte, pour ne jamais garder le verrou d'écriture SQLite pendant les E/S.
+    Le fichier hérité n'est supprimé qu'après ce commit.
+    """
+    batch_size = batch_size or BLOB_DEDUP_BATCH_SIZE
+    skipped = set()
+    state = _BLOB_MIGRATION_STATE
+    while True:
+        query = db.select(FileAttachment.id, FileAttachment.file_path).where(FileAttachment.content_hash.is_(None))
+        if skipped:
+            query = query.where(FileAttachment.id.notin_(skipped))
+        batch = db.session.execute(query.order_by(FileAttachment.created_at).limit(batch_size)).all()
+        db.session.rollback()
+        if not batch:
+            break
+        for attachment_id, path in batch:
+            if not path or not os.path.exists(path):
+                skipped.add(attachment_id)
+                state['missing'] += 1
+                continue
+            staged = None
+            try:
+                size = os.path.getsize(path)
+                content_hash = _sha256_file(path)
+                if db.session.get(FileBlob, content_hash) is None:
+                    target = blob_path(content_hash)
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    staged = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+                    shutil.copyfile(path, staged)
+                db.session.rollback()
+                
+                f = db.session.get(FileAttachment, attachment_id)
+                if f is None or f.content_hash is not None:
+                    # Supprimé ou migré entre-temps
+                    db.session.rollback()
+                    continue
+                blob, created = acquire_blob(content_hash, staged, size)
+                if blob is None:
+                    # Blob supprimé entre la lecture et l'écriture : nouvel essai au prochain passage
+                    db.session.rollback()
+                    skipped.add(attachment_id)
+                    continue
+                f.content_hash = content_hash
+                f.file_path = blob.file_path
+                f.filename = blob_filename(content_hash)
+                db.session.commit()
+                if not created:
+                    state['deduplicated'] += 1
+                    state['bytes_saved'] += size
+                state['processed'] += 1
+                if os.path.abspath(path) != os.path.abspath(blob.file_path):
+                    remove_tracked_file(path)
+            except Exception as e:
+                db.session.rollback()
+                skipped.add(attachment_id)
+                state['errors'] += 1
+                print(f"[BLOBS] Migration impossible pour {attachment_id}: {e}")
+            finally:
+                # Copie préparée inutilisée (contenu déjà présent ou échec)
+                if staged is not None:
+                    staged.unlink(missing_ok=True)
 
+def start_blob_dedup_migration():
+    """Lance la déduplication des fichiers hérités en arrière-plan"""
+    if _BLOB_MIGRATION_STATE['running']:
+        return
+    _BLOB_MIGRATION_STATE['running'] = True
+    def worker():
+        try:
+            with app.app_context():
+                migrate_legacy_attachments()
+                state = _BLOB_MIGRATION_STATE
+                if state['processed']:
+                    print(f"[BLOBS] Migration terminée: {state['processed']} fichiers, "
+                          f"{state['deduplicated']} doublons, {state['bytes_saved']} octets libérés")
+        except Exception as e:
+            print(f"[BLOBS] Erreur de migration: {e}")
+        finally:
+            _BLOB_MIGRATION_STATE['running'] = False
+    threading.Thread(target=worker, daemon=True).start()
 
+def resolve_upload_channel(channel_id, dm_target_user_id):
+    """Salon cible d'un upload ; un DM inexistant est créé immédiatement"""
+    # Si pas d'ID de canal mais un ID utilisateur cible (DM)
+    if not channel_id and dm_target_user_id:
+        # Chercher le canal DM existant
+        dm_channel = _find_dm_channel(current_user.id, dm_target_user_id)
+        
+        # Si pas trouvé, on le crée IMMÉDIATEMENT
+        if not dm_channel:
+            target_user = db.session.get(User, dm_target_user_id)
+            if target_user and target_user.is_active:
+                dm_channel, created = get_or_create_dm_channel(current_user, target_user)
+                
+                # Notifier la création (via socket externe)
+                try:
+                    if created:
+                        socketio.emit('dm_conversation_created', {
+                            'channel': dm_channel.to_dict(),
+                            'other_user': current_user.to_dict(include_sensitive=False),
+                        }, room=f"user_{target_user.id}")
+                except:
+                    pass
 
+        if dm_channel:
+            channel_id = dm_channel.id
+    return channel_id
 
+def create_file_attachment(original_filename, channel_id, content_hash, source_path, file_size, standalone=False):
+    """Crée le FileAttachment pointant sur le blob (créé depuis source_path si nouveau contenu).
 
+    standalone : fichier déposé directement (sans message), conservé par le ramasse-miettes.
+    """
+    blob, created = acquire_blob(content_hash, source_path, file_size)
+    if blob is None:
+        raise ValueError('Contenu introuvable')
+    
+    file_record = FileAttachment(
+        uploader_id=current_user.id,
+        channel_id=channel_id if channel_id else None,
+        filename=blob_filename(content_hash),
+        original_filename=original_filename,
+        file_type=get_file_type(original_filename),
+        file_size=file_size,
+        file_path=blob.file_path,
+        content_hash=content_hash,
+        is_standalone=bool(standalone)
+    )
+    
+    db.session.add(file_record)
+    db.session.commit()
+    
+    # Contenu déjà connu : la copie temporaire est inutile
+    if source_path is not None and not created:
+        Path(source_path).unlink(missing_ok=True)
+    
+    log_action(current_user, ActionType.UPLOAD_FILE, target_id=file_record.id,
+               target_type='file', details=f'Upload: {original_filename}')
+    enqueue_thumbnail(file_record)
+    invalidate_gallery_facets()
+    return file_record
 
 # ============================================
-# UPLOAD DE FICHIERS
+# MINIATURES (POOL DE PROCESSUS)
 # ============================================
+# Les uploads d'images et de PDF alimentent une file bornée ; un thread
+# répartiteur soumet le rendu (thumbnails.render_thumbnails) à un pool de
+# processus et renseigne thumbnail_path à la fin.
+_THUMB_IMAGE_EXTS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp'}
+_THUMB_QUEUE = queue.Queue(maxsize=THUMBNAIL_QUEUE_MAXSIZE)
+_THUMB_METRICS = {'enqueued': 0, 'done': 0, 'failed': 0, 'unsupported': 0, 'dropped': 0, 'max_latency': 0.0}
+_THUMB_METRICS_LOCK = threading.Lock()
+_THUMB_INFLIGHT = threading.BoundedSemaphore(max(1, THUMBNAIL_WORKERS) * 2)
+_THUMB_EXECUTOR = None
+_MEDIA_EXECUTOR_LOCK = threading.Lock()
+_THUMB_WORKER_STARTED = False
+_THUMB_BACKFILL = {'running': False, 'enqueued': 0}
+
+def _thumb_metric(key, delta=1):
+    # Mis à jour par le répartiteur, les callbacks du pool et les requêtes
+    with _THUMB_METRICS_LOCK:
+        _THUMB_METRICS[key] += delta
+
+def thumbnail_kind(file_record):
+    """'image', 'pdf' ou None selon l'extension d'origine"""
+    name = file_record.original_filename or file_record.filename or ''
+    ext = name.rsplit('.', 1)[1].lower() if '.' in name else ''
+    if ext in _THUMB_IMAGE_EXTS:
+        return 'image'
+    if ext == 'pdf':
+        return 'pdf'
+    return None
+
+def thumbnail_paths(file_id):
+    return THUMBS_DIR / f"{file_id}.jpg", THUMBS_DIR / f"{file_id}.webp"
+
+def enqueue_thumbnail(file_record, block=False):
+    """Programme la miniature d'un fichier ; False si non concerné ou file pleine"""
+    kind = thumbnail_kind(file_record)
+    if not kind or file_record.thumbnail_path:
+        return False
+    _start_thumbnail_worker()
+    item = (file_record.id, file_record.file_path, kind, file_record.channel_id, time.monotonic())
+    try:
+        _THUMB_QUEUE.put(item, block=block, timeout=5 if block else None)
+    except queue.Full:
+        _thumb_metric('dropped')
+        return False
+    _thumb_metric('enqueued')
+    return True
+
+def _finish_thumbnail(file_id, channel_id, jpeg_path, queued_at, future):
+    _THUMB_INFLIGHT.release()
+    with _THUMB_METRICS_LOCK:
+        _THUMB_METRICS['max_latency'] = max(_THUMB_METRICS['max_latency'], time.monotonic() - queued_at)
+    try:
+        rendered = future.result() or {}
+    except Exception as e:
+        from thumbnails import PreviewUnavailable
+        if isinstance(e, PreviewUnavailable):
+            _thumb_metric('unsupported')
+        else:
+            _thumb_metric('failed')
+            print(f"[THUMBS] Échec pour {file_id}: {e}")
+        return
+    try:
+        with app.app_context():
+            record = db.session.get(FileAttachment, file_id)
+            if not record:
+                # Fichier supprimé pendant le rendu
+                for path in thumbnail_paths(file_id):
+                    path.unlink(missing_ok=True)
+                return
+            jpeg_path, webp_path = thumbnail_paths(file_id)
+            track_file_added(jpeg_path)
+            if rendered.get('webp'):
+                track_file_added(webp_path)
+            else:
+                # Pillow sans WebP : ne pas laisser traîner une ancienne variante
+                webp_path.unlink(missing_ok=True)
+            record.thumbnail_path = str(jpeg_path)
+            record.thumbnail_has_webp = bool(rendered.get('webp'))
+            db.session.commit()
+            _thumb_metric('done')
+            if channel_id:
+                socketio.emit('file_thumbnail_ready', {
+                    'file_id': file_id,
+                    'thumbnail': f"/uploads/files/.thumbs/{file_id}.jpg",
+                    'thumbnail_webp': f"/uploads/files/.thumbs/{file_id}.webp" if rendered.get('webp') else None,
+                }, room=str(channel_id))
+    except Exception as e:
+        _thumb_metric('failed')
+        print(f"[THUMBS] Mise à jour impossible pour {file_id}: {e}")
+
+def get_media_executor():
+    """Pool de processus partagé (miniatures, variantes d'avatar)"""
+    global _THUMB_EXECUTOR
+    with _MEDIA_EXECUTOR_LOCK:
+        if _THUMB_EXECUTOR is None:
+            # 'spawn' : pas de fork d'un processus multi-thread. Chaque processus ré-exécute
+            # app.py (sous __mp_main__) avant d'importer thumbnails : voir POOL_WORKER
+            _THUMB_EXECUTOR = ProcessPoolExecutor(
+                max_workers=max(1, THUMBNAIL_WORKERS),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _THUMB_EXECUTOR
+
+def _start_thumbnail_worker():
+    global _THUMB_WORKER_STARTED
+    if _THUMB_WORKER_STARTED:
+        return
+    _THUMB_WORKER_STARTED = True
+    def dispatcher():
+        from thumbnails import render_thumbnails
+        while True:
+            file_id, source_path, kind, channel_id, queued_at = _THUMB_QUEUE.get()
+            jpeg_path, webp_path = thumbnail_paths(file_id)
+            _THUMB_INFLIGHT.acquire()
+            try:
+                future = get_media_executor().submit(render_thumbnails, source_path, kind,
+                                                str(jpeg_path), str(webp_path), THUMBNAIL_MAX_SIZE)
+            except Exception as e:
+                _THUMB_INFLIGHT.release()
+                _thumb_metric('failed')
+                print(f"[THUMBS] Pool indisponible: {e}")
+                continue
+            future.add_done_callback(functools.partial(_finish_thumbnail, file_id, channel_id, jpeg_path, queued_at))
+    threading.Thread(target=dispatcher, daemon=True).start()
+
+def backfill_thumbnails(batch_size=200):
+    """Programme les miniatures manquantes des fichiers existants (bloque si la file est pleine)"""
+    total = 0
+    last = None
+    while True:
+        query = FileAttachment.query.filter(
+            FileAttachment.thumbnail_path.is_(None),
+            FileAttachment.file_type.in_(['image', 'gif', 'document'])
+        )
+        if last:
+            query = query.filter(db.or_(
+                FileAttachment.created_at > last[0],
+                db.and_(FileAttachment.created_at == last[0], FileAttachment.id > last[1])
+            ))
+        batch = query.order_by(FileAttachment.created_at, FileAttachment.id).limit(batch_size).all()
+        if not batch:
+            break
+        for record in batch:
+            if os.path.exists(record.file_path) and enqueue_thumbnail(record, block=True):
+                total += 1
+                _THUMB_BACKFILL['enqueued'] += 1
+        last = (batch[-1].created_at, batch[-1].id)
+        db.session.expunge_all()
+    return total
+
+def start_thumbnail_backfill():
+    if _THUMB_BACKFILL['running']:
+        return False
+    _THUMB_BACKFILL['running'] = True
+    _THUMB_BACKFILL['enqueued'] = 0
+    def worker():
+        try:
+            with app.app_context():
+                total = backfill_thumbnails()
+                print(f"[THUMBS] Rattrapage: {total} miniatures programmées")
+        except Exception as e:
+            print(f"[THUMBS] Erreur de rattrapage: {e}")
+        finally:
+            _THUMB_BACKFILL['running'] = False
+    threading.Thread(target=worker, daemon=True).start()
+    return True
+
+def get_thumbnail_metrics():
+    with _THUMB_METRICS_LOCK:
+        metrics = dict(_THUMB_METRICS)
+    metrics['pending'] = _THUMB_QUEUE.qsize()
+    metrics['capacity'] = THUMBNAIL_QUEUE_MAXSIZE
+    metrics['workers'] = max(1, THUMBNAIL_WORKERS)
+    metrics['max_latency'] = round(metrics['max_latency'], 3)
+    metrics['backfill'] = dict(_THUMB_BACKFILL)
+    return metrics
+
+def own_profile_image(directory, name):
+    """True si name est un nom simple, préfixé par l'id de l'utilisateur courant et présent dans directory"""
+    if not isinstance(name, str) or name != secure_filename(name) or not name.startswith(f"{current_user.id}_"):
+        return False
+    path = safe_join(str(directory), name)
+    return bool(path) and os.path.isfile(path)
+
+def avatar_path(avatar_filename):
+    """Chemin d'un fichier de AVATARS_DIR ; None si le nom en sortirait"""
+    if not avatar_filename or '/' in avatar_filename or '\\' in avatar_filename:
+        return None
+    path = safe_join(str(AVATARS_DIR), avatar_filename)
+    if not path or Path(path).resolve().parent != AVATARS_DIR.resolve():
+        return None
+    return Path(path)
+
+def remove_avatar_files(avatar_filename):
+    """Supprime un avatar source et toutes ses variantes"""
+    source = avatar_path(avatar_filename)
+    if not source:
+        return
+    stem = avatar_filename.rsplit('.', 1)[0]
+    avatars_root = AVATARS_DIR.resolve()
+    variants = [p for p in AVATARS_DIR.glob(f"{glob_escape(stem)}_*") if p.resolve().parent == avatars_root]
+    for path in [source, *variants]:
+        remove_tracked_file(path)
+
+def _finish_avatar_variants(user_id, avatar_filename, future):
+    try:
+        result = future.result()
+    except Exception as e:
+        print(f"[AVATARS] Variantes impossibles pour {avatar_filename}: {e}")
+        return
+    try:
+        with app.app_context():
+            user = db.session.get(User, user_id)
+            # L'utilisateur a pu changer d'avatar entre-temps
+            if not user or user.avatar_filename != avatar_filename:
+                remove_avatar_files(avatar_filename)
+                return
+            stem = avatar_filename.rsplit('.', 1)[0]
+            for size in result['sizes']:
+                track_file_added(AVATARS_DIR / f"{stem}_{size}.{result['format']}")
+            user.avatar_variants = f"{result['format']}:{','.join(str(v) for v in result['sizes'])}"
+            db.session.commit()
+            socketio.emit('avatar_variants_ready', {
+                'user_id': user_id,
+                'avatar': user.get_avatar_url(128),
+                'avatar_small': user.get_avatar_url(64),
+                'avatar_large': user.get_avatar_url(),
+            }, room=f"user_{user_id}")
+    except Exception as e:
+        print(f"[AVATARS] Mise à jour impossible pour {user_id}: {e}")
+
+def schedule_avatar_variants(user_id, avatar_filename):
+    """Programme la génération des variantes d'un avatar dans le pool de processus"""
+    source_path = avatar_path(avatar_filename)
+    if not source_path or not source_path.is_file():
+        return False
+    from thumbnails import render_avatar_variants
+    try:
+        future = get_media_executor().submit(
+            render_avatar_variants, str(source_path), str(AVATARS_DIR),
+            avatar_filename.rsplit('.', 1)[0], list(AVATAR_VARIANT_SIZES), AVATAR_MAX_FRAMES
+        )
+    except Exception as e:
+        print(f"[AVATARS] Pool indisponible: {e}")
+        return False
+    future.add_done_callback(functools.partial(_finish_avatar_variants, user_id, avatar_filename))
+    return True
+
+@app.route('/api/admin/thumbnails', methods=['GET'])
+@admin_required
+def admin_thumbnail_metrics():
+    """Métriques de la file de miniatures"""
+    return jsonify(get_thumbnail_metrics())
+
+@app.route('/api/admin/thumbnails/backfill', methods=['POST'])
+@admin_required
+def admin_thumbnail_backfill():
+    """Lance la génération des miniatures manquantes"""
+    started = start_thumbnail_backfill()
+    return jsonify({'started': started, 'metrics': get_thumbnail_metrics()}), 202 if started else 409
+
 @app.route('/api/upload', methods=['POST'])
 @login_required
 def upload_file():
     """Upload d'un fichier"""
+    # Quota vérifié avant de lire le corps : Content-Length (enveloppe multipart comprise)
+    # et salon passé en paramètre d'URL par le client
+    quota_error = storage_quota_error(current_user, request.args.get('channel_id'), request.content_length)
+    if quota_error:
+        return jsonify({'error': quota_error}), 413
+    
     if 'file' not in request.files:
         return jsonify({'error': 'Aucun fichier fourni'}), 400
     
@@ -1897,111 +3283,25 @@ def upload_file():
     
     if file and allowed_file(file.filename):
         try:
-            # Générer un nom de fichier unique
             original_filename = secure_filename(file.filename)
-            ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-            unique_filename = f"{uuid.uuid4().hex}.{ext}"
-            
-            # Déterminer le type de fichier
-            file_type = get_file_type(original_filename)
-            
-            # =================================================================
-            # LOGIQUE DE DOSSIER DÉDIÉ PAR CONVERSATION
-            # =================================================================
-            channel_id = request.form.get('channel_id')
-            dm_target_user_id = request.form.get('dm_target_user_id')
-            
-            # Si pas d'ID de canal mais un ID utilisateur cible (DM)
-            if not channel_id and dm_target_user_id:
-                # Chercher le canal DM existant
-                dm_channel = _find_dm_channel(current_user.id, dm_target_user_id)
-                
-                # Si pas trouvé, on le crée IMMÉDIATEMENT pour avoir un dossier
-                if not dm_channel:
-                    target_user = db.session.get(User, dm_target_user_id)
-                    if target_user and target_user.is_active:
-                        dm_channel = Channel(
-                            name=f"DM-{current_user.username}-{target_user.username}",
-                            channel_type=ChannelType.DM,
-                            category="Privé"
-                        )
-                        db.session.add(dm_channel)
-                        db.session.commit()
-                        
-                        p1 = ChannelParticipant(channel_id=dm_channel.id, user_id=current_user.id)
-                        p2 = ChannelParticipant(channel_id=dm_channel.id, user_id=target_user.id)
-                        db.session.add(p1)
-                        db.session.add(p2)
-                        db.session.commit()
-                        
-                        # Notifier la création (via socket externe)
-                        try:
-                            socketio.emit('dm_conversation_created', {
-                                'channel': dm_channel.to_dict(),
-                                'other_user': current_user.to_dict(include_sensitive=False),
-                            }, room=f"user_{target_user.id}")
-                        except:
-                            pass
-
-                if dm_channel:
-                    channel_id = dm_channel.id
-
-            # Définir le chemin en fonction du canal
-            relative_folder = ""
-            if channel_id:
-                channel = db.session.get(Channel, channel_id)
-                if channel:
-                    if channel.channel_type == ChannelType.DM:
-                        # 1 dossier par conversation privée
-                        relative_folder = f"private/{channel.id}"
-                    else:
-                        # Dossier dédié pour les chaînes publiques
-                        relative_folder = f"channels/{channel.id}"
             
-            # Fallback date si pas de canal identifié
-            if not relative_folder:
-                now = datetime.now(timezone.utc)
-                relative_folder = now.strftime('%Y/%m')
-
-            user_path = FILES_DIR / relative_folder
-            
-            try:
-                user_path.mkdir(parents=True, exist_ok=True)
-            except PermissionError:
-                # Fallback: utiliser le dossier racine
-                user_path = FILES_DIR
-                relative_folder = ""
-            
-            file_path = user_path / unique_filename
+            channel_id = resolve_upload_channel(
+                request.form.get('channel_id'),
+                request.form.get('dm_target_user_id')
+            )
             
-            # Sauvegarder le fichier
-            file.save(str(file_path))
+            # Écriture temporaire + empreinte, puis rattachement au blob (dédupliqué)
+            tmp_path, content_hash, file_size = spool_upload(file.stream)
             
-            # Obtenir la taille du fichier
-            try:
-                file_size = os.path.getsize(str(file_path))
-            except:
-                file_size = file.tell()
+            quota_error = storage_quota_error(current_user, channel_id, file_size)
+            if quota_error:
+                Path(tmp_path).unlink(missing_ok=True)
+                return jsonify({'error': quota_error}), 413
             
             # Créer l'enregistrement en base
-            # Le filename stocké doit inclure le chemin relatif pour l'accès futur
-            stored_filename = f"{relative_folder}/{unique_filename}" if relative_folder else unique_filename
-            
-            file_record = FileAttachment(
-                uploader_id=current_user.id,
-                channel_id=channel_id if channel_id else None,
-                filename=stored_filename,
-                original_filename=original_filename,
-                file_type=file_type,
-                file_size=file_size,
-                file_path=str(file_path)
-            )
-            
-            db.session.add(file_record)
-            db.session.commit()
-            
-            log_action(current_user, ActionType.UPLOAD_FILE, target_id=file_record.id,
-                       target_type='file', details=f'Upload: {original_filename}')
+            file_record = create_file_attachment(original_filename, channel_id, content_hash,
+                                                 tmp_path, file_size,
+                                                 standalone=request.form.get('standalone') == '1')
             
             return jsonify({
                 'message': 'Fichier uploadé',
@@ -2015,6 +3315,268 @@ def upload_file():
     
     return jsonify({'error': 'Type de fichier non autorisé'}), 400
 
+# ============================================
+# UPLOAD FRACTIONNÉ AVEC REPRISE
+# ============================================
+# Protocole : POST /api/upload/chunked (init) -> PUT .../<id>?offset=N (morceaux,
+# dans l'ordre) -> POST .../<id>/complete. L'état est persisté à côté du fichier
+# partiel (.json) pour survivre à une coupure ou un redémarrage ; GET .../<id>
+# renvoie l'offset à partir duquel reprendre.
+
+_CHUNKED_HASHERS = {}
+_CHUNKED_LOCKS = {}
+_CHUNKED_LOCKS_GUARD = threading.Lock()
+_CHUNKED_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def _chunked_paths(upload_id):
+    return CHUNKED_UPLOAD_DIR / f"{upload_id}.part", CHUNKED_UPLOAD_DIR / f"{upload_id}.json"
+
+def _chunked_lock(upload_id):
+    with _CHUNKED_LOCKS_GUARD:
+        lock = _CHUNKED_LOCKS.get(upload_id)
+        if lock is None:
+            lock = _CHUNKED_LOCKS[upload_id] = threading.Lock()
+        return lock
+
+def _load_chunked_state(upload_id):
+    """Charge l'état d'un upload appartenant à l'utilisateur courant (None sinon)"""
+    if not upload_id or not _CHUNKED_ID_RE.match(upload_id):
+        return None
+    part_path, meta_path = _chunked_paths(upload_id)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('user_id') != current_user.id:
+        return None
+    # L'offset fait foi sur disque (un morceau interrompu peut avoir été écrit en partie)
+    try:
+        state['offset'] = part_path.stat().st_size
+    except OSError:
+        state['offset'] = 0
+    return state
+
+def _save_chunked_state(upload_id, state):
+    _, meta_path = _chunked_paths(upload_id)
+    tmp_path = meta_path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, meta_path)
+
+def _discard_chunked_upload(upload_id):
+    for path in _chunked_paths(upload_id):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+    _CHUNKED_HASHERS.pop(upload_id, None)
+    with _CHUNKED_LOCKS_GUARD:
+        _CHUNKED_LOCKS.pop(upload_id, None)
+
+def _chunked_hasher(upload_id, offset):
+    """SHA-256 incrémental ; recalculé depuis le disque après un redémarrage"""
+    entry = _CHUNKED_HASHERS.get(upload_id)
+    if entry and entry[1] == offset:
+        return entry[0]
+    hasher = hashlib.sha256()
+    part_path, _ = _chunked_paths(upload_id)
+    if offset:
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+    _CHUNKED_HASHERS[upload_id] = (hasher, offset)
+    return hasher
+
+def prune_stale_chunked_uploads():
+    """Supprime les uploads fractionnés abandonnés depuis plus de CHUNKED_UPLOAD_EXPIRY_HOURS"""
+    cutoff = time.time() - CHUNKED_UPLOAD_EXPIRY_HOURS * 3600
+    removed = 0
+    try:
+        entries = list(CHUNKED_UPLOAD_DIR.glob('*.json'))
+    except OSError:
+        return 0
+    for meta_path in entries:
+        try:
+            if meta_path.stat().st_mtime < cutoff:
+                _discard_chunked_upload(meta_path.stem)
+                removed += 1
+        except OSError:
+            continue
+    # Fichiers temporaires d'upload simple laissés par une erreur
+    for spool_path in CHUNKED_UPLOAD_DIR.glob('*.spool'):
+        try:
+            if spool_path.stat().st_mtime < cutoff:
+                spool_path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+@app.route('/api/upload/chunked', methods=['POST'])
+@login_required
+def chunked_upload_init():
+    """Ouvre un upload fractionné"""
+    data = request.get_json(silent=True) or {}
+    original_filename = secure_filename(data.get('filename') or '')
+    if not original_filename:
+        return jsonify({'error': 'Nom de fichier vide'}), 400
+    if not allowed_file(original_filename):
+        return jsonify({'error': 'Type de fichier non autorisé'}), 400
+    try:
+        total_size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Taille du fichier requise'}), 400
+    if total_size <= 0 or total_size > CHUNKED_UPLOAD_MAX_SIZE:
+        return jsonify({'error': 'Taille de fichier invalide ou trop grande'}), 413
+    quota_error = storage_quota_error(current_user, data.get('channel_id'), total_size)
+    if quota_error:
+        return jsonify({'error': quota_error}), 413
+    
+    prune_stale_chunked_uploads()
+    
+    # Contenu déjà stocké (même empreinte et taille) : aucun octet à transférer, mais
+    # seulement si l'utilisateur possède déjà une pièce jointe de ce contenu (sinon
+    # l'empreinte seule prouverait la possession et révélerait ce qui est stocké)
+    known_hash = (data.get('sha256') or '').lower()
+    owns_content = bool(re.fullmatch(r'[0-9a-f]{64}', known_hash)) and db.session.execute(
+        db.select(FileAttachment.id)
+        .where(FileAttachment.content_hash == known_hash, FileAttachment.uploader_id == current_user.id)
+        .limit(1)
+    ).first() is not None
+    if owns_content:
+        blob = db.session.get(FileBlob, known_hash)
+        if blob and blob.file_size == total_size and os.path.exists(blob.file_path):
+            try:
+                channel_id = resolve_upload_channel(data.get('channel_id'), data.get('dm_target_user_id'))
+                file_record = create_file_attachment(original_filename, channel_id, known_hash,
+                                                     None, total_size, standalone=bool(data.get('standalone')))
+            except Exception as e:
+                db.session.rollback()
+                return jsonify({'error': f'Erreur lors de l\'upload: {str(e)}'}), 500
+            return jsonify({
+                'message': 'Fichier uploadé',
+                'file': file_record.to_dict(),
+                'channel_id': channel_id,
+                'sha256': known_hash,
+                'deduplicated': True
+            }), 201
+    
+    upload_id = uuid.uuid4().hex
+    state = {
+        'user_id': current_user.id,
+        'filename': original_filename,
+        'size': total_size,
+        'channel_id': data.get('channel_id'),
+        'dm_target_user_id': data.get('dm_target_user_id'),
+        'standalone': bool(data.get('standalone')),
+        'created_at': time.time(),
+    }
+    part_path, _ = _chunked_paths(upload_id)
+    part_path.touch()
+    _save_chunked_state(upload_id, state)
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': 0,
+        'size': total_size,
+        'chunk_size': CHUNKED_UPLOAD_CHUNK_SIZE
+    }), 201
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['GET'])
+@login_required
+def chunked_upload_status(upload_id):
+    """Offset à partir duquel reprendre l'envoi"""
+    state = _load_chunked_state(upload_id)
+    if not state:
+        return jsonify({'error': 'Upload introuvable'}), 404
+    return jsonify({'upload_id': upload_id, 'offset': state['offset'], 'size': state['size']})
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['PUT'])
+@login_required
+def chunked_upload_put(upload_id):
+    """Ajoute un morceau ; l'offset (paramètre ou en-tête Upload-Offset) doit suivre le précédent"""
+    if not _CHUNKED_ID_RE.match(upload_id):
+        return jsonify({'error': 'Upload introuvable'}), 404
+    lock = _chunked_lock(upload_id)
+    if not lock.acquire(blocking=False):
+        return jsonify({'error': 'Un morceau est déjà en cours d\'envoi'}), 409
+    try:
+        state = _load_chunked_state(upload_id)
+        if not state:
+            return jsonify({'error': 'Upload introuvable'}), 404
+        try:
+            offset = int(request.args.get('offset', request.headers.get('Upload-Offset', '')))
+        except ValueError:
+            return jsonify({'error': 'Offset requis'}), 400
+        if offset != state['offset']:
+            return jsonify({'error': 'Offset inattendu', 'offset': state['offset']}), 409
+        remaining = state['size'] - offset
+        length = request.content_length
+        if length is None or length <= 0 or length > remaining:
+            return jsonify({'error': 'Taille de morceau invalide', 'offset': offset}), 400
+        
+        hasher = _chunked_hasher(upload_id, offset)
+        part_path, _ = _chunked_paths(upload_id)
+        written = 0
+        stream = request.stream
+        try:
+            with open(part_path, 'ab') as f:
+                while written < length:
+                    block = stream.read(min(1024 * 1024, length - written))
+                    if not block:
+                        break
+                    f.write(block)
+                    hasher.update(block)
+                    written += len(block)
+        finally:
+            # Même interrompu, le hash reste aligné sur ce qui a été écrit
+            _CHUNKED_HASHERS[upload_id] = (hasher, offset + written)
+        if written < length:
+            return jsonify({'error': 'Morceau incomplet', 'offset': offset + written}), 400
+        return jsonify({'upload_id': upload_id, 'offset': offset + written, 'size': state['size']})
+    finally:
+        lock.release()
+
+@app.route('/api/upload/chunked/<upload_id>/complete', methods=['POST'])
+@login_required
+def chunked_upload_complete(upload_id):
+    """Finalise l'upload et crée le FileAttachment comme upload_file"""
+    if not _CHUNKED_ID_RE.match(upload_id):
+        return jsonify({'error': 'Upload introuvable'}), 404
+    lock = _chunked_lock(upload_id)
+    with lock:
+        state = _load_chunked_state(upload_id)
+        if not state:
+            return jsonify({'error': 'Upload introuvable'}), 404
+        if state['offset'] != state['size']:
+            return jsonify({'error': 'Upload incomplet', 'offset': state['offset']}), 409
+        sha256 = _chunked_hasher(upload_id, state['offset']).hexdigest()
+        expected = ((request.get_json(silent=True) or {}).get('sha256') or '').lower()
+        if expected and expected != sha256:
+            _discard_chunked_upload(upload_id)
+            return jsonify({'error': 'Empreinte SHA-256 invalide'}), 422
+        try:
+            channel_id = resolve_upload_channel(state.get('channel_id'), state.get('dm_target_user_id'))
+            # D'autres uploads ont pu consommer le quota depuis l'ouverture
+            quota_error = storage_quota_error(current_user, channel_id, state['size'])
+            if quota_error:
+                _discard_chunked_upload(upload_id)
+                return jsonify({'error': quota_error}), 413
+            part_path, _ = _chunked_paths(upload_id)
+            file_record = create_file_attachment(state['filename'], channel_id, sha256,
+                                                 part_path, state['size'],
+                                                 standalone=state.get('standalone', False))
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': f'Erreur lors de l\'upload: {str(e)}'}), 500
+        _discard_chunked_upload(upload_id)
+    return jsonify({
+        'message': 'Fichier uploadé',
+        'file': file_record.to_dict(),
+        'channel_id': channel_id,
+        'sha256': sha256
+    }), 201
+
 @app.route('/api/upload/avatar', methods=['POST'])
 @login_required
 def upload_avatar():
@@ -2040,65 +3602,30 @@ def upload_avatar():
         
         # Créer le dossier avatars si nécessaire
         AVATARS_DIR.mkdir(parents=True, exist_ok=True)
-        app.logger.info(f"upload_avatar: AVATARS_DIR={AVATARS_DIR}")
         
-        file_path = AVATARS_DIR / unique_filename
-        
-        # Traitement selon l'extension (éviter d'enregistrer du JPEG avec une extension PNG/WebP)
-        if ext in ('jpg', 'jpeg', 'png'):
-            try:
-                from PIL import Image
-                # Ouvrir l'image
-                img = Image.open(file)
-                # Redimensionner à 200x200 max, conserver proportions
-                img.thumbnail((200, 200), Image.Resampling.LANCZOS)
-                # Choisir le format de sortie cohérent avec l'extension
-                if ext in ('jpg', 'jpeg'):
-                    # JPEG n'accepte pas l'alpha
-                    if img.mode in ('RGBA', 'P'):
-                        img = img.convert('RGB')
-                    img.save(str(file_path), 'JPEG', quality=85, optimize=True)
-                elif ext == 'png':
-                    # Préserver alpha si présent
-                    img.save(str(file_path), 'PNG', optimize=True)
-            except ImportError:
-                # Pillow indisponible: sauvegarde brute
-                file.save(str(file_path))
-            except Exception as e:
-                # Tout autre problème d'image -> tentative de sauvegarde brute puis rapport détaillé si échec
-                try:
-                    file.stream.seek(0, os.SEEK_SET)
-                except Exception:
-                    pass
-                try:
-                    file.save(str(file_path))
-                except Exception as save_err:
-                    return jsonify({'error': f"Erreur lors de l’enregistrement de l'avatar: {save_err} (path={file_path})"}), 500
-        else:
-            # GIF/WEBP: on ne modifie pas pour préserver l'animation/qualité
-            try:
-                file.save(str(file_path))
-            except Exception as e:
-                return jsonify({'error': f"Erreur lors de l’enregistrement de l'avatar: {e} (path={file_path})"}), 500
+        file_path = AVATARS_DIR / unique_filename
+        
+        # Source enregistrée telle quelle : le décodage et les variantes
+        # (WebP multi-tailles) sont produits hors requête par le pool de processus
+        try:
+            file.save(str(file_path))
+        except Exception as e:
+            return jsonify({'error': f"Erreur lors de l’enregistrement de l'avatar: {e} (path={file_path})"}), 500
         
-        # Limite de taille de sécurité pour les sauvegardes brutes
-        max_size = 4 * 1024 * 1024  # 4MB
-        if file_path.stat().st_size > max_size:
+        if file_path.stat().st_size > AVATAR_SOURCE_MAX_SIZE:
             file_path.unlink(missing_ok=True)
-            return jsonify({'error': 'Avatar trop volumineux (max 4MB)'}), 400
+            return jsonify({'error': f'Avatar trop volumineux (max {AVATAR_SOURCE_MAX_SIZE // (1024 * 1024)}MB)'}), 400
+        track_file_added(file_path)
         
-        # Supprimer l'ancien avatar si c'est pas le défaut
+        # Supprimer l'ancien avatar (et ses variantes) si c'est pas le défaut
         if current_user.avatar_filename and current_user.avatar_filename != 'default_avatar.svg':
-            old_path = AVATARS_DIR / current_user.avatar_filename
-            if old_path.exists():
-                try:
-                    old_path.unlink()
-                except:
-                    pass
+            remove_avatar_files(current_user.avatar_filename)
         
         # Mettre à jour l'utilisateur
         current_user.avatar_filename = unique_filename
+        current_user.avatar_variants = None
         db.session.commit()
+        schedule_avatar_variants(current_user.id, unique_filename)
         
         log_action(current_user, ActionType.UPLOAD_FILE, target_id=current_user.id,
                    target_type='avatar', details=f'Nouvel avatar: {unique_filename}')
@@ -2114,76 +3641,97 @@ def upload_avatar():
 
 @app.route('/uploads/avatars/<filename>')
 def serve_avatar(filename):
-    """Sert les avatars"""
+    """Sert les avatars (nom unique par upload : cache immuable)"""
     # Vérifier que le fichier existe
-    file_path = AVATARS_DIR / filename
-    if not file_path.exists():
+    file_path = safe_join(str(AVATARS_DIR), filename)
+    if not file_path or not os.path.isfile(file_path):
         # Servir l'avatar par défaut depuis le dossier static/icons
         fallback_dir = os.path.join(app.static_folder or 'static', 'icons')
-        return send_from_directory(fallback_dir, 'default_avatar.svg')
-    return send_from_directory(str(AVATARS_DIR), filename)
+        return send_from_directory(fallback_dir, 'default_avatar.svg', max_age=DEFAULT_AVATAR_MAX_AGE)
+    return deliver_file(file_path, immutable=True, public=True)
 
 @app.route('/uploads/banners/<filename>')
 def serve_banner(filename):
-    """Sert les bannières"""
+    """Sert les bannières (nom unique par upload : cache immuable)"""
     # Vérifier que le fichier existe
-    file_path = BANNERS_DIR / filename
-    if not file_path.exists():
+    file_path = safe_join(str(BANNERS_DIR), filename)
+    if not file_path or not os.path.isfile(file_path):
         return jsonify({'error': 'Bannière non trouvée'}), 404
-    return send_from_directory(str(BANNERS_DIR), filename)
+    return deliver_file(file_path, immutable=True, public=True)
+
+def _immutable_cache_control(public):
+    scope = 'public' if public else 'private'
+    return f"{scope}, max-age={IMMUTABLE_CACHE_MAX_AGE}, immutable"
+
+def deliver_file(path, download_name=None, etag=None, immutable=False, public=False):
+    """Envoie un fichier selon FILE_DELIVERY_MODE, avec validateurs HTTP.
+
+    send_file gère Range (206), If-Range, If-None-Match et If-Modified-Since ;
+    l'ETag fort est l'empreinte du contenu si connue, sinon mtime/taille.
+    Les ressources à nom unique sont marquées immuables.
+
+    En mode 'x-accel', seul l'en-tête est produit : nginx sert le corps (et les
+    plages) depuis l'emplacement interne X_ACCEL_PREFIX (alias de UPLOADS_DIR).
+    'x-sendfile' est géré par Flask (USE_X_SENDFILE). Sinon send_file passe par
+    wsgi.file_wrapper (sendfile) quand le serveur le fournit.
+    """
+    if FILE_DELIVERY_MODE == 'x-accel':
+        try:
+            relative = Path(path).resolve().relative_to(Path(UPLOADS_DIR).resolve())
+        except ValueError:
+            relative = None
+        if relative is not None:
+            name = download_name or Path(path).name
+            response = Response(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            try:
+                name.encode('latin-1')
+                response.headers.set('Content-Disposition', 'inline', filename=name)
+            except UnicodeEncodeError:
+                response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(name)}"
+            response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative.as_posix())
+            if immutable:
+                response.headers['Cache-Control'] = _immutable_cache_control(public)
+            return response
+    response = send_file(
+        path,
+        download_name=download_name,
+        conditional=True,
+        etag=etag or True,
+        max_age=IMMUTABLE_CACHE_MAX_AGE if immutable else None
+    )
+    if immutable:
+        response.headers['Cache-Control'] = _immutable_cache_control(public)
+    return response
 
 @app.route('/uploads/files/<path:filename>')
 def serve_file(filename):
-    """Sert les fichiers uploadés avec le nom original préservé"""
+    """Sert les fichiers uploadés avec le nom original préservé.
+
+    URL canonique : /uploads/files/<id> (clé primaire). Les anciennes URL par
+    chemin relatif sont résolues par égalité sur la colonne indexée filename.
+    """
     from urllib.parse import unquote
-    from pathlib import Path
     
-    # Tentative 1: Chercher par ID (UUID) dans la base de données
-    file_record = FileAttachment.query.get(filename)
+    if '/' not in filename:
+        file_record = db.session.get(FileAttachment, filename)
+    else:
+        file_record = FileAttachment.query.filter_by(filename=filename).first()
     
     if file_record:
-        # Le filename était l'UUID du fichier
-        file_path = file_record.file_path
-        original_name = unquote(file_record.original_filename)
-        
-        # Vérifier si le fichier existe physiquement
-        if os.path.exists(file_path):
-            file_dir = os.path.dirname(file_path)
-            actual_filename = os.path.basename(file_path)
-            return send_from_directory(
-                file_dir, 
-                actual_filename,
-                download_name=original_name
-            )
-        else:
+        if not os.path.exists(file_record.file_path):
             return jsonify({'error': 'Fichier non trouvé sur le serveur'}), 404
+        # Le contenu d'une pièce jointe ne change jamais : cache immuable, ETag = empreinte
+        return deliver_file(file_record.file_path, download_name=unquote(file_record.original_filename),
+                            etag=file_record.content_hash, immutable=True)
     
-    # Tentative 2: Chercher par filename dans la base de données
-    # Le filename peut contenir des slashes, donc on cherche par like
-    file_record = FileAttachment.query.filter(FileAttachment.filename.endswith(filename.replace('/', '%'))).first()
-    
-    if file_record and os.path.exists(file_record.file_path):
-        file_dir = os.path.dirname(file_record.file_path)
-        actual_filename = os.path.basename(file_record.file_path)
-        original_name = unquote(file_record.original_filename)
-        return send_from_directory(
-            file_dir, 
-            actual_filename,
-            download_name=original_name
-        )
-    
-    # Tentative 3: Servir directement depuis FILES_DIR (chemin simple sans sous-dossiers)
-    # Nettoyer le filename et essayer de le trouver
-    clean_filename = filename.split('/')[-1]  # Prendre juste le nom du fichier
-    direct_path = FILES_DIR / clean_filename
-    if os.path.exists(str(direct_path)):
-        return send_from_directory(str(FILES_DIR), clean_filename, download_name=clean_filename)
-    
-    # Tentative 4: Essayer avec le chemin complet dans FILES_DIR
-    if os.path.exists(str(FILES_DIR / filename)):
-        return send_from_directory(str(FILES_DIR), filename)
+    # Fichier présent sur disque sans enregistrement (anciens dépôts manuels)
+    try:
+        direct_path = safe_join(str(FILES_DIR), filename)
+    except Exception:
+        direct_path = None
+    if direct_path and os.path.isfile(direct_path):
+        return deliver_file(direct_path)
     
-    # Aucune méthode n'a fonctionné
     return jsonify({'error': 'Fichier non trouvé'}), 404
 
 @app.route('/api/files/history', methods=['GET'])
@@ -2424,6 +3972,167 @@ def kick_user(user_id):
         'redirect_url': redirect_url
     })
 
+# ============================================
+# MODÉRATION DE MASSE (RAIDS)
+# ============================================
+BULK_MODERATION_ACTIONS = {'ban', 'mute', 'shadowban', 'kick'}
+
+def _parse_iso_datetime(value):
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    # Les dates sont stockées en UTC naïf côté SQLite
+    if dt.tzinfo:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+def resolve_bulk_targets(selector):
+    """Résout la liste des comptes visés en une seule requête.
+
+    selector accepte : user_ids, ip (dernière IP connue), created_after/created_before,
+    seen_after/seen_before. Les critères fournis sont combinés (ET logique).
+    """
+    query = User.query
+    has_criteria = False
+    user_ids = selector.get('user_ids')
+    if user_ids:
+        query = query.filter(User.id.in_(user_ids))
+        has_criteria = True
+    ip = (selector.get('ip') or '').strip()
+    if ip:
+        query = query.filter(User.last_ip == ip)
+        has_criteria = True
+    for key, column, op in (
+        ('created_after', User.created_at, '>='),
+        ('created_before', User.created_at, '<'),
+        ('seen_after', User.last_seen, '>='),
+        ('seen_before', User.last_seen, '<'),
+    ):
+        bound = _parse_iso_datetime(selector.get(key))
+        if bound is None:
+            continue
+        query = query.filter(column >= bound if op == '>=' else column < bound)
+        has_criteria = True
+    if not has_criteria:
+        return None
+    return query.limit(BULK_MODERATION_MAX_TARGETS + 1).all()
+
+def apply_bulk_moderation(actor, action, selector, options=None):
+    """Applique ban/mute/shadowban/kick à un ensemble de comptes.
+
+    Une seule transaction, une seule requête de présence, une seule diffusion
+    agrégée et un seul enregistrement d'audit récapitulatif.
+    Retourne (résultat, erreur).
+    """
+    options = options or {}
+    if not isinstance(options, dict) or not isinstance(selector, dict):
+        return None, 'Données invalides'
+    user_ids = selector.get('user_ids')
+    if user_ids is not None and (not isinstance(user_ids, list)
+                                 or not all(isinstance(u, str) for u in user_ids)):
+        return None, 'Liste de comptes invalide'
+    if action not in BULK_MODERATION_ACTIONS:
+        return None, 'Action invalide'
+    targets = resolve_bulk_targets(selector)
+    if targets is None:
+        return None, 'Aucun critère de sélection fourni'
+    if len(targets) > BULK_MODERATION_MAX_TARGETS:
+        return None, f'Trop de comptes visés (max {BULK_MODERATION_MAX_TARGETS})'
+    
+    skipped = []
+    affected = []
+    for user in targets:
+        if user.id == actor.id or (user.is_supreme and not actor.is_supreme):
+            skipped.append(user.id)
+        else:
+            affected.append(user)
+    
+    reason = options.get('reason') or 'Action de modération de masse'
+    mute_until = None
+    if action == 'mute':
+        seconds = options.get('seconds', 0) or 0
+        try:
+            seconds = int(seconds) if not isinstance(seconds, bool) else 0
+        except (TypeError, ValueError):
+            seconds = 0
+        if seconds <= 0:
+            return None, 'Durée invalide'
+        mute_until = get_current_utc_time() + timedelta(seconds=seconds)
+    
+    try:
+        for user in affected:
+            if action == 'ban':
+                user.set_ban_info(reason, actor.id)
+            elif action == 'mute':
+                user.mute_until = mute_until
+            elif action == 'shadowban':
+                user.is_shadowbanned = True
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return None, f'Erreur lors de la modération de masse: {e}'
+    
+    affected_ids = [u.id for u in affected]
+    presences = OnlinePresence.query.filter(OnlinePresence.user_id.in_(affected_ids)).all() if affected_ids else []
+    mute_until_int = int(mute_until.timestamp()) if mute_until else None
+    for user_id in affected_ids:
+        if action == 'mute':
+            _ANTISPAM_MUTES[user_id] = mute_until_int
+            socketio.emit('mute_state', {'mute_until': mute_until_int}, room=f"user_{user_id}")
+    for presence in presences:
+        if action == 'ban':
+            socketio.emit('banned', {'reason': reason, 'banned_by': actor.username}, room=presence.socket_id)
+            safe_disconnect(presence.socket_id)
+        elif action == 'kick':
+            socketio.emit('kicked', {
+                'reason': reason,
+                'redirect_url': options.get('redirect_url') or '/login'
+            }, room=presence.socket_id)
+            safe_disconnect(presence.socket_id)
+    
+    # Diffusion agrégée (une seule pour tout le lot)
+    if affected_ids and action in ('ban', 'kick'):
+        socketio.emit('users_bulk_moderated', {
+            'action': action,
+            'user_ids': affected_ids,
+            'usernames': {u.id: u.username for u in affected},
+            'reason': reason,
+            'performed_by': actor.username
+        })
+    
+    criteria = {k: v for k, v in selector.items() if k != 'user_ids' and v}
+    if selector.get('user_ids'):
+        criteria['user_ids'] = len(selector['user_ids'])
+    log_action(actor, ActionType.BULK_MODERATION, target_type='users',
+               details=f'{action} de masse: {len(affected_ids)} comptes '
+                       f'({len(skipped)} ignorés) critères={json.dumps(criteria, ensure_ascii=False)} '
+                       f'ids={",".join(affected_ids)}')
+    
+    return {
+        'action': action,
+        'affected': affected_ids,
+        'skipped': skipped,
+        'count': len(affected_ids),
+    }, None
+
+@app.route('/api/admin/users/bulk', methods=['POST'])
+@admin_required
+def bulk_moderate_users():
+    """Modération de masse : ban, mute, shadowban ou kick d'une liste de comptes"""
+    data = request.get_json(silent=True) or {}
+    result, error = apply_bulk_moderation(
+        current_user,
+        data.get('action'),
+        data.get('selector') or {},
+        data.get('options') or {}
+    )
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify({'message': f"{result['count']} comptes traités", **result})
+
 @app.route('/api/admin/users/<user_id>/promote', methods=['POST'])
 @admin_required
 def promote_user(user_id):
@@ -2652,19 +4361,154 @@ def unban_ip(ip):
     
     return jsonify({'message': f'IP {ip} débannie'})
 
+# ============================================
+# REQUÊTES DU JOURNAL D'AUDIT
+# ============================================
+AUDIT_PAGE_SIZE = 50
+AUDIT_EXPORT_CHUNK = 1000
+AUDIT_HIGH_SEVERITY = ['BAN_USER', 'BAN_IP', 'DELETE_MESSAGE', 'KICK']
+AUDIT_MEDIUM_SEVERITY = ['PROMOTE', 'DEMOTE', 'EDIT_MESSAGE', 'SHADOWBAN']
+
+# Liste des types d'action : chargée une fois puis alimentée par log_action
+_AUDIT_ACTION_TYPES = None
+
+def get_audit_action_types():
+    global _AUDIT_ACTION_TYPES
+    if _AUDIT_ACTION_TYPES is None:
+        rows = db.session.query(AuditLog.action_type).distinct().all()
+        _AUDIT_ACTION_TYPES = {r[0] for r in rows if r[0]}
+    return sorted(_AUDIT_ACTION_TYPES)
+
+def _parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def _encode_keyset_cursor(created_at, row_id):
+    """Curseur opaque (horodatage, id) pour la pagination par clé"""
+    raw = f"{created_at.isoformat()}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def _decode_keyset_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        ts, row_id = raw.split('|', 1)
+        return datetime.fromisoformat(ts), row_id
+    except Exception:
+        return None
+
+def build_audit_query(args, columns=None):
+    """Construit la requête filtrée du journal d'audit.
+
+    Les dates sont converties en intervalles semi-ouverts [début, fin+1j[
+    afin que l'index sur created_at reste utilisable.
+    """
+    query = db.session.query(*columns) if columns else AuditLog.query
+    action_filter = args.get('action')
+    actor_filter = args.get('actor')
+    severity_filter = args.get('severity')
+    start = _parse_day(args.get('start_date'))
+    end = _parse_day(args.get('end_date'))
+    
+    if action_filter:
+        query = query.filter(AuditLog.action_type == action_filter)
+    if actor_filter:
+        actor_ids = db.select(User.id).where(User.username == actor_filter).scalar_subquery()
+        query = query.filter(AuditLog.actor_id == actor_ids)
+    if severity_filter == 'high':
+        query = query.filter(AuditLog.action_type.in_(AUDIT_HIGH_SEVERITY))
+    elif severity_filter == 'medium':
+        query = query.filter(AuditLog.action_type.in_(AUDIT_MEDIUM_SEVERITY))
+    if start:
+        query = query.filter(AuditLog.created_at >= start)
+    if end:
+        query = query.filter(AuditLog.created_at < end + timedelta(days=1))
+    return query
+
+def _audit_keyset_page(query, before=None, after=None, limit=AUDIT_PAGE_SIZE):
+    """Pagination par curseur (created_at, id) : aucune requête COUNT"""
+    if after:
+        ts, log_id = after
+        query = query.filter(db.or_(
+            AuditLog.created_at > ts,
+            db.and_(AuditLog.created_at == ts, AuditLog.id > log_id)
+        )).order_by(AuditLog.created_at.asc(), AuditLog.id.asc())
+        rows = query.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        return list(reversed(rows[:limit])), has_more
+    if before:
+        ts, log_id = before
+        query = query.filter(db.or_(
+            AuditLog.created_at < ts,
+            db.and_(AuditLog.created_at == ts, AuditLog.id < log_id)
+        ))
+    rows = query.order_by(AuditLog.created_at.desc(), AuditLog.id.desc()).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
 @app.route('/api/admin/logs', methods=['GET'])
 @admin_required
 def get_logs():
-    """Récupère le journal d'audit"""
-    page = int(request.args.get('page', 1))
-    per_page = 50
-    
-    logs = AuditLog.query.order_by(AuditLog.created_at.desc())\
-        .offset((page - 1) * per_page).limit(per_page).all()
+    """Récupère le journal d'audit (pagination par curseur)"""
+    before = _decode_keyset_cursor(request.args.get('cursor', ''))
+    try:
+        limit = max(1, min(int(request.args.get('limit', AUDIT_PAGE_SIZE)), 500))
+    except (TypeError, ValueError):
+        limit = AUDIT_PAGE_SIZE
+    logs, has_more = _audit_keyset_page(build_audit_query(request.args), before=before, limit=limit)
     
     return jsonify({
         'logs': [l.to_dict() for l in logs],
-        'page': page
+        'next_cursor': _encode_keyset_cursor(logs[-1].created_at, logs[-1].id) if logs and has_more else None,
+        'has_more': has_more
+    })
+
+@app.route('/api/admin/logs/export', methods=['GET'])
+@admin_required
+def export_logs():
+    """Export en flux (CSV ou NDJSON) du journal d'audit, mémoire constante"""
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Format invalide (csv ou ndjson)'}), 400
+    args = request.args.to_dict()
+    columns = (
+        AuditLog.id, AuditLog.created_at, AuditLog.actor_id, User.username,
+        AuditLog.action_type, AuditLog.target_id, AuditLog.target_type,
+        AuditLog.details, AuditLog.ip_address,
+    )
+    fields = ['id', 'created_at', 'actor_id', 'actor', 'action_type',
+              'target_id', 'target_type', 'details', 'ip_address']
+    
+    def generate():
+        if fmt == 'csv':
+            buf = io.StringIO()
+            csv.writer(buf).writerow(fields)
+            yield buf.getvalue()
+        cursor = None
+        while True:
+            query = build_audit_query(args, columns=columns)\
+                .outerjoin(User, User.id == AuditLog.actor_id)
+            rows, has_more = _audit_keyset_page(query, before=cursor, limit=AUDIT_EXPORT_CHUNK)
+            if not rows:
+                break
+            buf = io.StringIO()
+            writer = csv.writer(buf) if fmt == 'csv' else None
+            for row in rows:
+                values = list(row)
+                values[1] = values[1].isoformat() if values[1] else None
+                if writer:
+                    writer.writerow(values)
+                else:
+                    buf.write(json.dumps(dict(zip(fields, values)), ensure_ascii=False) + '\n')
+            yield buf.getvalue()
+            if not has_more:
+                break
+            cursor = (rows[-1][1], rows[-1][0])
+    
+    ts = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=kronos_audit_{ts}.{fmt}'
     })
 
 @app.route('/api/admin/stats', methods=['GET'])
@@ -2672,42 +4516,36 @@ def get_logs():
 def get_stats():
     """Statistiques du serveur"""
     try:
-        user_count = User.query.count()
-        channel_count = Channel.query.count()
-        message_count = Message.query.count()
-        file_count = FileAttachment.query.count()
-        
-        # Calculer l'espace disque utilisé avec gestion d'erreurs
-        total_size = 0
-        try:
-            for path in [UPLOADS_DIR, DATA_DIR]:
-                if path.exists() and path.is_dir():
-                    for root, dirs, files in os.walk(path):
-                        for f in files:
-                            try:
-                                file_full_path = os.path.join(root, f)
-                                if os.path.exists(file_full_path):
-                                    total_size += os.path.getsize(file_full_path)
-                            except (PermissionError, OSError):
-                                continue
-        except (PermissionError, OSError):
-            pass  # Ignorer les erreurs de permissions pour les stats
+        # Totaux maintenus en continu : aucun parcours disque ni COUNT sur les grosses tables
+        start_storage_reconciler()
+        totals = get_storage_totals()
         
         online_count = OnlinePresence.query.filter(
             OnlinePresence.last_ping > datetime.now(timezone.utc) - timedelta(minutes=5)
         ).count()
         
         return jsonify({
-            'users': user_count,
-            'channels': channel_count,
-            'messages': message_count,
-            'files': file_count,
-            'disk_used': total_size,
-            'online_users': online_count
+            'users': totals['users'],
+            'channels': totals['channels'],
+            'messages': totals['messages'],
+            'files': totals['files'],
+            'disk_used': totals['disk_used'],
+            'online_users': online_count,
+            'storage': totals,
+            'audit_log': get_audit_metrics(),
+            'blob_dedup': dict(_BLOB_MIGRATION_STATE),
+            'thumbnails': get_thumbnail_metrics(),
+            'sqlite': get_sqlite_profile_status()
         })
     except Exception as e:
         return jsonify({'error': str(e), 'users': 0, 'channels': 0, 'messages': 0, 'files': 0, 'disk_used': 0, 'online_users': 0})
 
+@app.route('/api/admin/socket-rate-limits', methods=['GET'])
+@admin_required
+def get_socket_rate_limits():
+    """Compteurs d'événements Socket.IO rejetés par le limiteur de débit"""
+    return jsonify(get_socket_rate_stats())
+
 # ============================================
 # SOCKET.IO - TEMPS RÉEL
 # ============================================
@@ -2754,7 +4592,7 @@ def handle_connect(auth=None):
     # =================================================================
     # L'utilisateur devient automatiquement admin si :
     # 1. Son IP correspond à l'IP du serveur (localhost ou IP configurée)
-    # 2. Ou si ADMIN_SUPREME_IP est configuré et correspond
+    # 2. Ou si KRONOS_ADMIN_IP est configuré et correspond
     
     is_auto_admin = False
     auto_admin_reason = None
@@ -2769,12 +4607,13 @@ def handle_connect(auth=None):
             is_auto_admin = True
             auto_admin_reason = "IP locale du serveur"
     
-    # Vérifier si l'IP correspond à ADMIN_SUPREME_IP dans la config
-    if ADMIN_SUPREME_IP and ip == ADMIN_SUPREME_IP:
+    # Vérifier si l'IP correspond à KRONOS_ADMIN_IP dans la config
+    admin_supreme_ip = get_admin_supreme_ip()
+    if admin_supreme_ip and ip == admin_supreme_ip:
         if current_user.role != UserRole.SUPREME:
             current_user.role = UserRole.SUPREME
             is_auto_admin = True
-            auto_admin_reason = f"IP Admin Suprême ({ADMIN_SUPREME_IP})"
+            auto_admin_reason = f"IP Admin Suprême ({admin_supreme_ip})"
     
     if is_auto_admin:
         db.session.commit()
@@ -2960,6 +4799,9 @@ def handle_join_channel(data):
         presence.current_channel = channel_id
         db.session.commit()
     
+    # Ouvrir le salon revient à le lire jusqu'au dernier message
+    advance_read_cursor(current_user.id, channel_id)
+    
     # Conversion en string pour garantir la cohérence
     join_room(str(channel_id))
     emit('joined_channel', {'channel_id': channel_id, 'user': current_user.to_dict()})
@@ -3306,11 +5148,11 @@ def _bs_emit_state(gs, room, role=None, extra=None):
         if gs.p1_id:
             u1 = db.session.get(User, gs.p1_id)
             if u1:
-                p1 = {'id': u1.id, 'username': u1.username, 'display_name': u1.display_name or u1.username, 'avatar': u1.get_avatar_url()}
+                p1 = {'id': u1.id, 'username': u1.username, 'display_name': u1.display_name or u1.username, 'avatar': u1.get_avatar_url(64)}
         if gs.p2_id:
             u2 = db.session.get(User, gs.p2_id)
             if u2:
-                p2 = {'id': u2.id, 'username': u2.username, 'display_name': u2.display_name or u2.username, 'avatar': u2.get_avatar_url()}
+                p2 = {'id': u2.id, 'username': u2.username, 'display_name': u2.display_name or u2.username, 'avatar': u2.get_avatar_url(64)}
     except Exception:
         pass
     payload = {
@@ -3354,7 +5196,7 @@ def _bs_get_display_identity(current_user_id, p1_id, p2_id):
                         'id': u.id,
                         'username': u.username,
                         'display_name': u.display_name or u.username,
-                        'avatar': u.get_avatar_url()
+                        'avatar': u.get_avatar_url(64)
                     }
         if current_user_id == p1_id:
             left = users_map.get(p1_id)
@@ -3698,7 +5540,7 @@ def bs_chat(data):
     user = db.session.get(User, uid)
     user_payload = None
     if user:
-        user_payload = {'id': user.id, 'username': user.username, 'display_name': user.display_name or user.username, 'avatar': user.get_avatar_url()}
+        user_payload = {'id': user.id, 'username': user.username, 'display_name': user.display_name or user.username, 'avatar': user.get_avatar_url(64)}
     payload = {'code': code, 'from': role, 'user': user_payload, 'message': msg[:300]}
     socketio.emit('bs_chat', payload, room=f'bs_{code}')
 
@@ -3736,21 +5578,10 @@ def handle_send_message(data):
             target_user = db.session.get(User, dm_target_user_id)
             if not target_user or not target_user.is_active:
                 return {'status': 'error', 'message': 'Utilisateur cible invalide'}
-            dm_channel = _find_dm_channel(current_user.id, dm_target_user_id)
+            dm_channel, created = get_or_create_dm_channel(current_user, target_user)
             if not dm_channel:
-                dm_channel = Channel(
-                    name=f"DM-{current_user.username}-{target_user.username}",
-                    description=None,
-                    channel_type=ChannelType.DM,
-                    category="Privé"
-                )
-                db.session.add(dm_channel)
-                db.session.commit()
-                p1 = ChannelParticipant(channel_id=dm_channel.id, user_id=current_user.id)
-                p2 = ChannelParticipant(channel_id=dm_channel.id, user_id=target_user.id)
-                db.session.add(p1)
-                db.session.add(p2)
-                db.session.commit()
+                return {'status': 'error', 'message': 'Conversation introuvable'}
+            if created:
                 join_room(str(dm_channel.id))
                 emit('dm_conversation_created', {
                     'channel': dm_channel.to_dict(),
@@ -3826,6 +5657,12 @@ def handle_send_message(data):
                     print(f"[ANTISPAM] Error notifying client: {e}")
                     return {'status': 'error', 'message': 'Anti-spam'}
         
+        # Filtre de contenu partagé avec NicknameValidator
+        content, filter_error = filter_message_content(content)
+        if filter_error:
+            emit('content_filtered', {'message': filter_error}, room=request.sid)
+            return {'status': 'error', 'message': filter_error}
+        
         # ROBUSTESSE : Rejoindre le salon pour être sûr de recevoir les événements
         # Cela corrige le bug où l'utilisateur n'est pas dans la room s'il n'a pas fait join_channel explicitement
         # Conversion en string pour garantir la cohérence
@@ -3847,6 +5684,9 @@ def handle_send_message(data):
             content=content,
             reply_to_id=reply_to_id
         )
+        # Un message shadowbanni ne doit pas apparaître dans les non-lus des autres
+        if not is_shadowbanned:
+            message.seq = next_channel_seq(channel_id)
         
         db.session.add(message)
         db.session.commit()
@@ -3877,6 +5717,8 @@ def handle_send_message(data):
                     mentioned_ids = [u.id for u in users_mentioned if u and u.id]
             if mentioned_ids:
                 message_dict['mentioned_user_ids'] = mentioned_ids
+                if not is_shadowbanned:
+                    increment_mentions(channel_id, [uid for uid in mentioned_ids if uid != current_user.id])
         except Exception as e:
             print(f"[DEBUG] Mention parsing error: {e}")
         if client_id:
@@ -3889,6 +5731,8 @@ def handle_send_message(data):
         )
         db.session.add(read_receipt)
         db.session.commit()
+        if message.seq:
+            advance_read_cursor(current_user.id, channel_id, message.seq)
         
         if is_shadowbanned:
             # =================================================================
@@ -3908,6 +5752,9 @@ def handle_send_message(data):
                             'shadowbanned_user': current_user.to_dict()
                         }, room=admin_presence.socket_id)
             
+            if channel.channel_type == ChannelType.DM:
+                record_dm_activity(channel_id, message, user_id=current_user.id)
+            
             # Log pour audit
             log_action(current_user, 'SHADOWBAN_MESSAGE', target_id=message.id,
                        target_type='message', details=f'Message shadowbanni dans #{channel.name}')
@@ -3918,24 +5765,20 @@ def handle_send_message(data):
             
             # Mettre à jour la liste des conversations privées pour les participants
             if channel.channel_type == ChannelType.DM:
-                participants = ChannelParticipant.query.filter_by(channel_id=channel_id).all()
-                for p in participants:
-                    user = db.session.get(User, p.user_id)
-                    if user:
-                        other_user = None
-                        if user.id != current_user.id:
-                            other_user = current_user.to_dict(include_sensitive=False)
-                        else:
-                            other_user_id = next((pp.user_id for pp in participants if pp.user_id != user.id), None)
-                            if other_user_id:
-                                other = db.session.get(User, other_user_id)
-                                if other:
-                                    other_user = other.to_dict(include_sensitive=False)
-                        emit('dm_conversation_updated', {
-                            'channel': channel.to_dict(),
-                            'other_user': other_user,
-                            'last_message': message_dict
-                        }, room=f"user_{user.id}")
+                record_dm_activity(channel_id, message)
+                dm_entry = get_dm_participants(channel)
+                profiles = dm_entry['profiles']
+                sender_profile = profiles.get(current_user.id) or current_user.to_dict(include_sensitive=False)
+                for user_id in profiles:
+                    if user_id != current_user.id:
+                        other_user = sender_profile
+                    else:
+                        other_user = next((prof for uid, prof in profiles.items() if uid != user_id), None)
+                    emit('dm_conversation_updated', {
+                        'channel': dm_entry['channel'],
+                        'other_user': other_user,
+                        'last_message': message_dict
+                    }, room=f"user_{user_id}")
             
             # =================================================================
             # ÉVÉNEMENT TEMPS RÉEL POUR L'HISTORIQUE DES FICHIERS
@@ -4005,6 +5848,11 @@ def handle_edit_message(data):
         emit('error', {'message': 'Ce message a été supprimé'})
         return
     
+    new_content, filter_error = filter_message_content(new_content)
+    if filter_error:
+        emit('error', {'message': filter_error})
+        return
+    
     # Stocker l'ancien contenu pour l'historique
     old_content = message.content
     
@@ -4284,6 +6132,31 @@ def handle_admin_action(data):
     else:
         emit('error', {'message': f'Action inconnue: {action}'})
 
+@socketio.on('admin_bulk_action')
+def handle_admin_bulk_action(data):
+    """Version Socket.IO de la modération de masse (anti-raid)"""
+    if not current_user.is_admin:
+        emit('error', {'message': 'Droits administrateur requis'})
+        return
+    data = data or {}
+    result, error = apply_bulk_moderation(
+        current_user,
+        data.get('action'),
+        data.get('selector') or {},
+        data.get('options') or {}
+    )
+    if error:
+        emit('error', {'message': error})
+        return {'status': 'error', 'message': error}
+    emit('admin_action_complete', {
+        'action': f"bulk_{result['action']}",
+        'success': True,
+        'affected': result['affected'],
+        'skipped': result['skipped'],
+        'message': f"{result['count']} comptes traités"
+    })
+    return {'status': 'ok', 'data': result}
+
 @socketio.on('typing')
 def handle_typing(data):
     """Indicateur de frappe"""
@@ -4333,6 +6206,8 @@ def handle_mark_read(data):
     # Notifier l'auteur du message
     message = Message.query.get(message_id)
     if message:
+        if message.seq:
+            advance_read_cursor(current_user.id, message.channel_id, message.seq)
         emit('message_read', {
             'message_id': message_id,
             'reader_id': current_user.id,
@@ -4729,39 +6604,22 @@ def logs_page():
     if not current_user.is_admin:
         abort(403)
         
-    page = request.args.get('page', 1, type=int)
-    action_filter = request.args.get('action')
-    actor_filter = request.args.get('actor')
-    severity_filter = request.args.get('severity')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    
-    query = AuditLog.query
-    
-    if action_filter:
-        query = query.filter(AuditLog.action_type == action_filter)
-        
-    if actor_filter:
-        actor = User.query.filter_by(username=actor_filter).first()
-        if actor:
-            query = query.filter(AuditLog.actor_id == actor.id)
-            
-    if severity_filter == 'high':
-        query = query.filter(AuditLog.action_type.in_(['BAN_USER', 'BAN_IP', 'DELETE_MESSAGE', 'KICK']))
-    elif severity_filter == 'medium':
-        query = query.filter(AuditLog.action_type.in_(['PROMOTE', 'DEMOTE', 'EDIT_MESSAGE', 'SHADOWBAN']))
-        
-    if start_date:
-        query = query.filter(db.func.date(AuditLog.created_at) >= start_date)
-    if end_date:
-        query = query.filter(db.func.date(AuditLog.created_at) <= end_date)
-            
-    pagination = query.order_by(AuditLog.created_at.desc()).paginate(page=page, per_page=50)
-    
-    action_types = db.session.query(AuditLog.action_type).distinct().all()
-    action_types = [a[0] for a in action_types]
-    
-    return render_template('logs.html', pagination=pagination, action_types=action_types, theme=THEME)
+    before = _decode_keyset_cursor(request.args.get('before', ''))
+    after = _decode_keyset_cursor(request.args.get('after', ''))
+    query = build_audit_query(request.args).options(joinedload(AuditLog.actor))
+    logs, has_more = _audit_keyset_page(query, before=before, after=after)
+    
+    # Curseurs de navigation (pas de COUNT sur l'ensemble filtré)
+    filter_args = {k: v for k, v in request.args.items() if k not in ('before', 'after') and v}
+    next_cursor = prev_cursor = None
+    if logs:
+        if has_more or after:
+            next_cursor = _encode_keyset_cursor(logs[-1].created_at, logs[-1].id)
+        if before or (after and has_more):
+            prev_cursor = _encode_keyset_cursor(logs[0].created_at, logs[0].id)
+    
+    return render_template('logs.html', logs=logs, next_cursor=next_cursor, prev_cursor=prev_cursor,
+                           filter_args=filter_args, action_types=get_audit_action_types(), theme=THEME)
 
 @app.route('/membre')
 @guest_allowed
@@ -4796,88 +6654,667 @@ def user_profile_by_id(user_id):
     
     return render_template('profile.html', user=user, stats=stats, theme=THEME)
 
+# ============================================
+# GALERIE DE FICHIERS (AGRÉGATS + PAGINATION PAR CLÉ)
+# ============================================
+GALLERY_PAGE_SIZE = 100
+GALLERY_FACETS_TTL = 300
+# Regroupement des valeurs de file_type en catégories de filtre
+GALLERY_TYPE_GROUPS = {
+    'image': ('image', 'gif'),
+    'video': ('video',),
+    'document': ('document', 'pdf'),
+    'audio': ('audio',),
+}
+_GALLERY_FACETS = {'data': None, 'expires': 0.0}
+_GALLERY_FACETS_LOCK = threading.Lock()
+
+def invalidate_gallery_facets():
+    with _GALLERY_FACETS_LOCK:
+        _GALLERY_FACETS['data'] = None
+
+def get_gallery_facets():
+    """Comptes par type, uploadeurs et extensions, mis en cache GALLERY_FACETS_TTL secondes"""
+    with _GALLERY_FACETS_LOCK:
+        if _GALLERY_FACETS['data'] is not None and _GALLERY_FACETS['expires'] > time.monotonic():
+            return _GALLERY_FACETS['data']
+    by_type = dict(
+        db.session.query(FileAttachment.file_type, db.func.count(FileAttachment.id))
+        .group_by(FileAttachment.file_type).all()
+    )
+    counts = {'all': sum(by_type.values())}
+    for group, types in GALLERY_TYPE_GROUPS.items():
+        counts[group] = sum(by_type.get(t, 0) for t in types)
+    uploader_ids = db.session.query(FileAttachment.uploader_id).distinct()
+    uploaders = [
+        {'id': u.id, 'username': u.username}
+        for u in User.query.filter(User.id.in_(uploader_ids)).order_by(User.username).all()
+    ]
+    # Extension après le dernier point (comme le filtre ilike('%.ext')) : rtrim retire les
+    # caractères finaux autres que '.', il reste le préfixe jusqu'au dernier point inclus
+    name = FileAttachment.original_filename
+    last_dot_prefix = db.func.rtrim(name, db.func.replace(name, '.', ''))
+    extensions_query = db.session.query(db.func.lower(db.func.substr(name, db.func.length(last_dot_prefix) + 1))) \
+        .filter(name.like('%.%')) \
+        .distinct().all()
+    extensions = sorted({e[0] for e in extensions_query if e[0]})
+    data = {'counts': counts, 'uploaders': uploaders, 'extensions': extensions}
+    with _GALLERY_FACETS_LOCK:
+        _GALLERY_FACETS['data'] = data
+        _GALLERY_FACETS['expires'] = time.monotonic() + GALLERY_FACETS_TTL
+    return data
+
+def build_gallery_query(args):
+    """Filtres uploader / type / extension / période (jours en intervalle semi-ouvert)"""
+    query = FileAttachment.query.options(joinedload(FileAttachment.uploader))
+    uploader = args.get('uploader')
+    if uploader:
+        query = query.filter(FileAttachment.uploader_id.in_(uploader.split(',')))
+    file_type = args.get('type')
+    if file_type and file_type != 'all':
+        query = query.filter(FileAttachment.file_type.in_(GALLERY_TYPE_GROUPS.get(file_type, (file_type,))))
+    ext = (args.get('ext') or '').lower().lstrip('.')
+    if ext:
+        query = query.filter(FileAttachment.original_filename.ilike(f'%.{ext}'))
+    date_from = _parse_day(args.get('date_from'))
+    if date_from:
+        query = query.filter(FileAttachment.created_at >= date_from)
+    date_to = _parse_day(args.get('date_to'))
+    if date_to:
+        query = query.filter(FileAttachment.created_at < date_to + timedelta(days=1))
+    return query
+
+def gallery_page(args, limit=GALLERY_PAGE_SIZE):
+    """Retourne (fichiers, curseur suivant) du plus récent au plus ancien"""
+    query = build_gallery_query(args)
+    cursor = _decode_keyset_cursor(args.get('cursor', ''))
+    if cursor:
+        created_at, file_id = cursor
+        query = query.filter(db.or_(
+            FileAttachment.created_at < created_at,
+            db.and_(FileAttachment.created_at == created_at, FileAttachment.id < file_id)
+        ))
+    files = (
+        query.order_by(FileAttachment.created_at.desc(), FileAttachment.id.desc())
+        .limit(limit + 1).all()
+    )
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = _encode_keyset_cursor(files[-1].created_at, files[-1].id)
+    return files, next_cursor
+
 @app.route('/fichiers')
 @guest_allowed
 def files_gallery():
     """Galerie de fichiers publics"""
-    # Récupérer tous les fichiers pour les filtres initiaux
-    all_files = FileAttachment.query.order_by(FileAttachment.created_at.desc()).all()
-    
-    # Pré-calculer les comptes pour éviter les filtres Jinja2 complexes
-    counts = {
-        'all': len(all_files),
-        'image': len([f for f in all_files if f.file_type and f.file_type.startswith('image/')]),
-        'video': len([f for f in all_files if f.file_type and f.file_type.startswith('video/')]),
-        'document': len([f for f in all_files if f.file_type and (f.file_type.startswith('application/') or f.file_type.startswith('text/'))])
-    }
-    
-    # Récupérer la liste des uploadeurs uniques pour le filtre
-    uploaders = db.session.query(User).join(FileAttachment, User.id == FileAttachment.uploader_id).distinct().all()
-    
-    # Types de fichiers uniques (extensions)
-    extensions_query = db.session.query(db.func.substr(FileAttachment.original_filename, db.func.instr(FileAttachment.original_filename, '.') + 1)) \
-        .filter(FileAttachment.original_filename.like('%.%')) \
-        .distinct().all()
-    extensions = [e[0].lower() for e in extensions_query if e[0]]
+    # Première page seulement ; la suite est chargée via /api/files/gallery
+    files, next_cursor = gallery_page(request.args)
+    facets = get_gallery_facets()
     
     return render_template('files.html', 
-                         files=all_files[:100], # On limite l'affichage initial pour le lazy loading
-                         counts=counts,
-                         uploaders=uploaders,
-                         extensions=sorted(list(set(extensions))),
+                         files=files,
+                         next_cursor=next_cursor,
+                         counts=facets['counts'],
+                         uploaders=facets['uploaders'],
+                         extensions=facets['extensions'],
                          theme=THEME)
 
+@app.route('/api/files/gallery', methods=['GET'])
+@guest_allowed
+def files_gallery_feed():
+    """Flux JSON paginé par clé de la galerie (chargement progressif)"""
+    try:
+        limit = max(1, min(int(request.args.get('limit', GALLERY_PAGE_SIZE)), 200))
+    except (TypeError, ValueError):
+        limit = GALLERY_PAGE_SIZE
+    files, next_cursor = gallery_page(request.args, limit)
+    payload = []
+    for f in files:
+        item = f.to_dict()
+        item['uploader_id'] = f.uploader_id
+        item['file_type'] = f.file_type
+        payload.append(item)
+    return jsonify({'files': payload, 'next_cursor': next_cursor, 'has_more': next_cursor is not None})
+
+@app.route('/api/files/gallery/facets', methods=['GET'])
+@guest_allowed
+def files_gallery_facets():
+    """Comptes par type, uploadeurs et extensions (cache)"""
+    return jsonify(get_gallery_facets())
+
+# ============================================
+# SUPPRESSION MASSIVE DE FICHIERS (TÂCHE EN ARRIÈRE-PLAN)
+# ============================================
+# La requête HTTP ne fait qu'enregistrer un BulkDeleteJob. Un thread supprime
+# ensuite les lignes par transactions de BULK_DELETE_CHUNK_SIZE, efface les
+# fichiers en parallèle une fois le lot validé, et pousse la progression à
+# l'admin demandeur (room user_<id>). Au redémarrage, les tâches encore
+# 'running' reprennent : les lignes déjà supprimées ne ressortent plus du filtre.
+# Un crash entre le commit d'un lot et l'effacement disque laisse au pire des
+# fichiers orphelins, jamais une pièce jointe pointant vers un fichier absent.
+
+BULK_DELETE_FILTERS = ('user', 'type', 'date', 'range', 'all')
+_BULK_DELETE_ACTIVE = set()
+_BULK_DELETE_LOCK = threading.Lock()
+
+def build_bulk_delete_query(job):
+    """Sélection (id, chemin, empreinte) des fichiers visés par la tâche.
+
+    Bornée à created_at <= création de la tâche : une reprise ne supprime pas
+    les fichiers envoyés entre-temps. Lève ValueError si le filtre est invalide.
+    """
+    query = db.select(FileAttachment.id, FileAttachment.file_path, FileAttachment.content_hash).where(
+        FileAttachment.created_at <= job.created_at
+    )
+    if job.filter_type == 'user':
+        query = query.where(FileAttachment.uploader_id == job.filter_value)
+    elif job.filter_type == 'type':
+        query = query.where(FileAttachment.file_type.like(f'%{job.filter_value}%'))
+    elif job.filter_type in ('date', 'range'):
+        start = datetime.strptime(job.filter_value if job.filter_type == 'date' else job.start_date, '%Y-%m-%d')
+        end = datetime.strptime(job.filter_value if job.filter_type == 'date' else job.end_date, '%Y-%m-%d')
+        # Intervalle semi-ouvert [début, fin + 1 jour) : utilisable par l'index created_at
+        query = query.where(FileAttachment.created_at >= start, FileAttachment.created_at < end + timedelta(days=1))
+    elif job.filter_type != 'all':
+        raise ValueError('Filtre invalide')
+    return query
+
+def _emit_bulk_delete_progress(job):
+    socketio.emit('bulk_delete_progress', job.to_dict(), room=f"user_{job.requested_by}")
+
+def delete_attachment_rows(rows):
+    """Supprime des pièces jointes (id, file_path, content_hash) dans la transaction courante.
+
+    Retourne (lignes supprimées, fichiers à effacer, blobs libérés) ; l'appelant
+    valide puis passe le tout à finish_attachment_deletion.
+    """
+    ids = [row.id for row in rows]
+    disk_paths, released_blobs = [], []
+    for row in rows:
+        if row.content_hash:
+            released = release_blob(row.content_hash)
+            if released:
+                released_blobs.append(released)
+        elif row.file_path:
+            disk_paths.append(row.file_path)
+        disk_paths.extend(thumbnail_paths(row.id))
+    uncount_attachments(ids)
+    deleted = db.session.execute(db.delete(FileAttachment).where(FileAttachment.id.in_(ids))).rowcount
+    return deleted, disk_paths, released_blobs
+
+def finish_attachment_deletion(deleted, disk_paths, released_blobs, pool=None):
+    """Après commit : décompte les lignes et efface les fichiers (en parallèle si pool)"""
+    # Suppression ORM contournée : les écouteurs de comptage ne voient pas ces lignes
+    adjust_storage_total('files', -deleted)
+    # Un blob libéré a pu être recréé par un upload concurrent depuis le commit
+    paths = disk_paths + [path for path in released_blobs if db.session.get(FileBlob, Path(path).name) is None]
+    if pool is not None:
+        list(pool.map(remove_tracked_file, paths))
+    else:
+        for path in paths:
+            remove_tracked_file(path)
+    invalidate_gallery_facets()
+
+def run_bulk_delete_job(job_id):
+    """Exécute (ou reprend) une tâche de suppression massive jusqu'à épuisement du filtre"""
+    job = db.session.get(BulkDeleteJob, job_id)
+    if job is None or job.status not in ('pending', 'running'):
+        return
+    query = build_bulk_delete_query(job).order_by(FileAttachment.id).limit(max(1, BULK_DELETE_CHUNK_SIZE))
+    if job.status == 'pending':
+        job.total = db.session.execute(
+            db.select(db.func.count()).select_from(query.limit(None).order_by(None).subquery())
+        ).scalar() or 0
+        job.status = 'running'
+        db.session.commit()
+    _emit_bulk_delete_progress(job)
+
+    with ThreadPoolExecutor(max_workers=max(1, BULK_DELETE_UNLINK_WORKERS)) as unlink_pool:
+        while True:
+            db.session.refresh(job)
+            if job.status == 'cancelled':
+                break
+            rows = db.session.execute(query).all()
+            if not rows:
+                break
+            deleted, disk_paths, released_blobs = delete_attachment_rows(rows)
+            job.deleted_count += deleted
+            job.updated_at = get_current_utc_time()
+            db.session.commit()
+            finish_attachment_deletion(deleted, disk_paths, released_blobs, unlink_pool)
+            _emit_bulk_delete_progress(job)
+
+    if job.status != 'cancelled':
+        job.status = 'done'
+    job.finished_at = get_current_utc_time()
+    job.updated_at = job.finished_at
+    db.session.commit()
+    _emit_bulk_delete_progress(job)
+    log_action(db.session.get(User, job.requested_by), ActionType.DELETE_MESSAGE,
+               target_id=job.id, target_type='bulk_delete_job',
+               details=f'Suppression massive: {job.deleted_count} fichiers (Filtre: {job.filter_type})')
+    print(f"[BULK DELETE] Tâche {job.id} terminée: {job.deleted_count}/{job.total} fichiers")
+
+def start_bulk_delete_job(job_id):
+    """Lance la tâche dans un thread (une seule exécution par tâche)"""
+    with _BULK_DELETE_LOCK:
+        if job_id in _BULK_DELETE_ACTIVE:
+            return
+        _BULK_DELETE_ACTIVE.add(job_id)
+    def worker():
+        try:
+            with app.app_context():
+                try:
+                    run_bulk_delete_job(job_id)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"[BULK DELETE] Erreur tâche {job_id}: {e}")
+                    job = db.session.get(BulkDeleteJob, job_id)
+                    if job is not None:
+                        job.status = 'failed'
+                        job.error = str(e)[:1000]
+                        job.finished_at = get_current_utc_time()
+                        db.session.commit()
+                        _emit_bulk_delete_progress(job)
+                finally:
+                    db.session.remove()
+        finally:
+            with _BULK_DELETE_LOCK:
+                _BULK_DELETE_ACTIVE.discard(job_id)
+    threading.Thread(target=worker, daemon=True).start()
+
+def resume_bulk_delete_jobs():
+    """Relance les tâches interrompues par un arrêt du serveur"""
+    with app.app_context():
+        job_ids = db.session.execute(
+            db.select(BulkDeleteJob.id).where(BulkDeleteJob.status.in_(('pending', 'running')))
+        ).scalars().all()
+    for job_id in job_ids:
+        print(f"[BULK DELETE] Reprise de la tâche {job_id}")
+        start_bulk_delete_job(job_id)
+
 @app.route('/api/admin/files/bulk-delete', methods=['POST'])
 @login_required
 def bulk_delete_files():
-    """Suppression massive de fichiers (Admin Suprême uniquement)"""
+    """Programme une suppression massive de fichiers (Admin Suprême uniquement)"""
     if current_user.role != UserRole.SUPREME:
         return jsonify({'error': 'Accès refusé. Niveau SUPREME requis.'}), 403
     
-    data = request.json
+    data = request.json or {}
     filter_type = data.get('filter_type') # 'user', 'type', 'date', 'range', 'all'
-    filter_value = data.get('filter_value')
-    
-    query = FileAttachment.query
-    
-    if filter_type == 'user':
-        query = query.filter_by(uploader_id=filter_value)
-    elif filter_type == 'type':
-        query = query.filter(FileAttachment.file_type.like(f'%{filter_value}%'))
-    elif filter_type == 'date':
-        target_date = datetime.strptime(filter_value, '%Y-%m-%d').date()
-        query = query.filter(db.func.date(FileAttachment.created_at) == target_date)
-    elif filter_type == 'range':
-        start_date = datetime.strptime(data.get('start_date'), '%Y-%m-%d').date()
-        end_date = datetime.strptime(data.get('end_date'), '%Y-%m-%d').date()
-        query = query.filter(db.func.date(FileAttachment.created_at).between(start_date, end_date))
-    elif filter_type == 'all':
-        pass # Supprimer tout
-    else:
+    if filter_type not in BULK_DELETE_FILTERS:
         return jsonify({'error': 'Filtre invalide'}), 400
     
-    files_to_delete = query.all()
-    deleted_count = 0
-    
-    for f in files_to_delete:
-        try:
-            # Supprimer le fichier physique
-            if os.path.exists(f.file_path):
-                os.remove(f.file_path)
-            if f.thumbnail_path and os.path.exists(f.thumbnail_path):
-                os.remove(f.thumbnail_path)
-            
-            db.session.delete(f)
-            deleted_count += 1
-        except Exception as e:
-            print(f"Erreur lors de la suppression de {f.id}: {e}")
-            
+    job = BulkDeleteJob(
+        requested_by=current_user.id,
+        filter_type=filter_type,
+        filter_value=str(data.get('filter_value') or '')[:255] or None,
+        start_date=data.get('start_date'),
+        end_date=data.get('end_date'),
+    )
+    job.created_at = get_current_utc_time()
+    try:
+        build_bulk_delete_query(job)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Filtre invalide'}), 400
+    db.session.add(job)
     db.session.commit()
     
-    log_action(current_user, ActionType.DELETE_MESSAGE, # On réutilise un type existant ou on pourrait en créer un
-               details=f'Suppression massive: {deleted_count} fichiers (Filtre: {filter_type})')
-    
-    return jsonify({'success': True, 'deleted_count': deleted_count})
+    log_action(current_user, ActionType.DELETE_MESSAGE, target_id=job.id, target_type='bulk_delete_job',
+               details=f'Suppression massive programmée (Filtre: {filter_type})')
+    start_bulk_delete_job(job.id)
+    return jsonify({'success': True, 'job': job.to_dict()}), 202
+
+@app.route('/api/admin/files/bulk-delete/<job_id>', methods=['GET'])
+@login_required
+def bulk_delete_status(job_id):
+    """État d'une tâche de suppression massive"""
+    if current_user.role != UserRole.SUPREME:
+        return jsonify({'error': 'Accès refusé. Niveau SUPREME requis.'}), 403
+    job = db.session.get(BulkDeleteJob, job_id)
+    if job is None:
+        return jsonify({'error': 'Tâche introuvable'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/admin/files/bulk-delete/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_bulk_delete(job_id):
+    """Arrête la tâche après le lot en cours"""
+    if current_user.role != UserRole.SUPREME:
+        return jsonify({'error': 'Accès refusé. Niveau SUPREME requis.'}), 403
+    updated = db.session.execute(
+        db.update(BulkDeleteJob)
+        .where(BulkDeleteJob.id == job_id, BulkDeleteJob.status.in_(('pending', 'running')))
+        .values(status='cancelled', updated_at=get_current_utc_time())
+    ).rowcount
+    db.session.commit()
+    if not updated:
+        return jsonify({'error': 'Tâche introuvable ou déjà terminée'}), 404
+    return jsonify({'success': True})
+
+# ============================================
+# RAMASSE-MIETTES DES UPLOADS ORPHELINS
+# ============================================
+# Pièces jointes orphelines : jamais rattachées à un message (upload abandonné,
+# passé ORPHAN_GC_GRACE_HOURS), rattachées à un message supprimé, ou d'un salon
+# supprimé. Les compteurs de blobs sont recalés sur les références réelles
+# (les suppressions ORM en cascade ne libèrent pas les blobs). Côté disque,
+# tout fichier inconnu de la base et plus vieux que le délai de grâce est
+# effacé. Le passage se fait par lots, en priorité d'E/S minimale, avec une
+# pause entre les lots ; en dry_run rien n'est supprimé, seul le rapport est produit.
+
+_ORPHAN_GC_STATE = {'running': False, 'last_report': None}
+_ORPHAN_GC_LOCK = threading.Lock()
+_ORPHAN_GC_STARTED = False
+ORPHAN_GC_SAMPLE_SIZE = 50
+# Numéro de l'appel système ioprio_set selon l'architecture
+_IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314}
+
+def lower_io_priority():
+    """Passe le thread courant en classe d'E/S idle (Linux uniquement, sans effet ailleurs)"""
+    import sys
+    import platform
+    syscall_nr = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if not sys.platform.startswith('linux') or syscall_nr is None:
+        return False
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        # IOPRIO_WHO_PROCESS (1), cible 0 = thread appelant, IOPRIO_CLASS_IDLE (3) << 13
+        return libc.syscall(syscall_nr, 1, 0, 3 << 13) == 0
+    except (OSError, AttributeError):
+        return False
+
+def _gc_tally(report, section, reason, size, path):
+    entry = report[section].setdefault(reason, {'count': 0, 'bytes': 0})
+    entry['count'] += 1
+    entry['bytes'] += size or 0
+    if len(report['samples']) < ORPHAN_GC_SAMPLE_SIZE:
+        report['samples'].append(f"{section}/{reason}: {path}")
+
+def _orphan_attachment_conditions(cutoff):
+    """Conditions disjointes par motif (jointures externes sur channels et messages)"""
+    channel_gone = db.and_(FileAttachment.channel_id.isnot(None), Channel.id.is_(None))
+    return {
+        'channel_deleted': channel_gone,
+        'message_deleted': db.and_(FileAttachment.message_id.isnot(None), Message.id.is_(None), ~channel_gone),
+        # Uploads préparés pour un message jamais envoyé (les dépôts directs sont exclus)
+        'unlinked': db.and_(FileAttachment.message_id.is_(None), FileAttachment.is_standalone.is_(False),
+                            FileAttachment.created_at < cutoff, ~channel_gone),
+    }
+
+def _iter_orphan_attachments(condition):
+    last_id = ''
+    while True:
+        rows = db.session.execute(
+            db.select(FileAttachment.id, FileAttachment.file_path, FileAttachment.content_hash, FileAttachment.file_size)
+            .outerjoin(Channel, Channel.id == FileAttachment.channel_id)
+            .outerjoin(Message, Message.id == FileAttachment.message_id)
+            .where(condition, FileAttachment.id > last_id)
+            .order_by(FileAttachment.id)
+            .limit(max(1, ORPHAN_GC_BATCH_SIZE))
+        ).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+def _collect_unreferenced_blobs(report, cutoff, dry_run):
+    """Recale ref_count sur le nombre réel de pièces jointes et supprime les blobs sans référence"""
+    references = (db.select(db.func.count(FileAttachment.id))
+                  .where(FileAttachment.content_hash == FileBlob.content_hash)
+                  .scalar_subquery())
+    last_hash = ''
+    while True:
+        rows = db.session.execute(
+            db.select(FileBlob.content_hash, FileBlob.file_path, FileBlob.file_size, FileBlob.ref_count,
+                      references.label('actual'), (FileBlob.created_at < cutoff).label('expired'))
+            .where(FileBlob.content_hash > last_hash)
+            .order_by(FileBlob.content_hash)
+            .limit(max(1, ORPHAN_GC_BATCH_SIZE))
+        ).all()
+        if not rows:
+            return
+        last_hash = rows[-1].content_hash
+        drifted = [r.content_hash for r in rows if r.actual and r.actual != r.ref_count]
+        unreferenced = [r for r in rows if not r.actual and r.expired]
+        if drifted:
+            report['blobs'].setdefault('ref_count_fixed', {'count': 0, 'bytes': 0})['count'] += len(drifted)
+        for r in unreferenced:
+            _gc_tally(report, 'blobs', 'unreferenced', r.file_size, r.file_path)
+        if not dry_run and (drifted or unreferenced):
+            if drifted:
+                db.session.execute(
+                    db.update(FileBlob).where(FileBlob.content_hash.in_(drifted)).values(ref_count=references)
+                )
+            if unreferenced:
+                db.session.execute(
+                    db.delete(FileBlob).where(
+                        FileBlob.content_hash.in_([r.content_hash for r in unreferenced]),
+                        ~db.exists().where(FileAttachment.content_hash == FileBlob.content_hash),
+                    )
+                )
+            db.session.commit()
+            purge_blob_files([r.file_path for r in unreferenced])
+        time.sleep(ORPHAN_GC_BATCH_PAUSE)
+
+def _iter_stray_candidates(root, recursive=False):
+    """Lots de (chemin, nom, taille) plus anciens que le délai de grâce"""
+    cutoff_ts = time.time() - ORPHAN_GC_GRACE_HOURS * 3600
+    stack, batch = [str(root)], []
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                stack.append(entry.path)
+                            continue
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if st.st_mtime >= cutoff_ts:
+                        continue
+                    batch.append((entry.path, entry.name, st.st_size))
+                    if len(batch) >= ORPHAN_GC_BATCH_SIZE:
+                        yield batch
+                        batch = []
+        except OSError:
+            continue
+    if batch:
+        yield batch
+
+def _known_legacy_files(names):
+    return set(db.session.execute(
+        db.select(FileAttachment.filename).where(FileAttachment.filename.in_(names))
+    ).scalars())
+
+def _known_blob_files(names):
+    return set(db.session.execute(
+        db.select(FileBlob.content_hash).where(FileBlob.content_hash.in_(names))
+    ).scalars())
+
+def _known_thumbnails(names):
+    ids = set(db.session.execute(
+        db.select(FileAttachment.id).where(FileAttachment.id.in_({n.rsplit('.', 1)[0] for n in names}))
+    ).scalars())
+    return {n for n in names if n.rsplit('.', 1)[0] in ids}
+
+def _avatar_source_stem(name):
+    """'<stem>_64.webp' -> '<stem>' pour une variante, sinon le nom sans extension"""
+    stem = name.rsplit('.', 1)[0]
+    base, _, suffix = stem.rpartition('_')
+    if base and suffix.isdigit() and int(suffix) in AVATAR_VARIANT_SIZES:
+        return base
+    return stem
+
+def _stray_scan_targets():
+    """(section, dossier, récursif, fonction des noms connus) pour chaque zone d'upload"""
+    avatar_stems = {
+        name.rsplit('.', 1)[0] for name in db.session.execute(
+            db.select(User.avatar_filename).where(User.avatar_filename.isnot(None))
+        ).scalars()
+    }
+    banner_names = set(db.session.execute(
+        db.select(User.banner_filename).where(User.banner_filename.isnot(None))
+    ).scalars())
+    targets = [
+        ('files', FILES_DIR, False, _known_legacy_files),
+        ('thumbs', THUMBS_DIR, False, _known_thumbnails),
+        ('avatars', AVATARS_DIR, False,
+         lambda names: {n for n in names if n.rsplit('.', 1)[0] in avatar_stems or _avatar_source_stem(n) in avatar_stems}),
+        ('banners', BANNERS_DIR, False, lambda names: set(names) & banner_names),
+    ]
+    # Un blob copié par la migration garde l'ancienne date : pas de scan pendant qu'elle tourne
+    if not _BLOB_MIGRATION_STATE['running']:
+        targets.append(('blobs', BLOBS_DIR, True, _known_blob_files))
+    # Un dossier replié sur un autre (create_directory_with_fallback) serait jugé avec
+    # les noms connus d'une autre zone : une seule zone par dossier, aucune autre que
+    # 'files' sur FILES_DIR, et pas de scan récursif englobant une autre zone
+    files_root = FILES_DIR.resolve()
+    kept, roots = [], []
+    for target in targets:
+        section, directory, recursive, _ = target
+        root = Path(directory).resolve()
+        if (root in roots or (section != 'files' and root == files_root)
+                or (recursive and any(root in other.parents for other in roots))):
+            print(f"[GC] Zone '{section}' ignorée : {root} est partagé avec une autre zone")
+            continue
+        kept.append(target)
+        roots.append(root)
+    return kept
+
+def collect_orphans(dry_run=True):
+    """Un passage complet du ramasse-miettes ; retourne le rapport"""
+    started = time.monotonic()
+    lower_io_priority()
+    cutoff = get_current_utc_time() - timedelta(hours=ORPHAN_GC_GRACE_HOURS)
+    report = {
+        'dry_run': dry_run,
+        'grace_hours': ORPHAN_GC_GRACE_HOURS,
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'attachments': {}, 'blobs': {}, 'stray_files': {}, 'samples': [],
+    }
+
+    for reason, condition in _orphan_attachment_conditions(cutoff).items():
+        for rows in _iter_orphan_attachments(condition):
+            for row in rows:
+                _gc_tally(report, 'attachments', reason, row.file_size, row.file_path)
+            if not dry_run:
+                deleted, disk_paths, released_blobs = delete_attachment_rows(rows)
+                db.session.commit()
+                finish_attachment_deletion(deleted, disk_paths, released_blobs)
+            time.sleep(ORPHAN_GC_BATCH_PAUSE)
+
+    _collect_unreferenced_blobs(report, cutoff, dry_run)
+
+    for section, root, recursive, known_names in _stray_scan_targets():
+        for batch in _iter_stray_candidates(root, recursive):
+            known = known_names([name for _, name, _ in batch])
+            for path, name, size in batch:
+                if name in known:
+                    continue
+                _gc_tally(report, 'stray_files', section, size, path)
+                if not dry_run:
+                    remove_tracked_file(path)
+            time.sleep(ORPHAN_GC_BATCH_PAUSE)
+
+    if not dry_run:
+        report['chunked_uploads_pruned'] = prune_stale_chunked_uploads()
+    report['duration'] = round(time.monotonic() - started, 3)
+    return report
+
+def run_orphan_gc(dry_run=True):
+    """Exécute un passage (un seul à la fois) ; None si un passage est déjà en cours"""
+    with _ORPHAN_GC_LOCK:
+        if _ORPHAN_GC_STATE['running']:
+            return None
+        _ORPHAN_GC_STATE['running'] = True
+    try:
+        report = collect_orphans(dry_run)
+        _ORPHAN_GC_STATE['last_report'] = report
+        freed = sum(entry['bytes'] for section in ('attachments', 'blobs', 'stray_files')
+                    for entry in report[section].values())
+        print(f"[GC] {'Simulation' if dry_run else 'Passage'} terminé en {report['duration']}s: {freed} octets "
+              f"{'récupérables' if dry_run else 'récupérés'}")
+        return report
+    finally:
+        _ORPHAN_GC_STATE['running'] = False
+
+def start_orphan_gc_run(dry_run=True):
+    """Lance un passage en arrière-plan"""
+    if _ORPHAN_GC_STATE['running']:
+        return False
+    def worker():
+        with app.app_context():
+            try:
+                run_orphan_gc(dry_run)
+            except Exception as e:
+                db.session.rollback()
+                print(f"[GC] Erreur: {e}")
+            finally:
+                db.session.remove()
+    threading.Thread(target=worker, daemon=True).start()
+    return True
+
+def start_orphan_gc_scheduler():
+    """Passage réel toutes les ORPHAN_GC_INTERVAL secondes"""
+    global _ORPHAN_GC_STARTED
+    if _ORPHAN_GC_STARTED or not ORPHAN_GC_ENABLED:
+        return
+    _ORPHAN_GC_STARTED = True
+    def worker():
+        while True:
+            time.sleep(max(300, ORPHAN_GC_INTERVAL))
+            with app.app_context():
+                try:
+                    run_orphan_gc(dry_run=False)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"[GC] Erreur: {e}")
+                finally:
+                    db.session.remove()
+    threading.Thread(target=worker, daemon=True).start()
+
+@app.route('/api/admin/gc', methods=['GET'])
+@admin_required
+def admin_orphan_gc_report():
+    """Dernier rapport du ramasse-miettes"""
+    return jsonify(_ORPHAN_GC_STATE)
+
+@app.route('/api/admin/gc/run', methods=['POST'])
+@admin_required
+def admin_orphan_gc_run():
+    """Lance une simulation (par défaut) ou un passage réel (Admin Suprême)"""
+    dry_run = bool((request.get_json(silent=True) or {}).get('dry_run', True))
+    if not dry_run and current_user.role != UserRole.SUPREME:
+        return jsonify({'error': 'Accès refusé. Niveau SUPREME requis.'}), 403
+    started = start_orphan_gc_run(dry_run)
+    if started and not dry_run:
+        log_action(current_user, ActionType.ORPHAN_GC, target_type='orphan_gc',
+                   details='Ramasse-miettes des uploads orphelins lancé')
+    return jsonify({'started': started, 'dry_run': dry_run}), 202 if started else 409
+
+@app.route('/api/admin/backups', methods=['GET'])
+@admin_required
+def admin_list_backups():
+    """Sauvegardes disponibles + état du planificateur"""
+    return jsonify({'backups': list_backup_infos(), 'state': _BACKUP_STATE,
+                    'interval': BACKUP_INTERVAL, 'retention_days': BACKUP_RETENTION_DAYS})
+
+@app.route('/api/admin/backups', methods=['POST'])
+@admin_required
+def admin_create_backup():
+    """Déclenche une sauvegarde en arrière-plan (Admin Suprême)"""
+    if current_user.role != UserRole.SUPREME:
+        return jsonify({'error': 'Accès refusé. Niveau SUPREME requis.'}), 403
+    started = start_backup_run()
+    return jsonify({'started': started}), 202 if started else 409
 
 @app.route('/parametre')
 @guest_allowed
@@ -5066,21 +7503,8 @@ def init_db():
     """Initialise la base de données avec les salons par défaut"""
     try:
         with app.app_context():
-            db.create_all()
-            
-            # Migration: Ajout de la colonne channel_id si manquante
-            try:
-                with db.engine.connect() as conn:
-                    # Tentative d'ajout de la colonne (échouera si elle existe déjà)
-                    # Note: SQLite ne supporte pas IF NOT EXISTS pour ADD COLUMN dans toutes les versions
-                    # On utilise text() pour la compatibilité SQLAlchemy
-                    from sqlalchemy import text
-                    conn.execute(text('ALTER TABLE file_attachments ADD COLUMN channel_id VARCHAR(36)'))
-                    conn.commit()
-                    print("  Migration: Colonne channel_id ajoutée à file_attachments")
-            except Exception:
-                # La colonne existe probablement déjà ou erreur mineure
-                pass
+            # Sans effet si le démarrage a déjà migré (une lecture de version)
+            apply_migrations(db.engine)
             
             # Créer les salons par défaut si inexistants (seulement 2 channels)
             if Channel.query.count() == 0:
@@ -5110,7 +7534,11 @@ if __name__ == '__main__':
         DATA_DIR = Path.cwd() / 'data'
         DATA_DIR.mkdir(parents=True, exist_ok=True)
     
-    init_db()
+    with boot_stage('init_db'):
+        init_db()
+    
+    with boot_stage('services'):
+        start_background_services()
     
     print("=" * 60)
     print("  KRONOS - Système de Communication Souverain")
@@ -5120,6 +7548,7 @@ if __name__ == '__main__':
     print("=" * 60)
     print("  Accédez à: http://localhost:5000")
     print("=" * 60)
+    print_boot_timings()
     
     socketio.run(app, 
                  host='0.0.0.0', 
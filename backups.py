@@ -0,0 +1,139 @@
+# KRONOS - Sauvegardes en ligne de la base SQLite
+# Uniquement sqlite3 + fichiers : utilisé par l'application (planificateur) comme
+# par scripts/restore_backup.py, serveur arrêté. Ce module n'importe pas Flask.
+
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+
+BACKUP_PATTERN = "kronos_*.db"
+CHECKSUM_SUFFIX = ".sha256"
+PARTIAL_SUFFIX = ".partial"
+
+
+def copy_database(db_path, target, method='vacuum', pages_per_step=1024, step_sleep=0.0, timeout=30):
+    """Copie cohérente de la base vivante vers target ; retourne la méthode utilisée.
+
+    VACUUM INTO lit un instantané (en WAL les écrivains continuent) et produit
+    une copie compactée. L'API de sauvegarde copie pages_per_step pages à la
+    fois et relâche le verrou entre deux pas (step_sleep secondes).
+    """
+    src = sqlite3.connect(str(db_path), timeout=timeout)
+    try:
+        if method == 'vacuum' and sqlite3.sqlite_version_info >= (3, 27, 0):
+            src.execute("VACUUM INTO ?", (str(target),))
+            return 'vacuum'
+        dst = sqlite3.connect(str(target))
+        try:
+            def pause(status, remaining, total):
+                if step_sleep:
+                    time.sleep(step_sleep)
+            src.backup(dst, pages=max(1, int(pages_per_step)), progress=pause)
+        finally:
+            dst.close()
+        return 'backup'
+    finally:
+        src.close()
+
+
+def quick_check(path):
+    """PRAGMA quick_check en lecture seule ; lève RuntimeError si la copie est corrompue"""
+    conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()
+    finally:
+        conn.close()
+    if not result or result[0] != 'ok':
+        raise RuntimeError(f"quick_check en échec pour {Path(path).name}: {result[0] if result else '?'}")
+
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def checksum_path(path):
+    path = Path(path)
+    return path.with_name(path.name + CHECKSUM_SUFFIX)
+
+
+def write_checksum(path, checksum):
+    """Fichier voisin au format sha256sum (vérifiable avec `sha256sum -c`)"""
+    checksum_path(path).write_text(f"{checksum}  {Path(path).name}\n")
+
+
+def read_checksum(path):
+    try:
+        return checksum_path(path).read_text().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def verify_checksum(path):
+    """True si l'empreinte enregistrée correspond au contenu actuel"""
+    expected = read_checksum(path)
+    return bool(expected) and sha256_file(path) == expected
+
+
+def list_backups(backup_dir):
+    """Sauvegardes terminées, de la plus ancienne à la plus récente"""
+    backups = []
+    for path in Path(backup_dir).glob(BACKUP_PATTERN):
+        try:
+            backups.append((path.stat().st_mtime, path))
+        except OSError:
+            continue
+    return [path for _, path in sorted(backups)]
+
+
+def expired_backups(backup_dir, retention_days, min_keep):
+    """Sauvegardes plus vieilles que retention_days, hors les min_keep plus récentes"""
+    backups = list_backups(backup_dir)
+    if min_keep > 0:
+        backups = backups[:-min_keep]
+    cutoff = time.time() - retention_days * 86400
+    expired = []
+    for path in backups:
+        try:
+            if path.stat().st_mtime < cutoff:
+                expired.append(path)
+        except OSError:
+            continue
+    return expired
+
+
+def stale_partials(backup_dir, max_age=86400):
+    """Copies interrompues (crash pendant une sauvegarde)"""
+    cutoff = time.time() - max_age
+    stale = []
+    for path in Path(backup_dir).glob("*" + PARTIAL_SUFFIX):
+        try:
+            if path.stat().st_mtime < cutoff:
+                stale.append(path)
+        except OSError:
+            continue
+    return stale
+
+
+def restore(backup_path, db_path, timeout=30):
+    """Réécrit db_path depuis une sauvegarde via l'API de sauvegarde.
+
+    L'écriture passe par une connexion SQLite sur la base cible : un éventuel
+    journal -wal est pris en compte au lieu d'être laissé incohérent comme avec
+    une copie de fichier. À lancer serveur arrêté.
+    """
+    if not verify_checksum(backup_path):
+        raise RuntimeError(f"Empreinte SHA-256 absente ou invalide pour {Path(backup_path).name}")
+    quick_check(backup_path)
+    src = sqlite3.connect(f"{Path(backup_path).resolve().as_uri()}?mode=ro", uri=True)
+    dst = sqlite3.connect(str(db_path), timeout=timeout)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    return Path(backup_path)
@@ -2,6 +2,7 @@
 # Système de Communication Souverain
 
 import os
+import functools
 from pathlib import Path
 
 # ============================================
@@ -49,11 +50,34 @@ PERMANENT_SESSION_LIFETIME = 86400 * 7  # 7 jours
 # ============================================
 # CONFIGURATION SQLALCHEMY
 # ============================================
-SQLALCHEMY_DATABASE_URI = f"sqlite:///{DB_PATH}?timeout=30"
+# Profil SQLite appliqué à chaque connexion du pool : WAL (lecteurs non bloqués
+# par l'écrivain), synchronous=NORMAL (sûr en WAL), cache et mmap dimensionnés
+SQLITE_JOURNAL_MODE = os.environ.get('KRONOS_SQLITE_JOURNAL_MODE', 'WAL').upper()
+SQLITE_SYNCHRONOUS = os.environ.get('KRONOS_SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('KRONOS_SQLITE_BUSY_TIMEOUT_MS', '30000'))
+SQLITE_CACHE_SIZE_KIB = int(os.environ.get('KRONOS_SQLITE_CACHE_SIZE_KIB', '65536'))
+SQLITE_MMAP_SIZE = int(os.environ.get('KRONOS_SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_WAL_AUTOCHECKPOINT = int(os.environ.get('KRONOS_SQLITE_WAL_AUTOCHECKPOINT', '1000'))
+SQLITE_PRAGMAS = (
+    ('journal_mode', SQLITE_JOURNAL_MODE),
+    ('synchronous', SQLITE_SYNCHRONOUS),
+    ('busy_timeout', SQLITE_BUSY_TIMEOUT_MS),
+    ('cache_size', -SQLITE_CACHE_SIZE_KIB),  # négatif = taille en Kio
+    ('mmap_size', SQLITE_MMAP_SIZE),
+    ('temp_store', 'MEMORY'),
+    ('wal_autocheckpoint', SQLITE_WAL_AUTOCHECKPOINT),
+)
+# Checkpoint périodique (secondes) ; TRUNCATE au-delà de cette taille de WAL
+SQLITE_CHECKPOINT_INTERVAL = int(os.environ.get('KRONOS_SQLITE_CHECKPOINT_INTERVAL', '300'))
+SQLITE_WAL_TRUNCATE_BYTES = int(os.environ.get('KRONOS_SQLITE_WAL_TRUNCATE_BYTES', str(64 * 1024 * 1024)))
+
+SQLALCHEMY_DATABASE_URI = f"sqlite:///{DB_PATH}"
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_ENGINE_OPTIONS = {
-    "pool_pre_ping": True,
-    "pool_recycle": 300,
+    # Fichier local : ni pre-ping ni recyclage (les connexions gardent cache et mmap)
+    "pool_size": int(os.environ.get('KRONOS_SQLITE_POOL_SIZE', '10')),
+    "max_overflow": int(os.environ.get('KRONOS_SQLITE_POOL_OVERFLOW', '20')),
+    "connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
 }
 
 # ============================================
@@ -173,12 +197,18 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
-# L'IP du serveur devient Admin Suprême automatiquement
-SERVER_IP = get_local_ip()
-print(f"[KRONOS] IP du serveur détectée: {SERVER_IP}")
+# L'IP du serveur devient Admin Suprême automatiquement. Résolue au premier usage :
+# importer config (scripts, processus du pool) n'ouvre pas de socket
+@functools.lru_cache(maxsize=None)
+def get_server_ip():
+    server_ip = os.environ.get('KRONOS_SERVER_IP') or get_local_ip()
+    print(f"[KRONOS] IP du serveur détectée: {server_ip}")
+    return server_ip
 
-# Peut être surchargé via variable d'environnement
-ADMIN_SUPREME_IP = os.environ.get('KRONOS_ADMIN_IP', SERVER_IP)
+def get_admin_supreme_ip():
+    """KRONOS_ADMIN_IP si défini (vide = désactivé), sinon l'IP du serveur"""
+    admin_ip = os.environ.get('KRONOS_ADMIN_IP')
+    return get_server_ip() if admin_ip is None else admin_ip
 
 # ============================================
 # PANIC MODE (ANTI-WATCH)
@@ -234,6 +264,106 @@ ANTISPAM_PERSEC_COUNT = int(os.environ.get('KRONOS_ANTISPAM_PERSEC_COUNT', '3'))
 ANTISPAM_PERSEC_WINDOW = int(os.environ.get('KRONOS_ANTISPAM_PERSEC_WINDOW', '1'))
 ANTISPAM_REPEAT_CHAR_MIN = int(os.environ.get('KRONOS_ANTISPAM_REPEAT_CHAR_MIN', '6'))
 
+# Filtre de contenu (pseudonymes + messages)
+# Fichier optionnel : un terme par ligne, lignes commençant par # ignorées
+CONTENT_FILTER_BLOCKLIST_PATH = os.environ.get('KRONOS_BLOCKLIST_PATH', str(DATA_DIR / "blocklist.txt"))
+# 'block' (refus), 'mask' (remplacement par ***) ou 'off'
+CONTENT_FILTER_MESSAGE_MODE = os.environ.get('KRONOS_CONTENT_FILTER_MODE', 'block').lower()
+
+# Limiteur de débit Socket.IO (seau à jetons par utilisateur et par événement)
+# Valeurs : (jetons rechargés par seconde, capacité du seau)
+SOCKET_RATE_LIMIT_ENABLED = os.environ.get('KRONOS_SOCKET_RATE_LIMIT', 'true').lower() == 'true'
+SOCKET_RATE_LIMIT_DEFAULT = (
+    float(os.environ.get('KRONOS_SOCKET_RATE_DEFAULT_RATE', '5')),
+    int(os.environ.get('KRONOS_SOCKET_RATE_DEFAULT_BURST', '20')),
+)
+SOCKET_RATE_LIMITS = {
+    'send_message': (2, 10),
+    'get_members': (1, 10),
+    'get_admin_users': (0.2, 3),
+    'typing': (2, 6),
+    'ping': (1, 6),
+    'join_channel': (2, 10),
+    'bs_fire': (2, 5),
+    'fire': (2, 5),
+    'fire_shot': (2, 5),
+    'webrtc_ice_candidate': (25, 100),
+    'admin_bulk_action': (0.2, 2),
+}
+
+# Modération de masse (raids)
+BULK_MODERATION_MAX_TARGETS = int(os.environ.get('KRONOS_BULK_MODERATION_MAX_TARGETS', '1000'))
+
+# Journal d'audit (écriture asynchrone par lots)
+AUDIT_QUEUE_MAXSIZE = int(os.environ.get('KRONOS_AUDIT_QUEUE_MAXSIZE', '10000'))
+AUDIT_BATCH_SIZE = int(os.environ.get('KRONOS_AUDIT_BATCH_SIZE', '200'))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('KRONOS_AUDIT_FLUSH_INTERVAL', '1.0'))
+AUDIT_LATE_SECONDS = float(os.environ.get('KRONOS_AUDIT_LATE_SECONDS', '5.0'))
+
+# Upload fractionné avec reprise (init / PUT par morceau / finalisation)
+CHUNKED_UPLOAD_DIR = create_directory_with_fallback(UPLOADS_DIR / ".partial", UPLOADS_DIR)
+CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get('KRONOS_CHUNKED_UPLOAD_MAX_SIZE', str(MAX_CONTENT_LENGTH)))
+CHUNKED_UPLOAD_CHUNK_SIZE = int(os.environ.get('KRONOS_CHUNKED_UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+CHUNKED_UPLOAD_EXPIRY_HOURS = int(os.environ.get('KRONOS_CHUNKED_UPLOAD_EXPIRY_HOURS', '24'))
+
+# Stockage dédupliqué par empreinte SHA-256 (uploads/files/.blobs/<2 car.>/<hash>)
+BLOBS_DIR = create_directory_with_fallback(FILES_DIR / ".blobs", FILES_DIR)
+BLOB_DEDUP_MIGRATION_ENABLED = os.environ.get('KRONOS_BLOB_DEDUP_MIGRATION', 'True').lower() == 'true'
+BLOB_DEDUP_BATCH_SIZE = int(os.environ.get('KRONOS_BLOB_DEDUP_BATCH_SIZE', '100'))
+
+# Livraison des fichiers : 'python' (send_file, sendfile via wsgi.file_wrapper si le
+# serveur le permet), 'x-accel' (nginx, X-Accel-Redirect) ou 'x-sendfile' (Apache/lighttpd)
+FILE_DELIVERY_MODE = os.environ.get('KRONOS_FILE_DELIVERY', 'python').lower()
+X_ACCEL_PREFIX = os.environ.get('KRONOS_X_ACCEL_PREFIX', '/_kronos_uploads/')
+USE_X_SENDFILE = FILE_DELIVERY_MODE == 'x-sendfile'
+
+# Cache HTTP : ressources à nom unique (pièces jointes, avatars, bannières) immuables
+IMMUTABLE_CACHE_MAX_AGE = int(os.environ.get('KRONOS_IMMUTABLE_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+DEFAULT_AVATAR_MAX_AGE = int(os.environ.get('KRONOS_DEFAULT_AVATAR_MAX_AGE', '300'))
+
+# Miniatures (pool de processus) : uploads/files/.thumbs/<id>.jpg et .webp
+THUMBS_DIR = create_directory_with_fallback(FILES_DIR / ".thumbs", FILES_DIR)
+THUMBNAIL_WORKERS = int(os.environ.get('KRONOS_THUMBNAIL_WORKERS', '2'))
+THUMBNAIL_MAX_SIZE = int(os.environ.get('KRONOS_THUMBNAIL_MAX_SIZE', '320'))
+THUMBNAIL_QUEUE_MAXSIZE = int(os.environ.get('KRONOS_THUMBNAIL_QUEUE_MAXSIZE', '1000'))
+
+# Variantes d'avatar (WebP, repli PNG/GIF) générées hors requête par le même pool
+AVATAR_VARIANT_SIZES = (32, 64, 128, 256)
+AVATAR_MAX_FRAMES = int(os.environ.get('KRONOS_AVATAR_MAX_FRAMES', '60'))
+AVATAR_SOURCE_MAX_SIZE = int(os.environ.get('KRONOS_AVATAR_SOURCE_MAX_SIZE', str(10 * 1024 * 1024)))
+
+# Statistiques admin : totaux tenus à jour en continu, recalés périodiquement (secondes)
+STATS_RECONCILE_INTERVAL = int(os.environ.get('KRONOS_STATS_RECONCILE_INTERVAL', '3600'))
+
+# Suppression massive en arrière-plan : lignes par transaction et threads de suppression disque
+BULK_DELETE_CHUNK_SIZE = int(os.environ.get('KRONOS_BULK_DELETE_CHUNK_SIZE', '500'))
+BULK_DELETE_UNLINK_WORKERS = int(os.environ.get('KRONOS_BULK_DELETE_UNLINK_WORKERS', '8'))
+
+# Ramasse-miettes des uploads orphelins (intervalle en secondes, délai de grâce en heures)
+ORPHAN_GC_ENABLED = os.environ.get('KRONOS_ORPHAN_GC', 'True').lower() == 'true'
+ORPHAN_GC_INTERVAL = int(os.environ.get('KRONOS_ORPHAN_GC_INTERVAL', str(6 * 3600)))
+ORPHAN_GC_GRACE_HOURS = int(os.environ.get('KRONOS_ORPHAN_GC_GRACE_HOURS', '24'))
+ORPHAN_GC_BATCH_SIZE = int(os.environ.get('KRONOS_ORPHAN_GC_BATCH_SIZE', '200'))
+ORPHAN_GC_BATCH_PAUSE = float(os.environ.get('KRONOS_ORPHAN_GC_BATCH_PAUSE', '0.5'))
+
+# Sauvegardes en ligne de la base (VACUUM INTO ou API de sauvegarde SQLite), en arrière-plan
+BACKUP_DIR = create_directory_with_fallback(DATA_DIR / "backups", DATA_DIR)
+BACKUP_METHOD = os.environ.get('KRONOS_BACKUP_METHOD', 'vacuum').lower()  # 'vacuum' ou 'backup'
+BACKUP_INTERVAL = int(os.environ.get('KRONOS_BACKUP_INTERVAL', str(6 * 3600)))
+BACKUP_STARTUP_DELAY = int(os.environ.get('KRONOS_BACKUP_STARTUP_DELAY', '120'))
+BACKUP_RETENTION_DAYS = int(os.environ.get('KRONOS_BACKUP_RETENTION_DAYS', '7'))
+BACKUP_MIN_KEEP = int(os.environ.get('KRONOS_BACKUP_MIN_KEEP', '3'))
+BACKUP_PAGES_PER_STEP = int(os.environ.get('KRONOS_BACKUP_PAGES_PER_STEP', '1024'))
+BACKUP_STEP_SLEEP = float(os.environ.get('KRONOS_BACKUP_STEP_SLEEP', '0.02'))
+
+# Vérification d'intégrité de la base, lancée en arrière-plan après le démarrage
+DB_INTEGRITY_CHECK = os.environ.get('KRONOS_DB_INTEGRITY_CHECK', 'quick').lower()  # 'quick', 'full' ou 'off'
+DB_INTEGRITY_CHECK_DELAY = int(os.environ.get('KRONOS_DB_INTEGRITY_CHECK_DELAY', '30'))
+
+# Quotas de stockage des pièces jointes en octets (0 = illimité), surchargeables par utilisateur / salon
+USER_STORAGE_QUOTA = int(os.environ.get('KRONOS_USER_STORAGE_QUOTA', str(5 * 1024 * 1024 * 1024)))
+CHANNEL_STORAGE_QUOTA = int(os.environ.get('KRONOS_CHANNEL_STORAGE_QUOTA', '0'))
+
 # ============================================
 # CONFIGURATION DEBUG
 # ============================================
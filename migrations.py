@@ -0,0 +1,443 @@
+# KRONOS - Migrations versionnées du schéma
+# La version du schéma est stockée dans l'en-tête SQLite (PRAGMA user_version) :
+# au démarrage, une seule lecture suffit quand la base est à jour. Chaque
+# migration s'exécute une seule fois, dans l'ordre, dans sa propre transaction
+# (BEGIN IMMEDIATE : DDL et données validés ou annulés ensemble) et est
+# journalisée dans schema_migrations.
+#
+# Les migrations antérieures à ce système sont écrites de façon idempotente :
+# une base déjà réparée par l'ancienne vérification au démarrage (version 0)
+# les rejoue sans effet. Toute nouvelle évolution du schéma = une nouvelle
+# fonction @migration(N+1, ...) en fin de fichier.
+#
+# Une base vide reçoit directement le schéma des modèles actuels (create_all) et
+# la dernière version, sans rejouer l'historique. Une base ancienne (version 0)
+# peut aussi recevoir de la migration 1 des tables créées d'après les modèles
+# actuels : les migrations passent donc par add_columns / ensure_index
+# (idempotents), jamais par un ALTER TABLE ADD COLUMN brut.
+
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from extensions import db
+# Importer les modèles enregistre leurs tables dans db.metadata
+from models import dm_pair_key
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def get_schema_version(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+
+
+# ============================================
+# OUTILS
+# ============================================
+def is_empty_database(conn):
+    return conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' LIMIT 1"
+    ).first() is None
+
+
+def table_exists(conn, table_name):
+    return conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table_name}
+    ).first() is not None
+
+
+def add_columns(conn, table_name, columns_spec):
+    """Ajoute les colonnes (nom, type SQL, défaut SQL) absentes de la table"""
+    if not table_exists(conn, table_name):
+        return
+    existing = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table_name})")}
+    for name, type_sql, default_sql in columns_spec:
+        if name in existing:
+            continue
+        ddl = f'ALTER TABLE {table_name} ADD COLUMN {name} {type_sql}'
+        if default_sql is not None:
+            ddl += f' DEFAULT {default_sql}'
+        conn.exec_driver_sql(ddl)
+        existing.add(name)
+        print(f"[DB] Colonne {table_name}.{name} ajoutée")
+
+
+def create_indexes(conn, table_name, statements):
+    if table_exists(conn, table_name):
+        for statement in statements:
+            conn.exec_driver_sql(statement)
+
+
+def index_covers(conn, table_name, columns):
+    """True si un index existant (y compris sqlite_autoindex d'un UNIQUE) commence par columns"""
+    for row in conn.exec_driver_sql(f"PRAGMA index_list({table_name})").fetchall():
+        indexed = [info[2] for info in conn.exec_driver_sql(f"PRAGMA index_info('{row[1]}')")]
+        if indexed[:len(columns)] == list(columns):
+            return True
+    return False
+
+
+def ensure_index(conn, table_name, index_name, columns):
+    """Crée l'index sauf si la table manque ou si un index équivalent existe déjà"""
+    if not table_exists(conn, table_name) or index_covers(conn, table_name, columns):
+        return
+    conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name}({', '.join(columns)})")
+    print(f"[DB] Index {index_name} créé sur {table_name}({', '.join(columns)})")
+
+
+# ============================================
+# MIGRATIONS
+# ============================================
+@migration(1, "Schéma de base (tables manquantes, colonnes historiques)")
+def _baseline(conn):
+    # Base neuve : toutes les tables des modèles ; base existante : seulement les manquantes
+    db.metadata.create_all(bind=conn, checkfirst=True)
+    add_columns(conn, 'users', [
+        ('reset_token', 'TEXT', None),
+        ('reset_token_expires_at', 'DATETIME', None),
+        ('mute_until', 'DATETIME', None),
+        ('last_ip', 'TEXT', None),
+        ('theme', 'TEXT', "'dark'"),
+        ('notif_sound', 'BOOLEAN', '1'),
+        ('animations_enabled', 'BOOLEAN', '1'),
+        ('personal_panic_url', 'VARCHAR(500)', None),
+        ('personal_panic_hotkey', 'VARCHAR(50)', None),
+    ])
+    add_columns(conn, 'email_messages', [
+        ('status', 'TEXT', "'pending'"),
+        ('attempts', 'INTEGER', '0'),
+        ('max_retries', 'INTEGER', '3'),
+        ('last_attempt', 'DATETIME', None),
+        ('error_log', 'TEXT', None),
+        ('sent_at', 'DATETIME', None),
+        ('is_opened', 'BOOLEAN', '0'),
+        ('opened_at', 'DATETIME', None),
+        ('created_at', 'DATETIME', None),
+    ])
+    create_indexes(conn, 'email_messages', [
+        "CREATE INDEX IF NOT EXISTS idx_email_recipient ON email_messages(recipient)",
+    ])
+    add_columns(conn, 'file_attachments', [('channel_id', 'VARCHAR(36)', None)])
+    add_columns(conn, 'game_sessions', [
+        ('name', 'TEXT', "'Battleship'"),
+        ('game_type', 'VARCHAR(50)', "'battleship'"),
+        ('is_private', 'BOOLEAN', '0'),
+        ('join_code', 'VARCHAR(20)', None),
+        ('created_by_id', 'TEXT', None),
+        ('max_players', 'INTEGER', '2'),
+        ('players_json', 'TEXT', "'[]'"),
+        ('state_json', 'TEXT', "'{}'"),
+        ('current_turn_user_id', 'TEXT', None),
+        ('code', 'VARCHAR(12)', None),
+        ('status', 'TEXT', "'waiting'"),
+        ('mode', 'TEXT', "'pvp'"),
+        ('p1_id', 'TEXT', None),
+        ('p2_id', 'TEXT', None),
+        ('p1_ready', 'BOOLEAN', '0'),
+        ('p2_ready', 'BOOLEAN', '0'),
+        ('current_turn', 'TEXT', None),
+        ('p1_board', 'TEXT', None),
+        ('p2_board', 'TEXT', None),
+        ('history', 'TEXT', None),
+        ('spectators', 'TEXT', None),
+        ('created_at', 'DATETIME', None),
+        ('updated_at', 'DATETIME', None),
+    ])
+
+
+@migration(2, "Clé canonique des DM")
+def _dm_keys(conn):
+    add_columns(conn, 'channels', [('dm_key', 'VARCHAR(80)', None)])
+    create_indexes(conn, 'channels', [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_channels_dm_key ON channels(dm_key)",
+    ])
+    backfill_dm_keys(conn)
+
+
+@migration(3, "Résumés de conversations privées")
+def _dm_conversations(conn):
+    backfill_dm_conversations(conn)
+
+
+@migration(4, "Numéros de message pour les non-lus")
+def _message_seq(conn):
+    add_columns(conn, 'channels', [('message_seq', 'INTEGER', '0')])
+    add_columns(conn, 'messages', [('seq', 'INTEGER', None)])
+
+
+@migration(5, "Stockage dédupliqué par empreinte")
+def _content_hash(conn):
+    add_columns(conn, 'file_attachments', [('content_hash', 'VARCHAR(64)', None)])
+    create_indexes(conn, 'file_attachments', [
+        "CREATE INDEX IF NOT EXISTS ix_file_attachments_content_hash ON file_attachments(content_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_file_attachments_filename ON file_attachments(filename)",
+    ])
+
+
+@migration(6, "Variantes d'avatar")
+def _avatar_variants(conn):
+    add_columns(conn, 'users', [('avatar_variants', 'VARCHAR(100)', None)])
+
+
+@migration(7, "Index du journal d'audit (filtres + pagination par curseur)")
+def _audit_indexes(conn):
+    create_indexes(conn, 'audit_logs', [
+        "CREATE INDEX IF NOT EXISTS idx_audit_created_id ON audit_logs(created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_action_created ON audit_logs(action_type, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_actor_created ON audit_logs(actor_id, created_at, id)",
+    ])
+
+
+@migration(8, "Quotas de stockage")
+def _storage_quotas(conn):
+    for table_name in ('users', 'channels'):
+        add_columns(conn, table_name, [
+            ('storage_used', 'BIGINT', None),
+            ('storage_quota', 'BIGINT', None),
+        ])
+    backfill_storage_usage(conn)
+
+
+@migration(9, "Index des recherches fréquentes")
+def _hot_lookup_indexes(conn):
+    # Les contraintes UNIQUE fournissent déjà ces index sur une base créée par
+    # create_all ; les tables plus anciennes qui en sont dépourvues les reçoivent ici
+    ensure_index(conn, 'message_reactions', 'idx_reaction_message_user_emoji', ('message_id', 'user_id', 'emoji'))
+    ensure_index(conn, 'message_reads', 'idx_read_message_user', ('message_id', 'user_id'))
+    ensure_index(conn, 'channel_participants', 'idx_participant_channel_user', ('channel_id', 'user_id'))
+    ensure_index(conn, 'game_sessions', 'ix_game_sessions_code', ('code',))
+    # Index déclarés dans les modèles
+    ensure_index(conn, 'channel_participants', 'idx_participant_user_channel', ('user_id', 'channel_id'))
+    ensure_index(conn, 'online_presence', 'idx_presence_socket', ('socket_id',))
+    ensure_index(conn, 'online_presence', 'idx_presence_last_ping', ('last_ping',))
+    ensure_index(conn, 'file_attachments', 'idx_attachment_message', ('message_id',))
+    ensure_index(conn, 'file_attachments', 'idx_attachment_uploader_created', ('uploader_id', 'created_at'))
+
+
+@migration(10, "Fichiers déposés sans message")
+def _standalone_uploads(conn):
+    if 'is_standalone' in {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(file_attachments)")}:
+        return
+    add_columns(conn, 'file_attachments', [('is_standalone', 'BOOLEAN NOT NULL', '0')])
+    # Impossible de distinguer les anciens dépôts directs des uploads abandonnés :
+    # les fichiers déjà sans message sont conservés
+    conn.exec_driver_sql("UPDATE file_attachments SET is_standalone = 1 WHERE message_id IS NULL")
+
+
+@migration(11, "Disponibilité des miniatures WebP")
+def _thumbnail_webp_flag(conn):
+    if 'thumbnail_has_webp' in {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(file_attachments)")}:
+        return
+    add_columns(conn, 'file_attachments', [('thumbnail_has_webp', 'BOOLEAN NOT NULL', '0')])
+    # Constat unique sur disque pour les miniatures déjà rendues ; ensuite le pool le renseigne
+    rows = conn.exec_driver_sql(
+        "SELECT id, thumbnail_path FROM file_attachments WHERE thumbnail_path IS NOT NULL"
+    ).fetchall()
+    with_webp = [{'id': file_id} for file_id, path in rows if os.path.exists(os.path.splitext(path)[0] + '.webp')]
+    if with_webp:
+        conn.execute(text("UPDATE file_attachments SET thumbnail_has_webp = 1 WHERE id = :id"), with_webp)
+    print(f"[DB] Miniatures WebP recensées: {len(with_webp)}/{len(rows)}")
+
+
+# ============================================
+# RATTRAPAGES DE DONNÉES
+# ============================================
+def backfill_dm_keys(conn):
+    """Attribue la clé canonique aux DM existants (2 participants distincts).
+
+    En cas de doublons historiques pour une même paire, la conversation la plus
+    ancienne reçoit la clé ; les autres restent consultables mais ne sont plus
+    proposées pour les nouveaux messages.
+    """
+    rows = conn.execute(text("""
+        SELECT cp.channel_id, MIN(cp.user_id), MAX(cp.user_id), c.created_at
+        FROM channel_participants cp
+        JOIN channels c ON c.id = cp.channel_id
+        WHERE c.channel_type = 'dm' AND c.dm_key IS NULL
+        GROUP BY cp.channel_id
+        HAVING COUNT(DISTINCT cp.user_id) = 2
+        ORDER BY c.created_at
+    """)).fetchall()
+    if not rows:
+        return
+    taken = {r[0] for r in conn.execute(text("SELECT dm_key FROM channels WHERE dm_key IS NOT NULL"))}
+    assigned = 0
+    for channel_id, user_a, user_b, _ in rows:
+        key = dm_pair_key(user_a, user_b)
+        if key in taken:
+            continue
+        conn.execute(text("UPDATE channels SET dm_key = :k WHERE id = :id"), {'k': key, 'id': channel_id})
+        taken.add(key)
+        assigned += 1
+    print(f"[DB] Clés DM canoniques attribuées: {assigned}/{len(rows)}")
+
+
+def backfill_dm_conversations(conn):
+    """Construit les résumés de DM manquants à partir des participants existants"""
+    existing = {
+        (r[0], r[1]) for r in conn.execute(text("SELECT user_id, channel_id FROM dm_conversations"))
+    }
+    participants = conn.execute(text("""
+        SELECT cp.channel_id, cp.user_id, c.created_at
+        FROM channel_participants cp
+        JOIN channels c ON c.id = cp.channel_id
+        WHERE c.channel_type = 'dm'
+    """)).fetchall()
+    missing = [r for r in participants if (r[1], r[0]) not in existing]
+    if not missing:
+        return
+    members = {}
+    for channel_id, user_id, _ in participants:
+        members.setdefault(channel_id, []).append(user_id)
+    # Dernier message visible de chaque DM (SQLite renvoie la ligne du MAX)
+    last_messages = {
+        r[0]: (r[1], r[2]) for r in conn.execute(text("""
+            SELECT m.channel_id, m.id, MAX(m.created_at)
+            FROM messages m
+            JOIN channels c ON c.id = m.channel_id
+            WHERE c.channel_type = 'dm' AND m.is_deleted = 0
+            GROUP BY m.channel_id
+        """))
+    }
+    rows = []
+    for channel_id, user_id, channel_created_at in missing:
+        peer_id = next((u for u in members.get(channel_id, []) if u != user_id), None)
+        last_id, last_at = last_messages.get(channel_id, (None, None))
+        rows.append({
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'channel_id': channel_id,
+            'peer_id': peer_id,
+            'last_message_id': last_id,
+            'last_activity_at': last_at or channel_created_at or datetime.utcnow(),
+        })
+    conn.execute(text("""
+        INSERT INTO dm_conversations (id, user_id, channel_id, peer_id, last_message_id, last_activity_at)
+        VALUES (:id, :user_id, :channel_id, :peer_id, :last_message_id, :last_activity_at)
+    """), rows)
+    print(f"[DB] Résumés de conversations privées créés: {len(rows)}")
+
+
+def backfill_storage_usage(conn):
+    """Initialise les compteurs de quota (lignes encore à NULL)"""
+    for table, column in (('users', 'uploader_id'), ('channels', 'channel_id')):
+        conn.execute(text(
+            f"UPDATE {table} SET storage_used = (SELECT COALESCE(SUM(file_size), 0) FROM file_attachments "
+            f"WHERE file_attachments.{column} = {table}.id) WHERE storage_used IS NULL"
+        ))
+
+
+# ============================================
+# EXÉCUTION
+# ============================================
+def pending_migrations(engine):
+    """Versions restant à appliquer (une lecture de PRAGMA user_version)"""
+    with engine.connect() as conn:
+        current = get_schema_version(conn)
+    return [version for version, _, _ in MIGRATIONS if version > current]
+
+
+def _create_migrations_table(conn):
+    conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME NOT NULL,
+            duration_ms INTEGER NOT NULL
+        )
+    """)
+
+
+def _record_version(conn, version, description, duration_ms):
+    conn.execute(text("""
+        INSERT OR REPLACE INTO schema_migrations (version, description, applied_at, duration_ms)
+        VALUES (:version, :description, :applied_at, :duration_ms)
+    """), {'version': version, 'description': description,
+           'applied_at': datetime.now(timezone.utc), 'duration_ms': duration_ms})
+    conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def _initialize_empty_database(conn):
+    """Base sans aucune table : schéma des modèles actuels, directement à latest_version().
+
+    Retourne False si la base n'est pas vide (un autre processus a pu l'initialiser
+    pendant l'attente du verrou) : l'historique des migrations s'applique alors.
+    """
+    empty = is_empty_database(conn)
+    conn.commit()
+    if not empty:
+        return False
+    started = time.monotonic()
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+    try:
+        if get_schema_version(conn) or not is_empty_database(conn):
+            conn.commit()
+            return False
+        db.metadata.create_all(bind=conn)
+        _create_migrations_table(conn)
+        duration_ms = int((time.monotonic() - started) * 1000)
+        _record_version(conn, latest_version(), "Schéma initial (base neuve)", duration_ms)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        print("[DB] Échec de la création du schéma initial, annulée")
+        raise
+    print(f"[DB] Base neuve initialisée en version {latest_version()} ({duration_ms} ms)")
+    return True
+
+
+def apply_migrations(engine):
+    """Amène la base à latest_version() ; retourne la liste des versions appliquées.
+
+    Base à jour : une seule lecture de PRAGMA user_version. Une migration qui
+    échoue est annulée en entier et l'exception remonte (version inchangée).
+    """
+    applied = []
+    with engine.connect() as conn:
+        current = get_schema_version(conn)
+        conn.commit()
+        if current >= latest_version():
+            return applied
+        if current == 0 and _initialize_empty_database(conn):
+            return [latest_version()]
+        _create_migrations_table(conn)
+        conn.commit()
+        for version, description, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            started = time.monotonic()
+            # Transaction explicite : le pilote sqlite3 validerait sinon chaque DDL isolément
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                # Un autre processus a pu migrer pendant l'attente du verrou
+                current = get_schema_version(conn)
+                if version <= current:
+                    conn.commit()
+                    continue
+                fn(conn)
+                duration_ms = int((time.monotonic() - started) * 1000)
+                _record_version(conn, version, description, duration_ms)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                print(f"[DB] Échec de la migration {version} ({description}), annulée")
+                raise
+            current = version
+            applied.append(version)
+            print(f"[DB] Migration {version} appliquée: {description} ({duration_ms} ms)")
+    return applied
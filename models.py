@@ -48,6 +48,9 @@ class ActionType:
     DELETE_MESSAGE = "delete_message"
     EDIT_MESSAGE = "edit_message"
     UPLOAD_FILE = "upload_file"
+    BULK_MODERATION = "bulk_moderation"
+    SET_QUOTA = "set_quota"
+    ORPHAN_GC = "orphan_gc"
 
 # ============================================
 # MODÈLE UTILISATEUR
@@ -64,8 +67,15 @@ class User(UserMixin, db.Model):
     display_name = db.Column(db.String(100), nullable=True)
     bio = db.Column(db.Text, nullable=True)
     avatar_filename = db.Column(db.String(255), nullable=True)
+    # Variantes générées : "<format>:<taille>,<taille>,..." (NULL tant qu'elles ne sont pas prêtes)
+    avatar_variants = db.Column(db.String(100), nullable=True)
     banner_filename = db.Column(db.String(255), nullable=True)
     
+    # Stockage : octets des pièces jointes envoyées (compteur maintenu) et quota
+    # propre (NULL = USER_STORAGE_QUOTA, 0 = illimité)
+    storage_used = db.Column(db.BigInteger, default=0, nullable=True)
+    storage_quota = db.Column(db.BigInteger, nullable=True)
+    
     # Rôle et statut
     role = db.Column(db.String(20), default=UserRole.MEMBER, nullable=False)
     is_active = db.Column(db.Boolean, default=True, nullable=False)
@@ -112,10 +122,20 @@ class User(UserMixin, db.Model):
     def is_supreme(self):
         return self.role == UserRole.SUPREME
     
-    def get_avatar_url(self):
-        if self.avatar_filename:
-            return f"/uploads/avatars/{self.avatar_filename}"
-        return "/static/icons/default_avatar.svg"
+    def get_avatar_url(self, size=None):
+        """URL de l'avatar ; avec size, la plus petite variante couvrant cette taille"""
+        if not self.avatar_filename:
+            return "/static/icons/default_avatar.svg"
+        if self.avatar_variants and ':' in self.avatar_variants:
+            fmt, sizes = self.avatar_variants.split(':', 1)
+            available = sorted(int(v) for v in sizes.split(',') if v.isdigit())
+            if available:
+                chosen = available[-1]
+                if size:
+                    chosen = next((v for v in available if v >= size), available[-1])
+                stem = self.avatar_filename.rsplit('.', 1)[0]
+                return f"/uploads/avatars/{stem}_{chosen}.{fmt}"
+        return f"/uploads/avatars/{self.avatar_filename}"
     
     def get_banner_url(self):
         if self.banner_filename:
@@ -134,7 +154,9 @@ class User(UserMixin, db.Model):
             'id': self.id,
             'username': self.username,
             'display_name': self.display_name or self.username,
-            'avatar': self.get_avatar_url(),
+            'avatar': self.get_avatar_url(128),
+            'avatar_small': self.get_avatar_url(64),
+            'avatar_large': self.get_avatar_url(),
             'banner': self.get_banner_url(),
             'bio': self.bio,
             'role': self.role,
@@ -184,6 +206,16 @@ class Channel(db.Model):
     # Permissions
     is_read_only = db.Column(db.Boolean, default=False, nullable=False)
     
+    # Clé canonique des DM : "<id_min>:<id_max>" (NULL pour les autres salons)
+    dm_key = db.Column(db.String(80), nullable=True, unique=True, index=True)
+    
+    # Numéro du dernier message (compteur monotone pour les non-lus)
+    message_seq = db.Column(db.Integer, default=0, nullable=False)
+    
+    # Stockage des pièces jointes du salon (compteur maintenu) et quota (NULL = CHANNEL_STORAGE_QUOTA)
+    storage_used = db.Column(db.BigInteger, default=0, nullable=True)
+    storage_quota = db.Column(db.BigInteger, nullable=True)
+    
     # Relations
     messages = db.relationship('Message', backref='channel', lazy='dynamic',
                                foreign_keys='Message.channel_id')
@@ -206,6 +238,11 @@ class Channel(db.Model):
 # ============================================
 # MODÈLE PARTICIPANT SALON
 # ============================================
+def dm_pair_key(user_a_id, user_b_id):
+    """Clé canonique (triée) identifiant la conversation privée entre deux utilisateurs"""
+    a, b = sorted([str(user_a_id), str(user_b_id)])
+    return f"{a}:{b}"
+
 class ChannelParticipant(db.Model):
     __tablename__ = 'channel_participants'
     
@@ -217,6 +254,8 @@ class ChannelParticipant(db.Model):
     
     __table_args__ = (
         db.UniqueConstraint('channel_id', 'user_id', name='unique_channel_user'),
+        # Salons d'un utilisateur (l'unicité ci-dessus ne sert que les recherches par salon)
+        db.Index('idx_participant_user_channel', 'user_id', 'channel_id'),
     )
 
 # ============================================
@@ -242,6 +281,9 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False, index=True)
     edited_at = db.Column(db.DateTime, nullable=True)
     
+    # Position dans le salon (Channel.message_seq au moment de l'envoi)
+    seq = db.Column(db.Integer, nullable=True)
+    
     __table_args__ = (
         db.Index('idx_message_channel_composite', 'channel_id', 'created_at'),
         # Index composite pour l'isolation stricte des messages par canal (remplace (roomId, roomType, msgId))
@@ -341,15 +383,31 @@ class FileAttachment(db.Model):
     channel_id = db.Column(db.String(36), db.ForeignKey('channels.id'), nullable=True, index=True)
     uploader_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
     
-    filename = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(255), nullable=False, index=True)
     original_filename = db.Column(db.String(255), nullable=False)
     file_type = db.Column(db.String(50), nullable=False)
     file_size = db.Column(db.Integer, nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
     thumbnail_path = db.Column(db.String(500), nullable=True)
+    # Variante WebP écrite à côté de la miniature JPEG (renseigné à la fin du rendu)
+    thumbnail_has_webp = db.Column(db.Boolean, default=False, nullable=False)
+    
+    # Empreinte SHA-256 du contenu (blob partagé, voir FileBlob) ; NULL = fichier hérité
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+    
+    # Déposé directement (glisser-déposer / sélecteur) et non préparé pour un message :
+    # message_id reste NULL sans que le fichier soit orphelin
+    is_standalone = db.Column(db.Boolean, default=False, nullable=False)
     
     created_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False)
     
+    __table_args__ = (
+        # Message.attachments, ramasse-miettes et suppressions en cascade
+        db.Index('idx_attachment_message', 'message_id'),
+        # Filtre « envoyé par » de la galerie et suppression massive par utilisateur
+        db.Index('idx_attachment_uploader_created', 'uploader_id', 'created_at'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -362,6 +420,7 @@ class FileAttachment(db.Model):
             'uploader': self.uploader.to_dict(include_sensitive=False) if self.uploader else None,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'thumbnail': f"/uploads/files/.thumbs/{self.id}.jpg" if self.thumbnail_path else None,
+            'thumbnail_webp': f"/uploads/files/.thumbs/{self.id}.webp" if self.thumbnail_path and self.thumbnail_has_webp else None,
             'is_image': self.file_type in ('image', 'gif'),
             'is_video': self.file_type == 'video',
             'is_audio': self.file_type == 'audio',
@@ -369,6 +428,57 @@ class FileAttachment(db.Model):
             'is_file': self.file_type == 'file',
         }
 
+# ============================================
+# MODÈLE BLOB (CONTENU DÉDUPLIQUÉ)
+# ============================================
+class FileBlob(db.Model):
+    """Contenu stocké une seule fois, partagé par les FileAttachment de même empreinte"""
+    __tablename__ = 'file_blobs'
+    
+    content_hash = db.Column(db.String(64), primary_key=True)
+    file_path = db.Column(db.String(500), nullable=False)
+    file_size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False)
+
+# ============================================
+# MODÈLE TÂCHE DE SUPPRESSION MASSIVE
+# ============================================
+class BulkDeleteJob(db.Model):
+    """Suppression massive de fichiers exécutée en arrière-plan, reprise après un crash"""
+    __tablename__ = 'bulk_delete_jobs'
+
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    requested_by = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
+    filter_type = db.Column(db.String(20), nullable=False)
+    filter_value = db.Column(db.String(255), nullable=True)
+    start_date = db.Column(db.String(10), nullable=True)
+    end_date = db.Column(db.String(10), nullable=True)
+    # pending, running, done, failed, cancelled
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True)
+    total = db.Column(db.Integer, default=0, nullable=False)
+    deleted_count = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False)
+    updated_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'requested_by': self.requested_by,
+            'filter_type': self.filter_type,
+            'filter_value': self.filter_value,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'status': self.status,
+            'total': self.total,
+            'deleted_count': self.deleted_count,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
 # ============================================
 # MODÈLE IP BANNIE
 # ============================================
@@ -408,6 +518,13 @@ class AuditLog(db.Model):
     
     created_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False, index=True)
     
+    __table_args__ = (
+        # Index composites pour les filtres du journal + pagination par curseur (created_at, id)
+        db.Index('idx_audit_created_id', 'created_at', 'id'),
+        db.Index('idx_audit_action_created', 'action_type', 'created_at', 'id'),
+        db.Index('idx_audit_actor_created', 'actor_id', 'created_at', 'id'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -462,6 +579,43 @@ class MessageRead(db.Model):
         db.UniqueConstraint('message_id', 'user_id', name='unique_message_read'),
     )
 
+# ============================================
+# MODÈLE CURSEUR DE LECTURE (NON-LUS / MENTIONS)
+# ============================================
+class ChannelReadState(db.Model):
+    """Curseur de lecture par (utilisateur, salon) : non-lus = message_seq - read_seq"""
+    __tablename__ = 'channel_read_states'
+    
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
+    channel_id = db.Column(db.String(36), db.ForeignKey('channels.id'), nullable=False)
+    read_seq = db.Column(db.Integer, default=0, nullable=False)
+    mention_count = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'channel_id', name='unique_channel_read_state'),
+    )
+
+# ============================================
+# MODÈLE RÉSUMÉ DE CONVERSATION PRIVÉE
+# ============================================
+class DMConversation(db.Model):
+    """Résumé matérialisé d'un DM pour un utilisateur (une ligne par participant)"""
+    __tablename__ = 'dm_conversations'
+    
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=False)
+    channel_id = db.Column(db.String(36), db.ForeignKey('channels.id'), nullable=False)
+    peer_id = db.Column(db.String(36), db.ForeignKey('users.id'), nullable=True)
+    last_message_id = db.Column(db.String(36), db.ForeignKey('messages.id'), nullable=True)
+    last_activity_at = db.Column(db.DateTime, default=get_current_utc_time, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'channel_id', name='unique_dm_conversation'),
+        db.Index('idx_dm_conv_user_activity', 'user_id', 'last_activity_at', 'channel_id'),
+    )
+
 # ============================================
 # MODÈLE PRÉSENCE EN LIGNE
 # ============================================
@@ -477,6 +631,13 @@ class OnlinePresence(db.Model):
     typing_channel = db.Column(db.String(36), nullable=True)
     last_ping = db.Column(db.DateTime, default=get_current_utc_time, nullable=False)
     
+    __table_args__ = (
+        # Déconnexion Socket.IO : la présence est retrouvée par son SID
+        db.Index('idx_presence_socket', 'socket_id'),
+        # Comptage des utilisateurs en ligne (last_ping récent)
+        db.Index('idx_presence_last_ping', 'last_ping'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
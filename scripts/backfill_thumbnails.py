@@ -0,0 +1,28 @@
+import os
+import sys
+import time
+
+# Rattrapage des miniatures pour les fichiers déjà présents.
+# Usage : python scripts/backfill_thumbnails.py
+
+def main():
+    base_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    sys.path.insert(0, base_dir)
+    from app import app, backfill_thumbnails, get_thumbnail_metrics
+
+    with app.app_context():
+        total = backfill_thumbnails()
+    print(f"{total} miniatures programmées")
+
+    # Attendre que le pool ait traité toute la file
+    while True:
+        metrics = get_thumbnail_metrics()
+        finished = metrics['done'] + metrics['failed'] + metrics['unsupported']
+        print(f"\r{finished}/{total} (échecs: {metrics['failed']}, non pris en charge: {metrics['unsupported']})", end="")
+        if finished >= total:
+            break
+        time.sleep(1)
+    print()
+
+if __name__ == "__main__":
+    main()
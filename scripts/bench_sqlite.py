@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import uuid
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+# Banc d'essai SQLite : débit lecture/écriture sous charge concurrente façon
+# Socket.IO (send_message = INSERT + mise à jour de présence, get_messages =
+# 50 derniers messages d'un salon), avant / après le profil SQLITE_PRAGMAS.
+# Usage : python scripts/bench_sqlite.py [--duration 10] [--readers 16] [--writers 4]
+
+# Réglages d'origine : journal rollback, synchronous FULL, timeout=30 de l'URI
+BASELINE_PRAGMAS = (
+    ('journal_mode', 'DELETE'),
+    ('synchronous', 'FULL'),
+    ('busy_timeout', 30000),
+)
+
+SCHEMA = """
+CREATE TABLE messages (
+    id VARCHAR(36) PRIMARY KEY,
+    channel_id VARCHAR(36) NOT NULL,
+    user_id VARCHAR(36) NOT NULL,
+    content TEXT,
+    created_at DATETIME NOT NULL
+);
+CREATE INDEX idx_message_channel_composite ON messages (channel_id, created_at);
+CREATE TABLE online_presence (
+    user_id VARCHAR(36) PRIMARY KEY,
+    socket_id VARCHAR(100) NOT NULL,
+    last_ping DATETIME NOT NULL
+);
+"""
+
+def connect(path, pragmas):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    for name, value in pragmas:
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+def seed(path, pragmas, channels, users, rows):
+    conn = connect(path, pragmas)
+    conn.executescript(SCHEMA)
+    now = time.time()
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO messages VALUES (?, ?, ?, ?, datetime(?, 'unixepoch'))",
+        ((str(uuid.uuid4()), random.choice(channels), random.choice(users), 'x' * 120, now - i)
+         for i in range(rows))
+    )
+    conn.executemany("INSERT INTO online_presence VALUES (?, ?, datetime('now'))",
+                     ((user, uuid.uuid4().hex) for user in users))
+    conn.execute("COMMIT")
+    conn.close()
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000
+
+def run_profile(label, pragmas, args):
+    workdir = tempfile.mkdtemp(prefix='kronos_bench_')
+    path = os.path.join(workdir, 'bench.db')
+    channels = [str(uuid.uuid4()) for _ in range(20)]
+    users = [str(uuid.uuid4()) for _ in range(200)]
+    seed(path, pragmas, channels, users, args.seed_rows)
+
+    stop = threading.Event()
+    results = {'read': [], 'write': [], 'errors': 0}
+    lock = threading.Lock()
+
+    def writer():
+        conn = connect(path, pragmas)
+        latencies, errors = [], 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                user = random.choice(users)
+                conn.execute("INSERT INTO messages VALUES (?, ?, ?, ?, datetime('now'))",
+                             (str(uuid.uuid4()), random.choice(channels), user, 'bench'))
+                conn.execute("UPDATE online_presence SET last_ping = datetime('now') WHERE user_id = ?", (user,))
+                conn.execute("COMMIT")
+                latencies.append(time.perf_counter() - started)
+            except sqlite3.OperationalError:
+                errors += 1
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.OperationalError:
+                    pass
+        conn.close()
+        with lock:
+            results['write'].extend(latencies)
+            results['errors'] += errors
+
+    def reader():
+        conn = connect(path, pragmas)
+        latencies, errors = [], 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                conn.execute(
+                    "SELECT id, user_id, content, created_at FROM messages WHERE channel_id = ? "
+                    "ORDER BY created_at DESC LIMIT 50", (random.choice(channels),)
+                ).fetchall()
+                conn.execute("SELECT socket_id FROM online_presence WHERE user_id = ?",
+                             (random.choice(users),)).fetchone()
+                latencies.append(time.perf_counter() - started)
+            except sqlite3.OperationalError:
+                errors += 1
+        conn.close()
+        with lock:
+            results['read'].extend(latencies)
+            results['errors'] += errors
+
+    threads = [threading.Thread(target=writer) for _ in range(args.writers)]
+    threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+    os.rmdir(workdir)
+
+    return {
+        'label': label,
+        'reads_per_s': len(results['read']) / args.duration,
+        'writes_per_s': len(results['write']) / args.duration,
+        'read_p95_ms': percentile(results['read'], 95),
+        'write_p95_ms': percentile(results['write'], 95),
+        'write_p99_ms': percentile(results['write'], 99),
+        'errors': results['errors'],
+    }
+
+def main():
+    base_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    sys.path.insert(0, base_dir)
+    from config import SQLITE_PRAGMAS
+
+    parser = argparse.ArgumentParser(description="Banc d'essai du profil SQLite KRONOS")
+    parser.add_argument('--duration', type=float, default=10.0, help="durée de chaque mesure (s)")
+    parser.add_argument('--readers', type=int, default=16, help="threads lecteurs (get_messages)")
+    parser.add_argument('--writers', type=int, default=4, help="threads écrivains (send_message)")
+    parser.add_argument('--seed-rows', type=int, default=20000, help="messages préchargés")
+    args = parser.parse_args()
+
+    rows = [run_profile('avant (rollback, FULL)', BASELINE_PRAGMAS, args),
+            run_profile('après (SQLITE_PRAGMAS)', SQLITE_PRAGMAS, args)]
+
+    print(f"{'profil':<26}{'lect./s':>10}{'écr./s':>10}{'lect. p95':>12}{'écr. p95':>11}{'écr. p99':>11}{'erreurs':>9}")
+    for r in rows:
+        print(f"{r['label']:<26}{r['reads_per_s']:>10.0f}{r['writes_per_s']:>10.0f}"
+              f"{r['read_p95_ms']:>10.2f}ms{r['write_p95_ms']:>9.2f}ms{r['write_p99_ms']:>9.2f}ms{r['errors']:>9}")
+    before, after = rows
+    if before['reads_per_s'] and before['writes_per_s']:
+        print(f"Gain : lectures x{after['reads_per_s'] / before['reads_per_s']:.2f}, "
+              f"écritures x{after['writes_per_s'] / before['writes_per_s']:.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import tempfile
+
+# Vérifie le plan d'exécution (EXPLAIN QUERY PLAN) des requêtes fréquentes
+# d'app.py : code de sortie 1 si l'une d'elles parcourt une table entière.
+# Par défaut sur une base neuve amenée à la dernière version de schéma ;
+# --db pour contrôler une base existante (index réellement présents).
+# Usage : python scripts/check_query_plans.py [--db data/kronos.db] [-v]
+
+def hot_queries():
+    """(nom, instruction SQLAlchemy d'app.py, tables dont le parcours complet est attendu)
+
+    Les instructions sont construites comme dans app.py sur les modèles réels,
+    puis compilées avec le dialecte SQLite : le SQL contrôlé est celui de l'ORM.
+    """
+    from sqlalchemy import select, update, func, and_, bindparam
+    from models import (User, Channel, ChannelParticipant, Message, MessageReaction, MessageRead,
+                        FileAttachment, FileBlob, ChannelReadState, DMConversation, OnlinePresence,
+                        GameSession, BannedIP, AuditLog)
+
+    FA = FileAttachment
+    channel_gone = and_(FA.channel_id.isnot(None), Channel.id.is_(None))
+    orphan_conditions = {
+        'channel_deleted': channel_gone,
+        'message_deleted': and_(FA.message_id.isnot(None), Message.id.is_(None), ~channel_gone),
+        'unlinked': and_(FA.message_id.is_(None), FA.is_standalone.is_(False),
+                         FA.created_at < bindparam('cutoff'), ~channel_gone),
+    }
+    blob_references = (select(func.count(FA.id))
+                       .where(FA.content_hash == FileBlob.content_hash)
+                       .scalar_subquery())
+    names = ['a', 'b']
+
+    queries = [
+        ('toggle_reaction', select(MessageReaction).filter_by(message_id='m', user_id='u', emoji='e').limit(1)),
+        ('Message.reactions', select(MessageReaction).where(MessageReaction.message_id == 'm')),
+        ('mark_as_read', select(MessageRead).filter_by(message_id='m', user_id='u').limit(1)),
+        ('Message.read_by', select(MessageRead).where(MessageRead.message_id == 'm')),
+        ('participant du salon', select(ChannelParticipant).filter_by(channel_id='c', user_id='u').limit(1)),
+        ('interlocuteur DM', select(ChannelParticipant)
+            .where(ChannelParticipant.channel_id == 'c', ChannelParticipant.user_id != 'u').limit(1)),
+        ('salons d\'un utilisateur', select(ChannelParticipant.channel_id).where(ChannelParticipant.user_id == 'u')),
+        ('membres du salon', select(User).join(ChannelParticipant, ChannelParticipant.user_id == User.id)
+            .where(ChannelParticipant.channel_id == 'c')),
+        ('présence par utilisateur', select(OnlinePresence).filter_by(user_id='u').limit(1)),
+        ('handle_disconnect', select(OnlinePresence).filter_by(socket_id='s').limit(1)),
+        ('utilisateurs en ligne', select(func.count(OnlinePresence.id))
+            .where(OnlinePresence.last_ping > bindparam('since'))),
+        ('partie par code', select(GameSession).filter_by(code='c').limit(1)),
+        ('Message.attachments', select(FA).where(FA.message_id == 'm')),
+        ('galerie par uploader', select(FA).where(FA.uploader_id.in_(names))
+            .order_by(FA.created_at.desc(), FA.id.desc()).limit(51)),
+        ('suppression massive par uploader', select(FA.id)
+            .where(FA.uploader_id == 'u', FA.created_at <= bindparam('before'))),
+        ('dédoublonnage par empreinte', select(FA).filter_by(content_hash='h').limit(1)),
+        ('blob par empreinte', select(FileBlob).where(FileBlob.content_hash == 'h')),
+        ('get_messages', select(Message).filter_by(channel_id='c', is_deleted=False)
+            .order_by(Message.created_at.desc()).limit(50)),
+        ('get_messages (before)', select(Message).filter_by(channel_id='c', is_deleted=False)
+            .where(Message.created_at < bindparam('before')).order_by(Message.created_at.desc()).limit(50)),
+        ('curseur de lecture', select(ChannelReadState).filter_by(user_id='u', channel_id='c').limit(1)),
+        ('liste des DM', select(DMConversation).filter_by(user_id='u')
+            .order_by(DMConversation.last_activity_at.desc(), DMConversation.channel_id.desc()).limit(50)),
+        ('DM par clé', select(Channel).filter_by(dm_key='k').limit(1)),
+        ('connexion (username)', select(User).filter_by(username='u').limit(1)),
+        ('connexion (email)', select(User).filter_by(email='e').limit(1)),
+        ('IP bannie', select(BannedIP).filter_by(ip_address='ip').limit(1)),
+        ('journal d\'audit', select(AuditLog).order_by(AuditLog.created_at.desc(), AuditLog.id.desc()).limit(50)),
+        # get_gallery_facets : agrégats sur toute la table, mis en cache GALLERY_FACETS_TTL
+        ('facettes (types)', select(FA.file_type, func.count(FA.id)).group_by(FA.file_type),
+            ('file_attachments',)),
+        ('facettes (uploadeurs)', select(User).where(User.id.in_(select(FA.uploader_id).distinct()))
+            .order_by(User.username), ('users', 'file_attachments')),
+        ('facettes (extensions)', select(func.lower(func.substr(
+                FA.original_filename,
+                func.length(func.rtrim(FA.original_filename, func.replace(FA.original_filename, '.', ''))) + 1)))
+            .where(FA.original_filename.like('%.%')).distinct(), ('file_attachments',)),
+    ]
+    # Ramasse-miettes : lots parcourus par clé primaire
+    for reason, condition in orphan_conditions.items():
+        queries.append((f'GC pièces jointes ({reason})',
+                        select(FA.id, FA.file_path, FA.content_hash, FA.file_size)
+                        .outerjoin(Channel, Channel.id == FA.channel_id)
+                        .outerjoin(Message, Message.id == FA.message_id)
+                        .where(condition, FA.id > bindparam('last_id'))
+                        .order_by(FA.id).limit(500)))
+    queries += [
+        ('GC blobs sans référence', select(FileBlob.content_hash, FileBlob.file_path, FileBlob.file_size,
+                                           FileBlob.ref_count, blob_references.label('actual'),
+                                           (FileBlob.created_at < bindparam('cutoff')).label('expired'))
+            .where(FileBlob.content_hash > bindparam('last_hash')).order_by(FileBlob.content_hash).limit(500)),
+        ('_known_legacy_files', select(FA.filename).where(FA.filename.in_(names))),
+        ('_known_blob_files', select(FileBlob.content_hash).where(FileBlob.content_hash.in_(names))),
+        ('_known_thumbnails', select(FA.id).where(FA.id.in_(names))),
+    ]
+    # reconcile_storage_usage : réécrit chaque ligne, seule la sous-requête doit passer par un index
+    for model, column in ((User, FA.uploader_id), (Channel, FA.channel_id)):
+        usage = (select(func.coalesce(func.sum(FA.file_size), 0))
+                 .where(column == model.id).scalar_subquery())
+        queries.append((f'reconcile_storage_usage ({model.__tablename__})',
+                        update(model).values(storage_used=usage), (model.__tablename__,)))
+    return [query if len(query) == 3 else query + ((),) for query in queries]
+
+def compile_sqlite(statement):
+    """SQL émis par l'ORM pour SQLite (paramètres « ? », listes IN dépliées)"""
+    from sqlalchemy.dialects import sqlite
+    return str(statement.compile(dialect=sqlite.dialect(), compile_kwargs={'render_postcompile': True}))
+
+def build_fresh_database(path):
+    """Base vide migrée à la dernière version (mêmes DDL que le démarrage de l'application)"""
+    from sqlalchemy import create_engine
+    from migrations import apply_migrations
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        apply_migrations(engine)
+    finally:
+        engine.dispose()
+
+# « SCAN t » sans index (« SCAN TABLE t » avant SQLite 3.36)
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+def query_plan(conn, sql):
+    params = (None,) * sql.count('?')
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+def unexpected_scans(plan, allowed=()):
+    scans = []
+    for step in plan:
+        match = FULL_SCAN.match(step)
+        if match and match.group(1) not in allowed:
+            scans.append(step)
+    return scans
+
+def check(conn, queries, verbose=False):
+    failures = []
+    for name, statement, allowed in queries:
+        sql = compile_sqlite(statement)
+        try:
+            plan = query_plan(conn, sql)
+            scans = unexpected_scans(plan, allowed)
+        except sqlite3.OperationalError as e:
+            # Table ou colonne absente : base pas encore migrée
+            plan = scans = [f"erreur: {e}"]
+        if scans:
+            failures.append((name, sql, plan))
+        if verbose or scans:
+            print(f"{'ÉCHEC' if scans else 'ok':<6}{name}")
+            for step in plan:
+                print(f"        {step}")
+    return failures
+
+def main():
+    base_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    sys.path.insert(0, base_dir)
+
+    parser = argparse.ArgumentParser(description="Contrôle des plans d'exécution des requêtes fréquentes")
+    parser.add_argument('--db', help="base existante à contrôler (par défaut : base neuve migrée)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="affiche le plan de chaque requête")
+    args = parser.parse_args()
+
+    queries = hot_queries()
+    workdir = None
+    if args.db:
+        path = args.db
+    else:
+        workdir = tempfile.mkdtemp(prefix='kronos_plans_')
+        path = os.path.join(workdir, 'plans.db')
+        build_fresh_database(path)
+
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    try:
+        failures = check(conn, queries, args.verbose)
+    finally:
+        conn.close()
+        if workdir:
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+            os.rmdir(workdir)
+
+    if failures:
+        print(f"{len(failures)}/{len(queries)} requête(s) en parcours complet de table ou sur un schéma incomplet")
+        sys.exit(1)
+    print(f"{len(queries)} requêtes fréquentes servies par un index")
+
+if __name__ == "__main__":
+    main()
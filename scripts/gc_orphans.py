@@ -0,0 +1,20 @@
+import os
+import sys
+import json
+
+# Ramasse-miettes des uploads orphelins.
+# Usage : python scripts/gc_orphans.py            (simulation, rien n'est supprimé)
+#         python scripts/gc_orphans.py --apply    (suppression réelle)
+
+def main():
+    base_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    sys.path.insert(0, base_dir)
+    from app import app, run_orphan_gc
+
+    dry_run = "--apply" not in sys.argv[1:]
+    with app.app_context():
+        report = run_orphan_gc(dry_run=dry_run)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
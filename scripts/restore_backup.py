@@ -0,0 +1,37 @@
+import os
+import sys
+
+# Restauration d'une sauvegarde de la base (serveur arrêté).
+# Usage : python scripts/restore_backup.py              (liste les sauvegardes)
+#         python scripts/restore_backup.py latest       (restaure la plus récente valide)
+#         python scripts/restore_backup.py kronos_20240101_120000.db
+
+def main():
+    base_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    sys.path.insert(0, base_dir)
+    import backups
+    from config import BACKUP_DIR, DB_PATH
+
+    available = backups.list_backups(BACKUP_DIR)
+    if len(sys.argv) < 2:
+        for path in reversed(available):
+            status = "ok" if backups.verify_checksum(path) else "empreinte invalide"
+            print(f"{path.name}  {path.stat().st_size:>12} octets  {status}")
+        return
+
+    if sys.argv[1] == "latest":
+        # La plus récente dont l'empreinte est valide
+        candidates = [p for p in reversed(available) if backups.verify_checksum(p)]
+        if not candidates:
+            sys.exit("Aucune sauvegarde valide")
+        target = candidates[0]
+    else:
+        target = BACKUP_DIR / os.path.basename(sys.argv[1])
+        if not target.exists():
+            sys.exit(f"Sauvegarde introuvable: {target}")
+
+    backups.restore(target, DB_PATH)
+    print(f"[BACKUP] Base restaurée depuis {target.name}")
+
+if __name__ == "__main__":
+    main()
@@ -1153,6 +1153,14 @@ const KRONOS = {
                     }
                 });
                 
+                this.socket.on('users_bulk_moderated', (data) => {
+                    try {
+                        this.handleUsersBulkModerated(data);
+                    } catch (e) {
+                        console.error('[KRONOS] Erreur handleUsersBulkModerated:', e);
+                    }
+                });
+                
                 this.socket.on('user_unbanned_broadcast', (data) => {
                     try {
                         this.handleUserUnbanned(data);
@@ -3439,7 +3447,7 @@ const KRONOS = {
     refreshPresence: function() {
         if (this.socket && this.state.isConnected) {
             // Émettre un ping pour mettre à jour notre présence
-            this.socket.emit('ping');
+            this.emitWithRetry('ping');
             
             // Demander la liste mise à jour des membres
             this.loadMembers();
@@ -3719,6 +3727,26 @@ const KRONOS = {
         this.loadMembers();  // Recharger la liste des membres
     },
     
+    // Modération de masse (diffusion agrégée) : même traitement que user_banned pour chaque compte
+    handleUsersBulkModerated: function(data) {
+        const userIds = data.user_ids || [];
+        if (data.action !== 'ban') {
+            console.log('[KRONOS] Action de masse:', data.action, userIds.length, 'comptes');
+            this.loadMembers();
+            return;
+        }
+        const usernames = data.usernames || {};
+        const known = this.state.allUsersMap || {};
+        userIds.forEach(userId => {
+            this.handleUserBanned({
+                user_id: userId,
+                username: usernames[userId] || known[userId]?.username || userId,
+                reason: data.reason,
+                banned_by: data.performed_by
+            });
+        });
+    },
+    
     // Gérer la notification qu'un utilisateur a été débanni (pour les autres utilisateurs)
     handleUserUnbanned: function(data) {
         this.showNotification(`@${data.username} a été rétabli par ${data.unbanned_by}`, 'success');
@@ -3910,15 +3938,45 @@ const KRONOS = {
         });
     },
     
-    // Charger les membres du salon - Version qualitative
-    loadMembers: async function() {
-        console.log('[KRONOS] loadMembers appelé - Version qualitative');
-        
+    // Émettre un événement ; s'il est refusé par le limiteur de débit du serveur
+    // (ack 'rate_limited'), nouvel essai différé, délai doublé jusqu'à 30 s
+    emitWithRetry: function(event, data, retryDelay = 2000) {
+        const onAck = (ack) => {
+            if (ack && ack.message === 'rate_limited') {
+                setTimeout(() => {
+                    if (this.socket && this.state.isConnected) {
+                        this.emitWithRetry(event, data, Math.min(retryDelay * 2, 30000));
+                    }
+                }, retryDelay);
+            }
+        };
+        if (data === undefined) {
+            this.socket.emit(event, onAck);
+        } else {
+            this.socket.emit(event, data, onAck);
+        }
+    },
+    
+    // Charger les membres du salon : les appels rapprochés (connexions / déconnexions
+    // en rafale, refreshPresence) sont regroupés en une seule demande
+    loadMembers: function(delay = 250) {
+        if (this._membersTimer) return;
+        this._membersTimer = setTimeout(() => {
+            this._membersTimer = null;
+            this.requestMembers();
+        }, delay);
+    },
+    
+    requestMembers: function() {
         try {
             // Émettre l'événement Socket.IO pour récupérer les membres
             if (this.socket && this.state.isConnected) {
-                this.socket.emit('get_members', { channel_id: this.state.currentChannel?.id });
-                console.log('[KRONOS] Événement get_members émis via Socket.IO');
+                this.socket.emit('get_members', { channel_id: this.state.currentChannel?.id }, (ack) => {
+                    // Refusé par le limiteur : redemander plus tard plutôt que garder une liste périmée
+                    if (ack && ack.message === 'rate_limited') {
+                        this.loadMembers(2000);
+                    }
+                });
             } else {
                 console.warn('[KRONOS] Socket non disponible, utilisation du fallback');
                 this.renderMembersFallback();
@@ -4730,7 +4788,9 @@ const KRONOS = {
 
                     const attemptUpload = () => {
                         const xhr = new XMLHttpRequest();
-                        xhr.open('POST', '/api/upload');
+                        // Salon en paramètre d'URL : le serveur vérifie le quota avant de lire le corps
+                        const uploadChannelId = formData.get('channel_id');
+                        xhr.open('POST', uploadChannelId ? `/api/upload?channel_id=${encodeURIComponent(uploadChannelId)}` : '/api/upload');
                         
                         xhr.upload.onprogress = (e) => {
                             if (e.lengthComputable && progressBar) {
@@ -4743,6 +4803,11 @@ const KRONOS = {
                         xhr.onload = () => {
                             if (xhr.status >= 200 && xhr.status < 300) {
                                 resolve(JSON.parse(xhr.responseText));
+                            } else if (xhr.status === 413) {
+                                // Quota ou taille dépassés : inutile de réessayer
+                                let message = 'Quota de stockage dépassé';
+                                try { message = JSON.parse(xhr.responseText).error || message; } catch (e) {}
+                                reject(new Error(message));
                             } else {
                                 if (retryCount < maxRetries) {
                                     retryCount++;
@@ -7215,6 +7280,9 @@ const KRONOS = {
             formData.append('file', file);
         }
         
+        // Dépôt direct : le fichier reste visible sans message (conservé par le ramasse-miettes)
+        formData.append('standalone', '1');
+        
         // Envoyer l'ID du canal pour organiser les fichiers
         if (this.state.currentChannel && this.state.currentChannel.id) {
             formData.append('channel_id', this.state.currentChannel.id);
@@ -7233,7 +7301,8 @@ const KRONOS = {
         }
         
         try {
-            const response = await fetch('/api/upload', {
+            const uploadChannelId = formData.get('channel_id');
+            const response = await fetch(uploadChannelId ? `/api/upload?channel_id=${encodeURIComponent(uploadChannelId)}` : '/api/upload', {
                 method: 'POST',
                 body: formData
             });
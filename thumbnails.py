@@ -0,0 +1,123 @@
+# KRONOS - Génération des miniatures et des variantes d'avatar
+# Exécuté dans les processus du pool : ce module ne doit importer ni Flask ni l'application.
+
+from pathlib import Path
+
+
+class PreviewUnavailable(Exception):
+    """Aucun moteur disponible pour produire l'aperçu (ex: PDF sans pdf2image/PyMuPDF)"""
+
+
+def _first_pdf_page(source_path, max_size):
+    """Rend la première page d'un PDF en image PIL (pdf2image puis PyMuPDF)"""
+    try:
+        from pdf2image import convert_from_path
+        pages = convert_from_path(source_path, first_page=1, last_page=1, size=(max_size * 2, None))
+        if pages:
+            return pages[0]
+    except ImportError:
+        pass
+    try:
+        import fitz
+        from PIL import Image
+        with fitz.open(source_path) as doc:
+            if doc.page_count == 0:
+                raise PreviewUnavailable('PDF vide')
+            page = doc.load_page(0)
+            zoom = max(0.1, (max_size * 2) / max(page.rect.width, 1))
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            return Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+    except ImportError:
+        raise PreviewUnavailable('pdf2image ou PyMuPDF requis pour les aperçus PDF')
+
+
+def render_thumbnails(source_path, kind, jpeg_path, webp_path, max_size=320):
+    """Produit les aperçus JPEG et WebP d'une image ou de la 1re page d'un PDF.
+
+    Retourne {'jpeg': bool, 'webp': bool}. Lève PreviewUnavailable ou l'erreur
+    Pillow si le fichier ne peut pas être lu.
+    """
+    from PIL import Image, ImageOps
+
+    if kind == 'pdf':
+        image = _first_pdf_page(source_path, max_size)
+    else:
+        image = Image.open(source_path)
+        # Décodage réduit pour les JPEG (beaucoup plus rapide sur les grandes photos)
+        image.draft('RGB', (max_size * 2, max_size * 2))
+        image.seek(0)
+        image = ImageOps.exif_transpose(image)
+
+    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    Path(jpeg_path).parent.mkdir(parents=True, exist_ok=True)
+    image.save(jpeg_path, 'JPEG', quality=80, optimize=True, progressive=True)
+    result = {'jpeg': True, 'webp': False}
+    try:
+        image.save(webp_path, 'WEBP', quality=75, method=4)
+        result['webp'] = True
+    except (OSError, KeyError, ValueError):
+        # Pillow compilé sans WebP : le JPEG suffit
+        pass
+    return result
+
+
+def _is_webp_supported():
+    from PIL import features
+    try:
+        return features.check('webp')
+    except Exception:
+        return False
+
+
+def render_avatar_variants(source_path, out_dir, stem, sizes, max_frames=60):
+    """Produit les variantes carrées d'un avatar : <stem>_<taille>.webp (ou .png/.gif).
+
+    Les avatars animés (GIF/WebP) gardent au plus max_frames images.
+    Retourne {'format': extension, 'sizes': [tailles produites]}.
+    """
+    from PIL import Image, ImageOps, ImageSequence
+
+    source = Image.open(source_path)
+    animated = getattr(source, 'is_animated', False) and getattr(source, 'n_frames', 1) > 1
+    frames, durations = [], []
+    if animated:
+        for index, frame in enumerate(ImageSequence.Iterator(source)):
+            if index >= max_frames:
+                break
+            frames.append(frame.convert('RGBA'))
+            durations.append(frame.info.get('duration', 100))
+    else:
+        source.draft('RGB', (max(sizes) * 2, max(sizes) * 2))
+        frames.append(ImageOps.exif_transpose(source).convert('RGBA'))
+
+    use_webp = _is_webp_supported()
+    if use_webp:
+        fmt = 'webp'
+    else:
+        fmt = 'gif' if animated else 'png'
+    out_dir = Path(out_dir)
+    produced = []
+    for size in sorted(sizes):
+        resized = [ImageOps.fit(frame, (size, size), Image.Resampling.LANCZOS) for frame in frames]
+        target = out_dir / f"{stem}_{size}.{fmt}"
+        if fmt == 'webp':
+            if animated:
+                resized[0].save(target, 'WEBP', save_all=True, append_images=resized[1:],
+                                duration=durations, loop=0, quality=80, method=4)
+            else:
+                resized[0].save(target, 'WEBP', quality=82, method=4)
+        elif fmt == 'gif':
+            resized[0].save(target, 'GIF', save_all=True, append_images=resized[1:],
+                            duration=durations, loop=0, disposal=2)
+        else:
+            resized[0].save(target, 'PNG', optimize=True)
+        produced.append(size)
+    return {'format': fmt, 'sizes': produced}